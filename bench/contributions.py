@@ -0,0 +1,82 @@
+# encoding=utf-8
+# vim: fenc=utf-8 et sw=4 ts=4 sts=4 ai
+"""
+Benchmark the UserContributions bookkeeping on a synthetic user.
+
+    python -m bench.contributions [--articles 5000] [--revisions 5]
+
+Each revision gets one contribution from each of two rules, one of them capped,
+so the default settings give 50 000 contributions.
+"""
+import argparse
+import re
+import time
+from unittest.mock import Mock
+
+from ukbot.contributions import UserContribution
+from ukbot.rules.byte import ByteRule
+from ukbot.rules.word import WordRule
+from ukbot.site import Site
+from ukbot.user import User
+
+
+def make_user(narticles, nrevisions):
+    contest = Mock()
+    contest.config = {'ignoreTags': [], 'wikidata_languages': []}
+    site = Mock(Site)
+    site.key = 'no.wikipedia.org'
+    site.redirect_regexp = re.compile('(?:redirect)', re.I)
+    user = User('Benchmark', contest)
+    revid = 0
+    for n in range(narticles):
+        article = user.add_article_if_necessary(site, 'Article %d' % n, 0)
+        for m in range(nrevisions):
+            revid += 1
+            article.add_revision(revid, timestamp=revid, parentid=revid - 1 if m > 0 else 0,
+                                 username=user.name, text='', parenttext='')
+    return contest, site, user
+
+
+def make_rule(cls, points, maxpoints=None):
+    params = {2: str(points)}
+    if maxpoints is not None:
+        params['maks'] = str(maxpoints)
+    return cls(None, params, {'maxpoints': 'maks'})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark UserContributions')
+    parser.add_argument('--articles', type=int, default=5000)
+    parser.add_argument('--revisions', type=int, default=5, help='Revisions per article')
+    args = parser.parse_args()
+
+    contest, site, user = make_user(args.articles, args.revisions)
+    byte_rule = make_rule(ByteRule, 2.)
+    word_rule = make_rule(WordRule, 7., maxpoints=25.)
+    revisions = list(user.revisions.values())
+    contributions = user.contributions
+
+    t0 = time.time()
+    for rev in revisions:
+        contributions.add(UserContribution(rev=rev, points=2., rule=byte_rule, description='bytes'))
+        contributions.add(UserContribution(rev=rev, points=7., rule=word_rule, description='words'))
+    t_add = time.time() - t0
+    print('add()                : %7.2f secs for %d contributions' % (t_add, len(contributions.contributions)))
+
+    t0 = time.time()
+    for rev in revisions:
+        contributions.get(revision=rev)
+    print('get(revision)        : %7.2f secs for %d revisions' % (time.time() - t0, len(revisions)))
+
+    t0 = time.time()
+    for article in user.articles.values():
+        contributions.get_article_points(article)
+    print('get_article_points() : %7.2f secs for %d articles' % (time.time() - t0, len(user.articles)))
+
+    t0 = time.time()
+    total = contributions.sum()
+    print('sum()                : %7.2f secs, %.1f points' % (time.time() - t0, total))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+# encoding=utf-8
+# vim: fenc=utf-8 et sw=4 ts=4 sts=4 ai
+"""
+Benchmark the startup cost of a bot job: importing ukbot.ukbot, and the first
+call to cleanup_input with an empty and with a warm cache dir.
+
+    python -m bench.startup [--repeat 5]
+
+Each measurement runs in a fresh interpreter, since imports are only slow once.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+IMPORT = """
+import time
+t0 = time.perf_counter()
+import ukbot.ukbot
+print(time.perf_counter() - t0)
+"""
+
+CLEANUP = """
+import time
+from ukbot.util import cleanup_input
+t0 = time.perf_counter()
+cleanup_input('Test\\u200b')
+print(time.perf_counter() - t0)
+"""
+
+
+def measure(code, repeat, env):
+    times = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', code], env=env, check=True, capture_output=True, text=True)
+        times.append(float(out.stdout.strip().splitlines()[-1]))
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the startup time')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, UKBOT_CACHE_DIR=tmp)
+
+        print('import ukbot.ukbot              : %7.1f ms' % (1000 * measure(IMPORT, args.repeat, env)))
+
+        cold = []
+        for n in range(args.repeat):
+            cold_env = dict(env, UKBOT_CACHE_DIR=os.path.join(tmp, 'cold%d' % n))
+            cold.append(measure(CLEANUP, 1, cold_env))
+        print('first cleanup_input, cold cache : %7.1f ms' % (1000 * statistics.median(cold)))
+        measure(CLEANUP, 1, env)  # fill the cache
+        print('first cleanup_input, warm cache : %7.1f ms' % (1000 * measure(CLEANUP, args.repeat, env)))
+
+
+if __name__ == '__main__':
+    main()
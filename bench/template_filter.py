@@ -0,0 +1,91 @@
+# encoding=utf-8
+# vim: fenc=utf-8 et sw=4 ts=4 sts=4 ai
+"""
+Benchmark TemplateFilter matching on a large article with a large set of aliases.
+
+    python -m bench.template_filter [--aliases 500] [--size 300000] [--repeat 50]
+
+The article contains many templates, but none of the filter templates, which is the
+worst case since the whole text has to be searched.
+"""
+import argparse
+import random
+import re
+import time
+from unittest.mock import Mock
+
+from ukbot.filters import TemplateFilter, trie_regexp
+
+
+def make_article(size, rng):
+    words = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit']
+    parts = []
+    length = 0
+    while length < size:
+        if rng.random() < 0.05:
+            part = '{{Infoboks %s|navn=%s}}' % (rng.choice(words), rng.choice(words))
+        elif rng.random() < 0.05:
+            part = '<ref>{{Kilde www|url=https://example.org/%d|tittel=%s}}</ref>' % (length, rng.choice(words))
+        else:
+            part = ' '.join(rng.choice(words) for _ in range(12)) + '.\n'
+        parts.append(part)
+        length += len(part)
+    return ''.join(parts)
+
+
+def make_aliases(naliases, rng):
+    prefixes = ['Opprydning', 'Kilder', 'Stubb', 'Wikifiser', 'Språkvask', 'Mangler']
+    return ['%s-%d%s' % (rng.choice(prefixes), n, '*' if n % 50 == 0 else '') for n in range(naliases)]
+
+
+def old_matcher(templates):
+    """ The matcher as it was before it was precompiled """
+    def text_contains_template(text):
+        tpls = [x.replace('*', '[^}]*?') for x in templates]
+        m = re.search(r'{{(%s)[\s]*(\||}})' % '|'.join(tpls), text, flags=re.IGNORECASE)
+        if m:
+            return m.group(1)
+        return None
+    return text_contains_template
+
+
+def alternation_matcher(templates):
+    """ A precompiled plain alternation, without the trie """
+    tpls = [re.escape(x).replace(r'\*', '[^}]*?') for x in templates]
+    matcher = re.compile(r'{{(%s)[\s]*(\||}})' % '|'.join(tpls), flags=re.IGNORECASE)
+    return lambda text: matcher.search(text)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark TemplateFilter matching')
+    parser.add_argument('--aliases', type=int, default=500)
+    parser.add_argument('--size', type=int, default=300000, help='Article size in characters')
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    text = make_article(args.size, rng)
+    templates = make_aliases(args.aliases, rng)
+
+    sites = Mock()
+    sites.homesite.pages = {}
+    t0 = time.time()
+    template_filter = TemplateFilter(sites, templates, include_aliases=False)
+    print('Compiling the trie matcher: %.1f ms (pattern: %d chars, plain alternation: %d chars)' % (
+        (time.time() - t0) * 1000, len(trie_regexp(templates)), len('|'.join(templates))))
+
+    for name, fn in [
+        ('old (formatted per call)', old_matcher(templates)),
+        ('precompiled alternation', alternation_matcher(templates)),
+        ('precompiled trie', template_filter.text_contains_template),
+    ]:
+        t0 = time.time()
+        for _ in range(args.repeat):
+            assert not fn(text)
+        dt = time.time() - t0
+        print('%-25s: %6.2f ms per article (%.1f MB/sec)' % (name, 1000 * dt / args.repeat,
+                                                            args.repeat * len(text) / dt / 1e6))
+
+
+if __name__ == '__main__':
+    main()
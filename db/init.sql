@@ -1,4 +1,7 @@
 # ************************************************************
+# Creates the tables for a new database. This drops the existing tables!
+# To upgrade an existing database, run `ukbot-textstore migrate`.
+# ************************************************************
 # Sequel Ace SQL dump
 # Version 20033
 #
@@ -81,16 +84,18 @@ CREATE TABLE `contribs` (
 
 
 
-# Dump of table fulltexts
+# Dump of table kvcache
 # ------------------------------------------------------------
 
-DROP TABLE IF EXISTS `fulltexts`;
+DROP TABLE IF EXISTS `kvcache`;
 
-CREATE TABLE `fulltexts` (
-  `revid` int(11) unsigned NOT NULL,
-  `site` varchar(50) COLLATE utf8mb4_bin NOT NULL,
-  `revtxt` mediumtext COLLATE utf8mb4_bin NOT NULL,
-  PRIMARY KEY (`revid`,`site`) USING BTREE
+CREATE TABLE `kvcache` (
+  `namespace` varchar(50) CHARACTER SET ascii NOT NULL,
+  `hash` char(40) CHARACTER SET ascii NOT NULL,
+  `value` mediumtext COLLATE utf8mb4_bin NOT NULL,
+  `expires` int(11) unsigned NOT NULL,
+  PRIMARY KEY (`namespace`,`hash`),
+  KEY `expires` (`expires`)
 ) ENGINE=MyISAM DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_bin;
 
 
@@ -129,6 +134,36 @@ CREATE TABLE `prizes` (
 
 
 
+# Dump of table revmetrics
+# ------------------------------------------------------------
+
+DROP TABLE IF EXISTS `revmetrics`;
+
+CREATE TABLE `revmetrics` (
+  `revid` int(11) unsigned NOT NULL,
+  `site` varchar(50) COLLATE utf8mb4_bin NOT NULL,
+  `version` int(4) unsigned NOT NULL,
+  `metrics` mediumtext COLLATE utf8mb4_bin NOT NULL,
+  PRIMARY KEY (`revid`,`site`) USING BTREE
+) ENGINE=MyISAM DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_bin;
+
+
+
+# Dump of table revtexts
+# ------------------------------------------------------------
+
+DROP TABLE IF EXISTS `revtexts`;
+
+CREATE TABLE `revtexts` (
+  `revid` int(11) unsigned NOT NULL,
+  `site` varchar(50) COLLATE utf8mb4_bin NOT NULL,
+  `sha1` char(40) CHARACTER SET ascii NOT NULL,
+  PRIMARY KEY (`revid`,`site`) USING BTREE,
+  KEY `sha1` (`sha1`)
+) ENGINE=MyISAM DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_bin;
+
+
+
 # Dump of table schemachanges
 # ------------------------------------------------------------
 
@@ -160,6 +195,39 @@ CREATE TABLE `stats` (
 
 
 
+# Dump of table sync_cursors
+# ------------------------------------------------------------
+
+DROP TABLE IF EXISTS `sync_cursors`;
+
+CREATE TABLE `sync_cursors` (
+  `contestsite` varchar(50) COLLATE utf8_bin NOT NULL,
+  `contest` varchar(100) COLLATE utf8_bin NOT NULL,
+  `user` varchar(100) COLLATE utf8_bin NOT NULL,
+  `site` varchar(50) COLLATE utf8_bin NOT NULL,
+  `window_start` datetime NOT NULL,
+  `last_timestamp` datetime NOT NULL,
+  `last_revid` int(11) unsigned NOT NULL,
+  `full_sync_at` datetime NOT NULL,
+  PRIMARY KEY (`contestsite`,`contest`,`user`,`site`)
+) ENGINE=MyISAM DEFAULT CHARSET=utf8 COLLATE=utf8_bin;
+
+
+
+# Dump of table textblobs
+# ------------------------------------------------------------
+
+DROP TABLE IF EXISTS `textblobs`;
+
+CREATE TABLE `textblobs` (
+  `sha1` char(40) CHARACTER SET ascii NOT NULL,
+  `len` int(11) unsigned NOT NULL,
+  `data` mediumblob NOT NULL,
+  PRIMARY KEY (`sha1`)
+) ENGINE=MyISAM DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_bin;
+
+
+
 # Dump of table users
 # ------------------------------------------------------------
 
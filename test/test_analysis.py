@@ -0,0 +1,43 @@
+# encoding=utf-8
+import unittest
+from unittest import TestCase
+from unittest.mock import Mock
+
+from ukbot.analysis import AnalysisCache, text_digest
+
+
+class TestAnalysisCache(TestCase):
+
+    def test_memoizes(self):
+        cache = AnalysisCache()
+        compute = Mock(return_value=(1, 2))
+        digest = text_digest('Some text')
+
+        self.assertEqual(cache.get(digest, 'feature', (), compute), (1, 2))
+        self.assertEqual(cache.get(digest, 'feature', (), compute), (1, 2))
+        self.assertEqual(compute.call_count, 1)
+
+        # Different feature parameters or texts are cached separately
+        cache.get(digest, 'feature', ('param',), compute)
+        cache.get(text_digest('Other text'), 'feature', (), compute)
+        self.assertEqual(compute.call_count, 3)
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+    def test_evicts_least_recently_used(self):
+        cache = AnalysisCache(max_bytes=1200)
+        digests = [text_digest(str(n)) for n in range(3)]
+
+        cache.get(digests[0], 'feature', (), lambda: 'x' * 300)
+        cache.get(digests[1], 'feature', (), lambda: 'x' * 300)
+        cache.get(digests[0], 'feature', (), lambda: 'unused')
+        cache.get(digests[2], 'feature', (), lambda: 'x' * 300)
+
+        self.assertLessEqual(cache.size, 1200)
+        self.assertEqual(cache.hits, 1)
+        self.assertIn((digests[0], 'feature', ()), cache.entries)
+        self.assertNotIn((digests[1], 'feature', ()), cache.entries)
+        self.assertIn((digests[2], 'feature', ()), cache.entries)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+# encoding=utf-8
+import unittest
+from unittest import TestCase
+from unittest.mock import Mock
+
+from ukbot.batching import BatchBudgets, batch_length, DEFAULT_BUDGET, MIN_BUDGET
+
+
+class TestBatchLength(TestCase):
+
+    def test_limited_by_count(self):
+        self.assertEqual(batch_length([1, 2, 3, 4], None, 3, None), 3)
+        self.assertEqual(batch_length([1, 2], {1: 10, 2: 10}, 3, 100), 2)
+
+    def test_limited_by_bytes(self):
+        sizes = {1: 40, 2: 40, 3: 40, 4: 40}
+        self.assertEqual(batch_length([1, 2, 3, 4], sizes, 10, 100), 2)
+
+    def test_at_least_one_revision(self):
+        self.assertEqual(batch_length([1, 2], {1: 500, 2: 10}, 10, 100), 1)
+
+
+class TestBatchBudgets(TestCase):
+
+    def test_budget_is_lowered_on_overflow_and_raised_on_success(self):
+        budgets = BatchBudgets()
+        budgets.overflow('no.wikipedia.org', 1000000)
+        self.assertEqual(budgets.get('no.wikipedia.org'), 900000)
+        self.assertEqual(budgets.get('nn.wikipedia.org'), DEFAULT_BUDGET)
+
+        budgets.success('no.wikipedia.org', 100000)  # A small batch says nothing about the limit
+        self.assertEqual(budgets.get('no.wikipedia.org'), 900000)
+        budgets.success('no.wikipedia.org', 850000)
+        self.assertEqual(budgets.get('no.wikipedia.org'), 1125000)
+
+        budgets.overflow('no.wikipedia.org', 0)
+        self.assertEqual(budgets.get('no.wikipedia.org'), MIN_BUDGET)
+
+    def test_changed_budgets_are_stored(self):
+        cache = Mock()
+        cache.get_many.return_value = {'no.wikipedia.org': 2000000}
+        budgets = BatchBudgets()
+        budgets.load(cache, ['no.wikipedia.org', 'nn.wikipedia.org'])
+        self.assertEqual(budgets.get('no.wikipedia.org'), 2000000)
+
+        budgets.overflow('nn.wikipedia.org', 1000000)
+        budgets.save(cache)
+
+        cache.set_many.assert_called_once_with('revision_batch_bytes', {'nn.wikipedia.org': 900000})
+
+
+if __name__ == '__main__':
+    unittest.main()
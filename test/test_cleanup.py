@@ -0,0 +1,137 @@
+# encoding=utf-8
+import unittest
+from datetime import datetime
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+import pytz
+
+from ukbot.cleanup import ContribsCleaner
+
+
+class FakeCursor(object):
+    """ Answers the queries starting with each prefix with the given results, in order """
+
+    def __init__(self, results):
+        self.results = results
+        self.queries = []
+        self.rows = []
+        self.rowcount = 0
+
+    def execute(self, query, params=None):
+        self.queries.append((query, params))
+        self.rows = []
+        self.rowcount = 0
+        for prefix, answers in self.results.items():
+            if query.startswith(prefix):
+                self.rows = answers.pop(0) if len(answers) > 0 else []
+                break
+        if query.startswith('DELETE'):
+            self.rowcount = 1
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchone(self):
+        return self.rows[0]
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def close(self):
+        pass
+
+
+class TestContribsCleaner(TestCase):
+
+    def setUp(self):
+        self.cur = FakeCursor({
+            'SELECT site, name, start_date, end_date FROM contests': [[]],
+            'SELECT revid, site, parentid FROM contribs': [[(12, 'no.wikipedia.org', 11), (13, 'no.wikipedia.org', 12)], []],
+            'SELECT revid, site FROM contribs': [[]],
+            # Revision 13 is the parent of a contribution after the contest period
+            'SELECT parentid, site FROM contribs': [[(13, 'no.wikipedia.org')]],
+            'SELECT sha1 FROM revtexts': [[('a',), ('b',)]],
+            'SELECT COUNT(*) FROM revmetrics': [[(2,)]],
+            'SELECT sha1, COUNT(*) FROM revtexts': [[('a', 1), ('b', 2)]],
+            'SELECT COUNT(*), SUM(LENGTH(data)) FROM textblobs': [[(1, 1000)]],
+        })
+        self.sql = Mock()
+        self.sql.cursor.return_value = self.cur
+
+    def cleaner(self, dry_run):
+        return ContribsCleaner(self.sql, datetime(2024, 1, 1), datetime(2024, 1, 31, 23, 59, 59),
+                               'no.wikipedia.org', 'Current contest', chunk_size=100, sleep=0, dry_run=dry_run)
+
+    def test_dry_run(self):
+        report = self.cleaner(dry_run=True).run()
+
+        self.assertEqual([q for q, p in self.cur.queries if q.startswith('DELETE')], [])
+        self.assertEqual(report['contribs'], 2)
+        self.assertEqual(report['revtexts'], 2)
+        self.assertEqual(report['revmetrics'], 2)
+        self.assertEqual(report['protected'], 1)
+        # Blob 'b' is still used by another revision
+        self.assertEqual(report['textblobs'], 1)
+        self.assertEqual(report['bytes'], 1000)
+
+    @patch('ukbot.cleanup.time.sleep')
+    def test_referenced_texts_are_kept(self, sleep):
+        self.cur.results['SELECT sha1, COUNT(*) FROM revtexts'] = [[('b', 1)]]
+
+        self.cleaner(dry_run=False).run()
+
+        deletes = {q.split()[2]: p for q, p in self.cur.queries if q.startswith('DELETE')}
+        self.assertEqual(sorted(zip(deletes['revtexts'][::2], deletes['revtexts'][1::2])),
+                         [(11, 'no.wikipedia.org'), (12, 'no.wikipedia.org')])
+        self.assertEqual(deletes['contribs'], [12, 'no.wikipedia.org', 13, 'no.wikipedia.org'])
+        self.assertIn('textblobs', deletes)
+
+    def test_current_contest_is_not_kept(self):
+        # In a dry run, the contest being cleaned has not been closed
+        self.cur.results['SELECT site, name, start_date, end_date FROM contests'] = [
+            [('no.wikipedia.org', 'Current contest', datetime(2024, 1, 1), datetime(2024, 1, 31, 23, 59, 59))],
+        ]
+
+        report = self.cleaner(dry_run=True).run()
+
+        query, params = self.cur.queries[0]
+        self.assertIn('NOT (site=%s AND name=%s)', query)
+        self.assertEqual(params[2:], ['no.wikipedia.org', 'Current contest'])
+        contribs_query, contribs_params = [(q, p) for q, p in self.cur.queries if q.startswith('SELECT revid, site, parentid')][0]
+        self.assertNotIn('NOT (timestamp', contribs_query)
+        self.assertEqual(report['contribs'], 2)
+
+    def test_contributions_of_open_contests_are_kept(self):
+        oslo = pytz.timezone('Europe/Oslo')
+        # January 2024 in Oslo, in UTC
+        cleaner = ContribsCleaner(self.sql, datetime(2023, 12, 31, 23), datetime(2024, 1, 31, 22, 59, 59),
+                                  'no.wikipedia.org', 'Current contest', wiki_tz=oslo, dry_run=True)
+        self.cur.results['SELECT site, name, start_date, end_date FROM contests'] = [[
+            ('no.wikipedia.org', 'Open contest', datetime(2024, 1, 20), datetime(2024, 2, 20, 23, 59, 59)),
+            # Ended just before the contest period, but is within a day of it
+            ('no.wikipedia.org', 'December contest', datetime(2023, 12, 1), datetime(2023, 12, 31, 23, 59, 59)),
+        ]]
+
+        windows = cleaner.open_contest_windows(self.cur)
+
+        self.assertEqual(windows, [('Open contest', datetime(2024, 1, 19, 23), datetime(2024, 2, 20, 22, 59, 59))])
+        # A contribution just before the open contest starts is deleted now. Its own cleanup
+        # will not cover it later.
+        name, open_start, open_end = windows[0]
+        self.assertFalse(open_start <= datetime(2024, 1, 19, 22, 30) <= open_end)
+        self.assertTrue(open_start <= datetime(2024, 1, 19, 23, 30) <= open_end)
+
+    def test_deletable_condition(self):
+        self.cur.results['SELECT site, name, start_date, end_date FROM contests'] = [
+            [('no.wikipedia.org', 'Open contest', datetime(2024, 1, 20), datetime(2024, 2, 20, 23, 59, 59))],
+        ]
+
+        condition, params = self.cleaner(dry_run=True).deletable_condition(self.cur)
+
+        self.assertEqual(condition, 'timestamp >= %s AND timestamp <= %s AND NOT (timestamp >= %s AND timestamp <= %s)')
+        self.assertEqual(params, ['2024-01-01 00:00:00', '2024-01-31 23:59:59', '2024-01-20 00:00:00', '2024-02-20 23:59:59'])
+
+if __name__ == '__main__':
+    unittest.main()
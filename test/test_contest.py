@@ -0,0 +1,36 @@
+# encoding=utf-8
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase
+from unittest.mock import Mock
+
+from ukbot.contest import Contest
+
+
+class TestIngestContribs(TestCase):
+
+    def test_failed_fetch_cancels_the_batch(self):
+        contest = Mock()
+        users = [Mock(), Mock(), Mock()]
+
+        def add_contribs_from_wikis(user):
+            if user is users[0]:
+                raise IOError('Connection reset')
+            time.sleep(0.2)  # Keep the worker busy until the pending fetches are cancelled
+
+        contest.add_contribs_from_wikis.side_effect = add_contribs_from_wikis
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            with self.assertRaises(IOError):
+                Contest.ingest_contribs(contest, users, executor)
+
+        fetched = [c[0][0] for c in contest.add_contribs_from_wikis.call_args_list]
+        self.assertNotIn(users[2], fetched)
+        for user in users:
+            user.save_contribs_to_db.assert_not_called()
+            user.save_sync_cursors.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+# encoding=utf-8
+import re
+import unittest
+from unittest import TestCase
+from unittest.mock import Mock
+
+from ukbot.contributions import UserContribution
+from ukbot.rules import ByteRule, WordRule
+from ukbot.rules.regexp import RegexpRule, SectionRule
+from ukbot.site import Site
+from ukbot.user import User
+
+
+def make_rule(cls, points, maxpoints=None):
+    params = {2: str(points), 3: 'pattern'}
+    if maxpoints is not None:
+        params['maks'] = str(maxpoints)
+    return cls(None, params, {'maxpoints': 'maks', 'description': 'beskrivelse'})
+
+
+class TestUserContributions(TestCase):
+
+    def setUp(self):
+        contest = Mock()
+        contest.config = {'ignoreTags': [], 'wikidata_languages': []}
+        self.site = Mock(Site)
+        self.site.key = 'no.wikipedia.org'
+        self.site.redirect_regexp = re.compile('(?:redirect)', re.I)
+        self.user = User('Testuser', contest)
+        self.contributions = self.user.contributions
+        self.revs = []
+        for n, title in enumerate(['A', 'A', 'A', 'B']):
+            article = self.user.add_article_if_necessary(self.site, title, 0)
+            self.revs.append(article.add_revision(n + 1, timestamp=n + 1, parentid=n, username='Testuser',
+                                                  text='', parenttext=''))
+
+    def add(self, rev, points, rule):
+        contribution = UserContribution(rev=rev, points=points, rule=rule, description='test')
+        self.contributions.add(contribution)
+        return contribution
+
+    def test_capping_per_article_and_rule(self):
+        byte_rule = make_rule(ByteRule, 1.)
+        word_rule = make_rule(WordRule, 1., maxpoints=10.)
+
+        self.assertEqual(self.add(self.revs[0], 6., word_rule).points, 6.)
+        self.assertEqual(self.add(self.revs[0], 6., byte_rule).points, 6.)
+        c = self.add(self.revs[1], 6., word_rule)
+        self.assertEqual(c.points, 4.)
+        self.assertTrue(c.capped)
+        self.assertEqual(self.add(self.revs[2], 6., word_rule).points, 0.)
+
+        # Other article
+        self.assertEqual(self.add(self.revs[3], 6., word_rule).points, 6.)
+
+        self.assertEqual(self.contributions.get_article_points(self.revs[0].article()), 16.)
+        self.assertEqual(self.contributions.get_article_points(self.revs[0].article(), ignore_max=True), 24.)
+        self.assertEqual(self.contributions.sum(), 22.)
+
+    def test_capping_includes_subclasses(self):
+        regexp_rule = make_rule(RegexpRule, 1., maxpoints=10.)
+        section_rule = make_rule(SectionRule, 1., maxpoints=10.)
+
+        self.assertEqual(self.add(self.revs[0], 8., section_rule).points, 8.)
+
+        # The section rule points count towards the regexp rule cap, but not the other way around
+        self.assertEqual(self.add(self.revs[1], 8., regexp_rule).points, 2.)
+        self.assertEqual(self.add(self.revs[2], 8., section_rule).points, 2.)
+
+    def test_get(self):
+        byte_rule = make_rule(ByteRule, 1.)
+        word_rule = make_rule(WordRule, 1.)
+        c1 = self.add(self.revs[0], 1., byte_rule)
+        c2 = self.add(self.revs[0], 1., word_rule)
+        c3 = self.add(self.revs[1], 1., byte_rule)
+        c4 = self.add(self.revs[3], 1., byte_rule)
+
+        self.assertEqual(self.contributions.get(revision=self.revs[0]), [c1, c2])
+        self.assertEqual(self.contributions.get(article=self.revs[0].article()), [c1, c2, c3])
+        self.assertEqual(self.contributions.get(article=self.revs[0].article(), rule=ByteRule), [c1, c3])
+        self.assertEqual(self.contributions.get(rule=ByteRule), [c1, c3, c4])
+        self.assertEqual(self.contributions.get(revision=self.revs[2]), [])
+        self.assertEqual(self.contributions.get_articles(), [self.revs[0].article(), self.revs[3].article()])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,7 +7,8 @@ from unittest import TestCase
 
 import itertools
 
-from ukbot.filters import CatFilter, ExternalLinksFilter
+from ukbot.cache import KeyValueCache
+from ukbot.filters import ByteFilter, CatFilter, ExternalLinksFilter, TemplateFilter, trie_regexp
 from ukbot.site import Site
 from ukbot.sites import SiteManager
 
@@ -133,6 +134,218 @@ class TestCatFilter(TestCase):
         assert self.filter_and_return_keys(**kwargs(2)) == []
         assert self.filter_and_return_keys(**kwargs(3)) == [dummy.a_key(0)]
 
+    def test_persistent_cache(self):
+        dummy = DummyDataProvider(articles=2, categories=0)
+        dummy.articles[0].name = 'Page1'
+        dummy.articles[1].name = 'Page2'
+        dummy.site.api = Mock(side_effect=[
+            {'query': {'pages': {'2': {'title': 'Page2', 'categories': [{'title': 'Kategori:Ignored'}]}}}},
+            {'query': {'pages': {'3': {'title': 'Kategori:Stored'}}}},
+        ])
+        cache = Mock(KeyValueCache)
+        cache.get_many.side_effect = lambda namespace, keys: {
+            key: ['Kategori:Stored'] for key in keys if key == 'dummy.wikipedia.org|Page1'
+        }
+
+        cat_filter = CatFilter(sites=dummy.sites, categories=[], maxdepth=1, ignore=['Ignored'], cache=cache)
+        cat_filter.add_to_category_cache(dummy.articles_keyed)
+
+        # Only the pages that were not stored are fetched, and ignored categories are not followed
+        titles = [call[1]['titles'] for call in dummy.site.api.call_args_list]
+        assert titles == ['Page2', 'Kategori:Stored']
+        assert cat_filter.categories_cache[dummy.site.key] == {
+            'Page1': {'Kategori:Stored'},
+            'Page2': set(),
+            'Kategori:Stored': set(),
+        }
+
+        # The fetched categories are stored unfiltered, since the ignore list is per contest
+        stored = [call[0][1] for call in cache.set_many.call_args_list]
+        assert stored == [
+            {'dummy.wikipedia.org|Page2': ['Kategori:Ignored']},
+            {'dummy.wikipedia.org|Kategori:Stored': []},
+        ]
+
+    def test_normalized_and_missing_titles(self):
+        dummy = DummyDataProvider(articles=0, categories=0)
+        dummy.site.api = Mock(return_value={'query': {
+            'normalized': [{'from': 'page_1', 'to': 'Page 1'}],
+            'redirects': [{'from': 'Page 1', 'to': 'Page 2'}],
+            'pages': {
+                '2': {'title': 'Page 2', 'categories': [{'title': 'Kategori:A'}]},
+                '-1': {'title': 'Page 3', 'missing': ''},
+            },
+        }})
+        cache = Mock(KeyValueCache)
+        cache.get_many.return_value = {}
+        articles = OrderedDict()
+        for title in ['page_1', 'Page 3', 'Page 4']:
+            article = dummy.article_mock(name=title)
+            articles[article.key] = article
+
+        cat_filter = CatFilter(sites=dummy.sites, categories=[], maxdepth=0, cache=cache)
+        cat_filter.add_to_category_cache(articles)
+
+        # The categories are stored under the requested title, and nothing is stored for the pages that were not found
+        assert cache.set_many.call_args[0][1] == {'dummy.wikipedia.org|page_1': ['Kategori:A']}
+        assert cat_filter.categories_cache[dummy.site.key] == {
+            'page_1': {'Kategori:A'},
+            'Page 3': set(),
+            'Page 4': set(),
+        }
+
+    def test_descendants_mode(self):
+        dummy = DummyDataProvider(articles=4, categories=0)
+        for n, article in enumerate(dummy.articles):
+            article.name = 'Page%d' % n
+            article.key = f"{dummy.site.key}:{article.name}"
+        dummy.articles_keyed = OrderedDict((a.key, a) for a in dummy.articles)
+
+        subcategories = {
+            'Kategori:Root': ['Kategori:A', 'Kategori:Ignored'],
+            'Kategori:A': ['Kategori:B'],
+            'Kategori:B': ['Kategori:C'],
+            'Kategori:Ignored': ['Kategori:D'],
+        }
+        categories = {
+            'Page0': ['Kategori:B'],
+            'Page1': ['Kategori:C', 'Kategori:A'],
+            'Page2': ['Kategori:D'],
+            'Page3': ['Kategori:Other'],
+        }
+
+        def api(action, **kwargs):
+            if kwargs.get('list') == 'categorymembers':
+                return {'query': {'categorymembers': [
+                    {'title': title} for title in subcategories.get(kwargs['cmtitle'], [])
+                ]}}
+            return {'query': {'pages': {
+                str(n): {'title': title, 'categories': [{'title': c} for c in categories[title]]}
+                for n, title in enumerate(kwargs['titles'].split('|'))
+            }}}
+        dummy.site.api = Mock(side_effect=api)
+
+        root = dummy.page_mock(name='Root', prefix='Kategori:')
+        cat_filter = CatFilter(sites=dummy.sites, categories=[root], maxdepth=2, ignore=['Ignored'],
+                               mode='descendants')
+        filtered = cat_filter.filter(dummy.articles_keyed)
+
+        # Kategori:C is too deep, and Kategori:D is only reachable through an ignored category
+        assert list(filtered.keys()) == [dummy.a_key(0), dummy.a_key(1)]
+        assert dummy.articles[0].cat_path == [dummy.site.key + ':Kategori:Root', dummy.site.key + ':Kategori:A',
+                                              dummy.site.key + ':Kategori:B']
+        assert dummy.articles[1].cat_path == [dummy.site.key + ':Kategori:Root', dummy.site.key + ':Kategori:A']
+
+        # The descendants are only expanded once
+        ncalls = dummy.site.api.call_count
+        cat_filter.filter(dummy.articles_keyed)
+        assert dummy.site.api.call_count == ncalls
+
+    def test_descendants_are_looked_up_per_level(self):
+        dummy = DummyDataProvider(articles=0, categories=0)
+        subcategories = {
+            'Kategori:A': ['Kategori:C'],
+            'Kategori:B': [],
+        }
+        dummy.site.api = Mock(side_effect=lambda action, **kwargs: {'query': {'categorymembers': [
+            {'title': title} for title in subcategories[kwargs['cmtitle']]
+        ]}})
+        cache = Mock(KeyValueCache)
+        cache.get_many.side_effect = lambda namespace, keys: {
+            key: ['Kategori:A', 'Kategori:B'] for key in keys if key == 'dummy.wikipedia.org|Kategori:Root'
+        }
+
+        root = dummy.page_mock(name='Root', prefix='Kategori:')
+        cat_filter = CatFilter(sites=dummy.sites, categories=[root], maxdepth=2, cache=cache, mode='descendants')
+        cat_filter.build_descendants()
+
+        # One cache query per level, and the API is only queried for the categories that were not stored
+        assert [call[0][1] for call in cache.get_many.call_args_list] == [
+            ['dummy.wikipedia.org|Kategori:Root'],
+            ['dummy.wikipedia.org|Kategori:A', 'dummy.wikipedia.org|Kategori:B'],
+        ]
+        assert [call[1]['cmtitle'] for call in dummy.site.api.call_args_list] == ['Kategori:A', 'Kategori:B']
+        assert [call[0][1] for call in cache.set_many.call_args_list] == [{
+            'dummy.wikipedia.org|Kategori:A': ['Kategori:C'],
+            'dummy.wikipedia.org|Kategori:B': [],
+        }]
+        cache.get.assert_not_called()
+        assert sorted(cat_filter.descendants.keys()) == [
+            'dummy.wikipedia.org:Kategori:A', 'dummy.wikipedia.org:Kategori:B',
+            'dummy.wikipedia.org:Kategori:C', 'dummy.wikipedia.org:Kategori:Root',
+        ]
+
+
+class TestSharedVerdicts(TestCase):
+
+    def test_verdicts_are_shared_between_users(self):
+        dummy = DummyDataProvider(articles=2, categories=2)
+        cat_filter = TestCatFilter.cat_filter_with_cache(dummy, categories=[dummy.categories[1]], tree={
+            dummy.articles[0]: {dummy.categories[0]},
+            dummy.articles[1]: {dummy.categories[0]},
+            dummy.categories[0]: {dummy.categories[1]},
+            dummy.categories[1]: {},
+        })
+        cat_filter.filter = Mock(side_effect=cat_filter.filter)
+        for article in dummy.articles:
+            article.errors = []
+        assert list(cat_filter.apply(dummy.articles_keyed).keys()) == [dummy.a_key(0), dummy.a_key(1)]
+
+        # Another user's article objects for the same pages
+        other = OrderedDict()
+        for article in dummy.articles:
+            other_article = dummy.article_mock(name=article.name)
+            other_article.errors = []
+            other[other_article.key] = other_article
+        assert list(cat_filter.apply(other).keys()) == [dummy.a_key(0), dummy.a_key(1)]
+        assert cat_filter.filter.call_count == 1
+        assert other[dummy.a_key(0)].cat_path == [dummy.c_key(1), dummy.c_key(0)]
+
+    def test_user_specific_filters_are_not_shared(self):
+        dummy = DummyDataProvider(articles=1, categories=0)
+        dummy.articles[0].bytes = 200
+        dummy.articles[0].errors = []
+        byte_filter = ByteFilter(sites=dummy.sites, bytelimit=100)
+        assert len(byte_filter.apply(dummy.articles_keyed)) == 1
+
+        dummy.articles[0].bytes = 50
+        assert len(byte_filter.apply(dummy.articles_keyed)) == 0
+
+
+class TestTemplateFilter(TestCase):
+
+    def make_filter(self, templates, redirects, cache=None):
+        dummy = DummyDataProvider(articles=0, categories=0)
+        template_page = Mock()
+        template_page.exists = True
+        template_page.backlinks = Mock(return_value=[Mock(page_title=title) for title in redirects])
+        dummy.sites.homesite = dummy.site
+        dummy.site.pages = {'Template:%s' % name: template_page for name in templates}
+        return TemplateFilter(sites=dummy.sites, templates=templates, cache=cache), template_page
+
+    def test_trie_regexp(self):
+        words = ['stub', 'stubb', 'stub-bio', 'sport*stub', 'a.b']
+        matcher = re.compile('^(%s)$' % trie_regexp(words))
+        for text in ['stub', 'stubb', 'stub-bio', 'sportstub', 'sport-bio-stub', 'a.b']:
+            assert matcher.match(text), text
+        for text in ['stu', 'stubbb', 'sport}stub', 'axb']:
+            assert not matcher.match(text), text
+
+    def test_text_contains_template(self):
+        template_filter, _ = self.make_filter(['Stubb'], ['Stub', 'Spire', 'Sport*stubb'])
+        assert template_filter.text_contains_template('Tekst\n{{stubb}}') == 'stubb'
+        assert template_filter.text_contains_template('{{Stub|dato=2020}}') == 'Stub'
+        assert template_filter.text_contains_template('{{Fotball-sportsstubb }}') is None
+        assert template_filter.text_contains_template('{{Sport-fotball-stubb}}') == 'Sport-fotball-stubb'
+        assert template_filter.text_contains_template('{{Stubbete}}') is None
+
+    def test_cached_aliases(self):
+        cache = Mock(KeyValueCache)
+        cache.get_many.return_value = {'dummy.wikipedia.org|Stubb': ['Stub']}
+        template_filter, template_page = self.make_filter(['Stubb'], ['Spire'], cache)
+        template_page.backlinks.assert_not_called()
+        assert template_filter.templates == ['Stubb', 'Stub']
+
 
 class TestExternalLinksFilter(TestCase):
 
@@ -0,0 +1,48 @@
+# encoding=utf-8
+import unittest
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+from ukbot.globaluserinfo import GlobalUserInfoService, hostnames
+
+
+def response(merged):
+    resp = Mock()
+    resp.json.return_value = {'query': {'globaluserinfo': {'merged': merged}}}
+    return resp
+
+
+class TestGlobalUserInfoService(TestCase):
+
+    def setUp(self):
+        self.cache = Mock()
+        self.cache.get_many.return_value = {'Cached': [{'wiki': 'nowiki', 'url': 'https://no.wikipedia.org'}]}
+        self.cache.ttl.return_value = 3600
+        self.service = GlobalUserInfoService(self.cache, workers=2)
+
+    @patch('ukbot.transport.Session.get')
+    def test_prefetch(self, get):
+        def lookup(url, params, timeout):
+            if params['guiuser'] == 'Failing':
+                raise IOError('timeout')
+            return response([
+                {'wiki': 'nowiki', 'url': 'https://no.wikipedia.org'},
+                {'wiki': 'wikidatawiki', 'url': 'https://www.wikidata.org'},
+            ])
+        get.side_effect = lookup
+
+        self.service.prefetch(['Cached', 'User', 'Failing', 'User'])
+
+        self.assertEqual(get.call_count, 2)
+        self.assertEqual(hostnames(self.service.get('User')), {'no.wikipedia.org', 'www.wikidata.org'})
+        self.assertEqual(hostnames(self.service.get('Cached')), {'no.wikipedia.org'})
+        self.assertIsNone(self.service.get('Failing'))
+        self.assertEqual(get.call_count, 2)
+
+        # Failures are cached with their own time to live
+        self.cache.set_many.assert_any_call('globaluserinfo', {'User': self.service.get('User')})
+        self.cache.set_many.assert_any_call('globaluserinfo', {'Failing': None}, ttl=3600)
+
+
+if __name__ == '__main__':
+    unittest.main()
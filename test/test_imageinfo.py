@@ -0,0 +1,73 @@
+# encoding=utf-8
+import unittest
+from unittest import TestCase
+from unittest.mock import Mock
+
+from ukbot.cache import KeyValueCache
+from ukbot.imageinfo import ImageInfoService, query_imageinfo
+from ukbot.site import Site
+
+
+def imageinfo_response():
+    return {
+        'query': {
+            'normalized': [{'from': 'File:local_file.jpg', 'to': 'File:Local file.jpg'}],
+            'pages': {
+                '-1': {'ns': 6, 'title': 'File:Missing.jpg', 'missing': ''},
+                '-2': {'ns': 6, 'title': 'File:Commons.jpg', 'missing': '', 'known': '',
+                       'imagerepository': 'shared',
+                       'imageinfo': [{'user': 'Other', 'extmetadata': {}}]},
+                '12': {'ns': 6, 'title': 'File:Local file.jpg', 'pageid': 12,
+                       'imageinfo': [{'user': 'Testuser', 'extmetadata': {
+                           'Credit': {'value': '<span class="int-own-work">Own work</span>'}}}]},
+            },
+        },
+    }
+
+
+class TestImageInfo(TestCase):
+
+    def setUp(self):
+        self.site = Mock(Site)
+        self.site.key = 'fi.wikipedia.org'
+        self.site.rights = []
+        self.site.api.return_value = imageinfo_response()
+
+    def test_query_imageinfo(self):
+        infos = query_imageinfo(self.site, ['local_file.jpg', 'Missing.jpg', 'Commons.jpg'])
+        self.assertEqual(infos, {
+            'local_file.jpg': {'user': 'Testuser', 'credit': '<span class="int-own-work">Own work</span>'},
+            'Missing.jpg': None,
+            'Commons.jpg': {'user': 'Other', 'credit': ''},
+        })
+        self.assertEqual(self.site.api.call_count, 1)
+        self.assertEqual(self.site.api.call_args[1]['iiprop'], 'user|extmetadata')
+
+    def test_batches(self):
+        service = ImageInfoService()
+        service.prefetch(self.site, ['File%d.jpg' % n for n in range(120)])
+        self.assertEqual(self.site.api.call_count, 3)
+
+        # Known files, also missing ones, are not looked up again
+        service.prefetch(self.site, ['File1.jpg'])
+        self.assertIsNone(service.get(self.site, 'File2.jpg'))
+        self.assertEqual(self.site.api.call_count, 3)
+
+    def test_persistent_cache(self):
+        cache = Mock(KeyValueCache)
+        cache.get_many.return_value = {'fi.wikipedia.org|Cached.jpg': {'user': 'Testuser', 'credit': ''}}
+        service = ImageInfoService(cache)
+        service.prefetch(self.site, ['Cached.jpg', 'local_file.jpg', 'Missing.jpg'])
+
+        self.assertEqual(service.get(self.site, 'Cached.jpg'), {'user': 'Testuser', 'credit': ''})
+        self.assertEqual(self.site.api.call_count, 1)
+        titles = self.site.api.call_args[1]['titles'].split('|')
+        self.assertEqual(sorted(titles), ['File:Missing.jpg', 'File:local_file.jpg'])
+
+        # Only files that exist are stored
+        stored = cache.set_many.call_args[0][1]
+        self.assertEqual(list(stored.keys()), ['fi.wikipedia.org|local_file.jpg'])
+
+
+if __name__ == '__main__':
+    unittest.main()
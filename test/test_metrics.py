@@ -0,0 +1,58 @@
+# encoding=utf-8
+import json
+import re
+import unittest
+from unittest import TestCase
+from unittest.mock import Mock
+
+from ukbot.metrics import ANALYZER_VERSION, Metrics, MetricsStore, metric_key
+from ukbot.site import Site
+from ukbot.user import User
+
+
+class TestMetrics(TestCase):
+
+    def setUp(self):
+        contest = Mock()
+        contest.config = {'ignoreTags': [], 'wikidata_languages': []}
+        self.site = Mock(Site)
+        self.site.key = 'no.wikipedia.org'
+        self.site.redirect_regexp = re.compile('(?:redirect)', re.I)
+        self.user = User('Testuser', contest)
+        article = self.user.add_article_if_necessary(self.site, 'A', 0)
+        self.rev = article.add_revision(12, timestamp=1, parentid=11, username='Testuser',
+                                        text='Hello world', parenttext='Hello')
+
+    def test_metric_key(self):
+        self.assertEqual(metric_key('sources', ()), 'sources')
+        self.assertEqual(metric_key('external_links', ('wiki',)), 'external_links:["wiki"]')
+
+    def test_dirty_tracking(self):
+        metrics = Metrics({'sources': [1, 2]})
+        self.assertFalse(metrics.dirty)
+        metrics['images'] = []
+        self.assertTrue(metrics.dirty)
+
+    def test_stored_metrics_are_used(self):
+        self.rev.text_metrics = Metrics({'words': 42})
+        compute = Mock(return_value=0)
+        self.assertEqual(self.rev.text_feature('words', compute), 42)
+        compute.assert_not_called()
+
+    def test_computed_metrics_are_saved(self):
+        sql = Mock()
+        cur = sql.cursor.return_value
+        cur.fetchmany.side_effect = [[(11, json.dumps({'length': 5}))], []]
+        store = MetricsStore(sql)
+        store.attach(self.user)
+
+        self.assertEqual(self.rev.parenttext_feature('length', len), 5)
+        self.assertEqual(self.rev.text_feature('length', len), 11)
+
+        store.save()
+        rows = cur.executemany.call_args[0][1]
+        self.assertEqual(rows, [(12, 'no.wikipedia.org', ANALYZER_VERSION, '{"length": 11}')])
+
+
+if __name__ == '__main__':
+    unittest.main()
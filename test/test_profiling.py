@@ -0,0 +1,31 @@
+# encoding=utf-8
+import io
+import sys
+import unittest
+from unittest import TestCase
+
+from ukbot import profiling
+
+
+class TestImportTimes(TestCase):
+
+    def test_records_new_imports(self):
+        sys.modules.pop('colorsys', None)
+        profiling.install()
+        try:
+            import colorsys  # noqa: F401
+            import os  # noqa: F401  (already imported, not recorded)
+        finally:
+            profiling.uninstall()
+
+        names = [record[0] for record in profiling._records]
+        self.assertIn('colorsys', names)
+        self.assertNotIn('os', names)
+
+        out = io.StringIO()
+        profiling.report_imports(file=out)
+        self.assertIn('| colorsys', out.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
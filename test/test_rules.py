@@ -9,6 +9,8 @@ import pytz
 
 from ukbot.rules import RefRule, TemplateRemovalRule, ByteRule, WordRule, NewPageRule, WikidataRule, SectionRule, ExternalLinkRule
 from ukbot.contributions import UserContribution
+from ukbot.metrics import Metrics
+from ukbot.rules.image import ImageRule
 import unittest
 
 from ukbot.revision import Revision
@@ -368,5 +370,30 @@ class TestSectionRule(RuleTestCase):
         assert contribs[0].points == 10
 
 
+class TestImageRule(RuleTestCase):
+
+    translations = {
+        'own': 'own',
+        'ownwork': 'ownwork',
+        'maxinitialcount': 'maxinitialcount',
+    }
+
+    def test_it_finds_added_images(self):
+        self.site.key = 'test.wikipedia.org'
+        self.site.file_prefixes = ['Fil', 'File']
+        self.rev.text = 'Lorem [[Fil:A.jpg]] ipsum [[File:B.png|thumb]]'
+        self.rev.parenttext = 'Lorem [[Fil:A.jpg]] ipsum'
+        self.rev.text_metrics = Metrics()
+
+        rule = ImageRule(self.sites, {2: 10}, self.translations)
+        before, added = rule.get_image_changes(self.rev)
+
+        assert before == ['A.jpg']
+        assert added == {'B.png'}
+        # The stored metric is keyed by a digest of the pattern, not the pattern itself
+        key, = self.rev.text_metrics.keys()
+        assert key.startswith('images:') and len(key) < 30
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -44,6 +44,31 @@ class TestInitSites(unittest.TestCase):
         self.assertNotIn('*.wikipedia.org', manager.sites)
         mock_db_conn.assert_called_once()
 
+    @patch('ukbot.sites.db_conn')
+    @patch('ukbot.sites.fetch_interwikimap')
+    @patch('ukbot.sites.Site')
+    def test_sites_are_initialized_on_first_use(self, mock_site, mock_fetch, mock_db_conn):
+        mock_site.side_effect = DummySite
+        mock_fetch.return_value = {
+            'en': 'en.wikipedia.org',
+            'de': 'de.wikipedia.org',
+            'fr': 'fr.wikipedia.org',
+        }
+        config = {
+            'homesite': 'en.wikipedia.org',
+            'othersites': ['*.wikipedia.org']
+        }
+        manager, sql = init_sites(config)
+        self.assertEqual(mock_site.call_count, 1)
+        self.assertEqual(sorted(manager.keys()), ['de.wikipedia.org', 'en.wikipedia.org', 'fr.wikipedia.org'])
+        self.assertEqual(mock_site.call_count, 1)
+
+        site = manager.from_prefix('de')
+        self.assertEqual(site.key, 'de.wikipedia.org')
+        self.assertEqual(site.prefixes, ['de'])
+        self.assertIs(manager.sites['de.wikipedia.org'], site)
+        self.assertEqual(mock_site.call_count, 2)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,40 @@
+# encoding=utf-8
+import sys
+import unittest
+from unittest import TestCase
+
+from ukbot.textregistry import TextRegistry
+
+
+class TestTextRegistry(TestCase):
+
+    def test_least_recently_used_texts_are_evicted(self):
+        text_size = sys.getsizeof('a' * 1000)
+        registry = TextRegistry(max_bytes=2 * text_size)
+        registry.add('no.wikipedia.org', 1, 'a' * 1000, 1000)
+        registry.add('no.wikipedia.org', 2, 'b' * 1000, 1000)
+        registry.get('no.wikipedia.org', 1)
+        registry.add('no.wikipedia.org', 3, 'c' * 1000, 1000)
+
+        self.assertEqual(set(registry.get_many('no.wikipedia.org', [1, 2, 3]).keys()), {1, 3})
+        self.assertEqual(registry.size, 2 * text_size)
+
+    def test_texts_are_keyed_by_site(self):
+        registry = TextRegistry()
+        registry.add('no.wikipedia.org', 1, 'Tekst', 5)
+
+        self.assertEqual(registry.get('no.wikipedia.org', 1), ('Tekst', 5))
+        self.assertIsNone(registry.get('nn.wikipedia.org', 1))
+
+    def test_texts_are_written_once(self):
+        registry = TextRegistry()
+        rows = [(1, 'no.wikipedia.org', 'A'), (0, 'no.wikipedia.org', ''), (2, 'no.wikipedia.org', None)]
+
+        self.assertEqual(list(registry.unsaved(rows)), rows)
+        self.assertEqual(list(registry.unsaved(rows + [(1, 'nn.wikipedia.org', 'A')])),
+                         [(0, 'no.wikipedia.org', ''), (2, 'no.wikipedia.org', None), (1, 'nn.wikipedia.org', 'A')])
+        self.assertEqual(registry.skipped_writes, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
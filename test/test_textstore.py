@@ -0,0 +1,114 @@
+# encoding=utf-8
+import os
+import re
+import unittest
+from unittest import TestCase
+from unittest.mock import Mock
+
+from ukbot.textstore import EMPTY_SHA1, SCHEMA, TextStore, compress, decompress, migrate, text_hash
+
+
+class TestTextStore(TestCase):
+
+    def test_roundtrip(self):
+        text = 'Æøå ' * 1000
+        data = compress(text)
+        self.assertLess(len(data), len(text))
+        self.assertEqual(decompress(data), text)
+
+    def test_save_stores_each_text_once(self):
+        sql = Mock()
+        cur = sql.cursor.return_value
+        store = TextStore(sql)
+
+        n = store.save([
+            (2, 'no.wikipedia.org', 'Text A'),
+            (1, 'no.wikipedia.org', 'Text B'),
+            (3, 'no.wikipedia.org', 'Text C'),
+            (1, 'no.wikipedia.org', 'Text B'),  # parent text repeated for another child
+            (4, 'no.wikipedia.org', 'Text A'),  # revert
+            (0, 'no.wikipedia.org', ''),  # parent of a new page
+        ])
+        self.assertEqual(n, 4)
+
+        blobs = cur.executemany.call_args_list[0][0][1]
+        refs = cur.executemany.call_args_list[1][0][1]
+        self.assertEqual([blob[0] for blob in blobs], [text_hash('Text A'), text_hash('Text B'), text_hash('Text C')])
+        self.assertEqual(refs[0], (2, 'no.wikipedia.org', text_hash('Text A')))
+        self.assertEqual(refs[3], (4, 'no.wikipedia.org', text_hash('Text A')))
+        sql.commit.assert_called_once()
+
+    def test_save_in_chunks(self):
+        sql = Mock()
+        cur = sql.cursor.return_value
+        store = TextStore(sql)
+
+        rows = ((revid, 'no.wikipedia.org', 'Text %d' % revid) for revid in range(1, 6))
+        self.assertEqual(store.save(rows, chunk_size=2), 5)
+
+        refs = [call[0][1] for call in cur.executemany.call_args_list if 'revtexts' in call[0][0]]
+        self.assertEqual([len(chunk) for chunk in refs], [2, 2, 1])
+        sql.commit.assert_called_once()
+
+    def test_existing(self):
+        sql = Mock()
+        cur = sql.cursor.return_value
+        cur.fetchmany.side_effect = [[(1, 'no.wikipedia.org')], []]
+
+        found = TextStore(sql).existing([(1, 'no.wikipedia.org'), (2, 'no.wikipedia.org')])
+
+        self.assertEqual(found, {(1, 'no.wikipedia.org')})
+        self.assertEqual(cur.execute.call_args[0][1], [1, 'no.wikipedia.org', 2, 'no.wikipedia.org', EMPTY_SHA1])
+
+    def test_load_skips_empty_texts(self):
+        sql = Mock()
+        cur = sql.cursor.return_value
+        cur.fetchmany.side_effect = [[(1, compress('Text'))], []]
+
+        texts = TextStore(sql).load('no.wikipedia.org', [1, 2])
+
+        self.assertEqual(texts, {1: 'Text'})
+        query, params = cur.execute.call_args[0]
+        self.assertIn('rt.sha1 != %s', query)
+        self.assertEqual(params, ['no.wikipedia.org', 1, 2, EMPTY_SHA1])
+
+    def test_save_nothing(self):
+        sql = Mock()
+        self.assertEqual(TextStore(sql).save([(0, 'no.wikipedia.org', '')]), 0)
+        sql.cursor.assert_not_called()
+
+    def test_save_skips_empty_texts(self):
+        sql = Mock()
+        # The text of a deleted revision, or a fetch that failed, is left to be backfilled later
+        self.assertEqual(TextStore(sql).save([(12, 'no.wikipedia.org', ''), (13, 'no.wikipedia.org', None)]), 0)
+        sql.cursor.assert_not_called()
+
+
+class TestMigrate(TestCase):
+
+    def test_creates_missing_tables(self):
+        sql = Mock()
+        cur = sql.cursor.return_value
+        cur.fetchone.return_value = (0,)  # No fulltexts table
+
+        migrate(sql)
+
+        queries = [c[0][0] for c in cur.execute.call_args_list]
+        self.assertEqual(queries[:len(SCHEMA)], SCHEMA)
+        self.assertTrue(all('CREATE TABLE IF NOT EXISTS' in q for q in SCHEMA))
+        self.assertFalse(any('FROM fulltexts' in q for q in queries))
+        cur.executemany.assert_not_called()
+
+    def test_schema_matches_init_sql(self):
+        with open(os.path.join(os.path.dirname(__file__), '..', 'db', 'init.sql')) as f:
+            init_sql = f.read()
+        for statement in SCHEMA:
+            table = re.search(r'CREATE TABLE IF NOT EXISTS `(\w+)`', statement).group(1)
+            columns = re.findall(r'^\s*(`\w+` .*?),?$', statement, re.M)
+            self.assertIn('CREATE TABLE `%s`' % table, init_sql)
+            for column in columns:
+                self.assertIn(column, init_sql)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+# encoding=utf-8
+import unittest
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+from ukbot import transport
+
+
+def response(status=200, headers=None):
+    resp = Mock()
+    resp.status_code = status
+    resp.headers = headers or {}
+    return resp
+
+
+class TestSession(TestCase):
+
+    def setUp(self):
+        transport.stats = transport.TransportStats()
+        self.session = transport.Session()
+
+    @patch('ukbot.transport.time.sleep')
+    @patch('requests.Session.request')
+    def test_maxlag_is_left_to_mwclient(self, request, sleep):
+        request.return_value = response(headers={'X-Database-Lag': '7', 'Retry-After': '3'})
+
+        resp = self.session.get('https://no.wikipedia.org/w/api.php')
+
+        self.assertEqual(resp.headers['X-Database-Lag'], '7')
+        self.assertEqual(request.call_count, 1)
+        sleep.assert_not_called()
+        host_stats = transport.stats.hosts['no.wikipedia.org']
+        self.assertEqual(host_stats.requests, 1)
+        self.assertEqual(host_stats.lag_responses, 1)
+
+    def test_latency_histogram(self):
+        for elapsed in [0.05, 0.05, 0.3, 4., 20.]:
+            transport.stats.record('query.wikidata.org', elapsed, 200)
+        transport.stats.record('query.wikidata.org', 0.01)
+
+        host_stats = transport.stats.hosts['query.wikidata.org']
+        self.assertEqual(host_stats.histogram, [3, 0, 1, 0, 0, 1, 0, 1])
+        self.assertEqual(host_stats.errors, 1)
+        self.assertEqual(host_stats.percentile(50), 0.1)
+        self.assertEqual(host_stats.percentile(95), float('inf'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,386 @@
+# encoding=utf-8
+import re
+import time
+import unittest
+from datetime import datetime
+from unittest import TestCase
+from unittest.mock import Mock
+
+import numpy as np
+import pytz
+
+from ukbot.batching import BatchBudgets
+from ukbot.contributions import UserContribution
+from ukbot.filters import Filter
+from ukbot.rules.rule import Rule
+from ukbot.site import Site
+from ukbot.textregistry import TextRegistry
+from ukbot.textstore import compress, text_hash
+from ukbot.user import User, fetch_revision_batch, fetch_revisions_with_parents
+from ukbot.util import unix_time, localtime_as_utc
+
+
+class TestIncrementalSync(TestCase):
+
+    def setUp(self):
+        self.contest = Mock()
+        self.contest.config = {'ignoreTags': [], 'full_sync_interval': 24, 'wikidata_languages': []}
+        self.contest.texts = TextRegistry()
+        self.contest.batch_budgets = BatchBudgets()
+        self.contest.name = 'Contest'
+        self.contest.sites.homesite.key = 'no.wikipedia.org'
+
+        self.site = Mock(Site)
+        self.site.key = 'no.wikipedia.org'
+        self.site.host = 'no.wikipedia.org'
+        self.site.rights = []
+        self.site.redirect_regexp = re.compile('(?:redirect)', re.I)
+        self.site.usercontributions = Mock(return_value=iter([]))
+
+        self.start = pytz.utc.localize(datetime(2024, 1, 1))
+        self.end = pytz.utc.localize(datetime(2024, 1, 31, 23, 59, 59))
+        self.user = User('Testuser', self.contest)
+
+        # A revision stored in the DB by an earlier run
+        article = self.user.add_article_if_necessary(self.site, 'Old article', 0)
+        rev = article.add_revision(1000, timestamp=unix_time(pytz.utc.localize(datetime(2024, 1, 2))), username=self.user.name)
+        rev.saved = True
+
+    def set_cursor(self, full_sync_at):
+        self.user.sync_cursors[self.site.key] = {
+            'window_start': datetime(2024, 1, 1),
+            'timestamp': datetime(2024, 1, 5, 12, 0, 0),
+            'revid': 1234,
+            'full_sync_at': full_sync_at,
+            'dirty': False,
+        }
+
+    def test_full_sync_without_cursor(self):
+        self.user.add_contribs_from_wiki(self.site, self.start, self.end)
+
+        args = self.site.usercontributions.call_args[0]
+        self.assertEqual(args[1], '2024-01-01T00:00:00Z')
+
+        # The stored revision was not listed, so it has been deleted
+        self.assertNotIn(1000, self.user.revisions)
+
+        cursor = self.user.sync_cursors[self.site.key]
+        self.assertTrue(cursor['dirty'])
+        self.assertEqual(cursor['timestamp'], datetime(2024, 1, 1))
+
+    def test_incremental_sync(self):
+        self.set_cursor(datetime.utcnow())
+        self.site.usercontributions = Mock(return_value=iter([
+            {'revid': 1240, 'title': 'Old article', 'ns': 0, 'tags': [],
+             'timestamp': time.strptime('2024-01-06T10:00:00Z', '%Y-%m-%dT%H:%M:%SZ')},
+        ]))
+        self.site.api = Mock(return_value={'query': {'pages': {'1': {
+            'title': 'Old article',
+            'revisions': [{'revid': 1240, 'parentid': 1000, 'size': 100, 'parsedcomment': ''}],
+        }}}})
+
+        self.user.add_contribs_from_wiki(self.site, self.start, self.end)
+
+        args = self.site.usercontributions.call_args[0]
+        self.assertEqual(args[1], '2024-01-05T12:00:00Z')
+
+        # Revisions older than the cursor are left alone
+        self.assertIn(1000, self.user.revisions)
+        self.assertIn(1240, self.user.revisions)
+
+        cursor = self.user.sync_cursors[self.site.key]
+        self.assertEqual(cursor['timestamp'], datetime(2024, 1, 6, 10, 0, 0))
+        self.assertEqual(cursor['revid'], 1240)
+
+    def test_parent_text_fetched_for_another_user(self):
+        self.contest.texts.add(self.site.key, 1000, 'Text by another user', 20)
+        self.site.usercontributions = Mock(return_value=iter([
+            {'revid': 1240, 'title': 'Old article', 'ns': 0, 'tags': [],
+             'timestamp': time.strptime('2024-01-06T10:00:00Z', '%Y-%m-%dT%H:%M:%SZ')},
+        ]))
+        self.site.api = Mock(return_value={'query': {'pages': {'1': {
+            'title': 'Old article',
+            'revisions': [{'revid': 1240, 'parentid': 1000, 'size': 100, 'parsedcomment': '',
+                           'slots': {'main': {'*': 'Text by this user'}}}],
+        }}}})
+
+        self.user.add_contribs_from_wiki(self.site, self.start, self.end, fulltext=True)
+
+        # Only the new revision is fetched
+        self.assertEqual(self.site.api.call_count, 1)
+        rev = self.user.revisions[1240]
+        self.assertEqual(rev.parenttext, 'Text by another user')
+        self.assertEqual(rev.parentsize, 20)
+        self.assertEqual(self.contest.texts.get(self.site.key, 1240), ('Text by this user', 100))
+
+    def test_full_sync_when_due(self):
+        self.set_cursor(datetime(2024, 1, 1))
+        self.user.add_contribs_from_wiki(self.site, self.start, self.end)
+
+        args = self.site.usercontributions.call_args[0]
+        self.assertEqual(args[1], '2024-01-01T00:00:00Z')
+        self.assertNotEqual(self.user.sync_cursors[self.site.key]['full_sync_at'], datetime(2024, 1, 1))
+
+    def test_full_sync_when_contest_start_changed(self):
+        self.set_cursor(datetime.utcnow())
+        self.user.add_contribs_from_wiki(self.site, pytz.utc.localize(datetime(2023, 12, 25)), self.end)
+
+        args = self.site.usercontributions.call_args[0]
+        self.assertEqual(args[1], '2023-12-25T00:00:00Z')
+
+
+class TestBackfillTexts(TestCase):
+
+    def setUp(self):
+        contest = Mock()
+        contest.config = {'ignoreTags': [], 'wikidata_languages': []}
+        contest.texts = TextRegistry()
+        contest.batch_budgets = BatchBudgets()
+        self.contest = contest
+        self.site = Mock(Site)
+        self.site.key = 'no.wikipedia.org'
+        self.site.rights = ['bot']
+        self.site.api_limit = 2
+        self.user = User('Testuser', contest)
+        self.article = self.user.add_article_if_necessary(self.site, 'Article', 0)
+        self.revs = [
+            self.article.add_revision(revid, timestamp=0, parentid=revid - 1, username=self.user.name)
+            for revid in [11, 12, 13]
+        ]
+
+    def api_response(self, revids):
+        return {'query': {'pages': {'1': {
+            'title': 'Article',
+            'revisions': [{'revid': int(revid), 'size': 7, 'slots': {'main': {'*': 'text %s' % revid}}}
+                          for revid in revids.split('|')],
+        }}}}
+
+    def test_backfill_in_batches(self):
+        calls = []
+
+        def api(*args, **kwargs):
+            calls.append(kwargs['revids'])
+            if len(calls) == 1:
+                # Result too large, should be retried with a smaller batch
+                return {'warnings': {'result': {'*': 'too large'}}, 'query': {'pages': {}}}
+            return self.api_response(kwargs['revids'])
+
+        self.site.api = Mock(side_effect=api)
+        sql = Mock()
+
+        self.user.backfill_texts(sql, {self.site.key: self.site},
+                                 {self.site.key: self.revs}, {self.site.key: [self.revs[0]]})
+
+        # The batch that was too large is split, but the batch size is not reduced for later batches
+        self.assertEqual(calls, ['10|11', '10', '11', '12|13'])
+        self.assertEqual(self.revs[0].text, 'text 11')
+        self.assertEqual(self.revs[0].parenttext, 'text 10')
+        self.assertEqual(self.revs[2].text, 'text 13')
+
+        # All texts are written in one go: one blob insert and one revtexts insert
+        cur = sql.cursor.return_value
+        self.assertEqual(cur.executemany.call_count, 2)
+        self.assertEqual(len(cur.executemany.call_args[0][1]), 4)
+
+
+class TestFetchRevisionsWithParents(TestCase):
+
+    def test_parents_are_fetched_in_full_batches(self):
+        calls = []
+
+        def api(*args, **kwargs):
+            revids = [int(r) for r in kwargs['revids'].split('|')]
+            calls.append((kwargs['rvprop'], revids))
+            if kwargs['rvprop'] == 'ids' and len(revids) == 3:
+                # Result too large, should be split in two
+                return {'warnings': {'result': {'*': 'too large'}}, 'query': {'pages': {}}}
+            return {'query': {'pages': {'1': {
+                'title': 'Article',
+                'revisions': [{'revid': revid} for revid in revids],
+            }}}}
+
+        site = Mock(Site)
+        site.api = Mock(side_effect=api)
+        parents = []
+
+        def handle_revisions(page):
+            return [apirev['revid'] + 100 for apirev in page['revisions']]
+
+        def handle_parents(page):
+            parents.extend(apirev['revid'] for apirev in page['revisions'])
+
+        fetch_revisions_with_parents(site, [1, 2, 3, 4, 5], 'ids', 'ids|size', 3, 2,
+                                     handle_revisions, handle_parents)
+
+        self.assertEqual(sorted(parents), [101, 102, 103, 104, 105])
+        parent_batches = [revids for rvprop, revids in calls if rvprop == 'ids|size']
+        self.assertEqual(sorted(len(batch) for batch in parent_batches), [2, 3])
+        self.assertIn(('ids', [1]), calls)
+        self.assertIn(('ids', [2, 3]), calls)
+
+    def test_only_the_truncated_part_is_fetched_again(self):
+        calls = []
+
+        def api(*args, **kwargs):
+            revids = [int(r) for r in kwargs['revids'].split('|')]
+            calls.append(revids)
+            res = {'query': {'pages': {'1': {
+                'title': 'Article',
+                'revisions': [{'revid': revid} for revid in revids[:2]],
+            }}}}
+            if len(revids) > 2:
+                res['warnings'] = {'result': {'*': 'truncated'}}
+            return res
+
+        site = Mock(Site)
+        site.key = 'no.wikipedia.org'
+        site.api = Mock(side_effect=api)
+        sizes = {revid: 1000000 for revid in range(1, 6)}
+        budgets = BatchBudgets()
+
+        pages = fetch_revision_batch(site, [1, 2, 3, 4, 5], 'ids|content', sizes, budgets)
+
+        self.assertEqual(sorted(apirev['revid'] for page in pages for apirev in page['revisions']), [1, 2, 3, 4, 5])
+        self.assertEqual(calls, [[1, 2, 3, 4, 5], [3], [4], [5]])
+        self.assertEqual(budgets.get('no.wikipedia.org'), 1800000)
+
+
+class TestSaveContribs(TestCase):
+
+    def setUp(self):
+        self.contest = Mock()
+        self.contest.config = {'ignoreTags': [], 'wikidata_languages': []}
+        self.contest.texts = TextRegistry()
+        self.site = Mock(Site)
+        self.site.key = 'no.wikipedia.org'
+        self.user = User('Testuser', self.contest)
+        article = self.user.add_article_if_necessary(self.site, 'Article', 0)
+        self.rev = article.add_revision(12, timestamp=0, parentid=11, username=self.user.name,
+                                        text='New text', parenttext='Old text')
+        self.rev.dirty = True
+
+    def test_stored_parent_texts_are_not_written_again(self):
+        sql = Mock()
+        cur = sql.cursor.return_value
+        cur.fetchmany.side_effect = [[(11, 'no.wikipedia.org')], []]
+
+        self.user.save_contribs_to_db(sql)
+
+        queries = [call[0] for call in cur.executemany.call_args_list]
+        contribs = [rows for query, rows in queries if 'into contribs' in query]
+        refs = [rows for query, rows in queries if 'into revtexts' in query]
+        self.assertEqual([row[0] for row in contribs[0]], [12])
+        self.assertEqual(refs, [[(12, 'no.wikipedia.org', text_hash('New text'))]])
+        self.assertTrue(self.rev.saved)
+        self.assertFalse(self.rev.dirty)
+
+
+class KeepFilter(Filter):
+
+    def __init__(self, keep):
+        Filter.__init__(self, None)
+        self.keep = keep
+
+    def test_page(self, page):
+        return page.name in self.keep
+
+
+class TestLazyTexts(TestCase):
+
+    def setUp(self):
+        self.contest = Mock()
+        self.contest.config = {'ignoreTags': [], 'wikidata_languages': []}
+        self.cur = self.contest.sql.cursor.return_value
+        self.site = Mock(Site)
+        self.site.key = 'no.wikipedia.org'
+        self.user = User('Testuser', self.contest)
+        self.revs = {}
+        for revid, parentid, title in [(11, 10, 'A'), (21, 0, 'B')]:
+            article = self.user.add_article_if_necessary(self.site, title, 0)
+            rev = article.add_revision(revid, timestamp=0, parentid=parentid, username=self.user.name)
+            rev.defer_texts()
+            self.revs[revid] = rev
+
+    def test_texts_loaded_after_filtering(self):
+        self.cur.fetchmany.side_effect = [[(11, compress('Text')), (10, compress('Parent text'))], []]
+
+        self.user.filter([KeepFilter(['A'])])
+
+        # Only the texts of the remaining article are read
+        self.assertEqual(self.cur.execute.call_count, 1)
+        self.assertEqual(sorted(self.cur.execute.call_args[0][1][1:-1]), [10, 11])
+        self.assertFalse(self.revs[21].text_loaded)
+
+        self.assertEqual(self.revs[11].text, 'Text')
+        self.assertEqual(self.revs[11].parenttext, 'Parent text')
+        self.assertEqual(self.cur.execute.call_count, 1)
+
+    def test_text_loaded_on_access(self):
+        self.cur.fetchmany.side_effect = [[(21, compress('Text B'))], []]
+
+        self.assertEqual(self.revs[21].text, 'Text B')
+        self.assertEqual(self.revs[21].parenttext, '')
+        self.assertFalse(self.revs[11].text_loaded)
+
+
+class PointsRule(Rule):
+
+    site = None
+    maxpoints = None
+
+    def __init__(self, points):
+        self.points = points
+
+    def test(self, rev):
+        if rev.revid in self.points:
+            yield UserContribution(rev=rev, points=self.points[rev.revid], rule=self, description='test')
+
+
+class TestWikisWithEdits(TestCase):
+
+    def test_accounts_from_contest(self):
+        contest = Mock()
+        contest.config = {'ignoreTags': [], 'wikidata_languages': []}
+        contest.globaluserinfo.get.return_value = [
+            {'wiki': 'nowiki', 'url': 'https://no.wikipedia.org'},
+            {'wiki': 'wikidatawiki', 'url': 'https://www.wikidata.org'},
+        ]
+        user = User('Testuser', contest)
+
+        self.assertEqual(user.wikis_with_edits(), {'nowiki', 'wikidatawiki'})
+        self.assertEqual(user.hosts_with_edits(), {'no.wikipedia.org', 'www.wikidata.org'})
+        contest.globaluserinfo.get.assert_called_with('Testuser')
+
+
+class TestAnalyze(TestCase):
+
+    def setUp(self):
+        contest = Mock()
+        contest.config = {'ignoreTags': [], 'wikidata_languages': []}
+        self.site = Mock(Site)
+        self.site.key = 'no.wikipedia.org'
+        self.user = User('Testuser', contest)
+        for revid, title, ts in [(1, 'A', 300), (2, 'B', 100), (3, 'A', 400), (4, 'B', 200)]:
+            article = self.user.add_article_if_necessary(self.site, title, 0)
+            article.add_revision(revid, timestamp=ts, parentid=0, username=self.user.name, text='', parenttext='')
+
+    def test_cumulative_points(self):
+        self.user.analyze([PointsRule({1: 10., 2: 5., 3: 1., 4: 0.})])
+
+        np.testing.assert_array_equal(self.user.plotdata['x'], localtime_as_utc([100, 300, 400]))
+        np.testing.assert_array_equal(self.user.plotdata['y'], [5., 15., 16.])
+
+    def test_suspension(self):
+        self.user.suspended_since = pytz.utc.localize(datetime.utcfromtimestamp(localtime_as_utc([350])[0]))
+        self.user.analyze([PointsRule({1: 10., 2: 5., 3: 1.})])
+
+        np.testing.assert_array_equal(self.user.plotdata['y'], [5., 15.])
+
+    def test_localtime_as_utc(self):
+        timestamps = [0, 1700000000, 1720000000]
+        expected = [unix_time(pytz.utc.localize(datetime.fromtimestamp(ts))) for ts in timestamps]
+        np.testing.assert_array_equal(localtime_as_utc(timestamps), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+# encoding=utf-8
+import os
+import tempfile
+import unittest
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+from ukbot import util
+
+
+class TestControlChars(TestCase):
+
+    def test_ranges_are_cached(self):
+        with tempfile.TemporaryDirectory() as tmp, patch.dict(os.environ, {'UKBOT_CACHE_DIR': tmp}):
+            ranges = util.control_char_ranges()
+            self.assertIn([0, 31], ranges)
+            self.assertEqual(len(os.listdir(tmp)), 1)
+
+            with patch.object(util, 'find_control_char_ranges') as find:
+                self.assertEqual(util.control_char_ranges(), ranges)
+                find.assert_not_called()
+
+    def test_ranges_without_cache_dir(self):
+        with tempfile.NamedTemporaryFile() as fp, patch.dict(os.environ, {'UKBOT_CACHE_DIR': os.path.join(fp.name, 'ukbot')}):
+            self.assertIn([0, 31], util.control_char_ranges())
+
+    def test_cleanup_input(self):
+        regexp = util.control_char_regexp([[0, 31], [127, 159], [0x200b, 0x200f]])
+        with patch.object(util, 'control_char_re', regexp):
+            self.assertEqual(util.cleanup_input(' Test​\x07 <!-- comment -->navn\n'), 'Test navn')
+
+
+class TestCachedJson(TestCase):
+
+    def test_load_cached_json(self):
+        with tempfile.TemporaryDirectory() as tmp, patch.dict(os.environ, {'UKBOT_CACHE_DIR': tmp}):
+            fetch = Mock(return_value={'en': 'en.wikipedia.org'})
+            self.assertEqual(util.load_cached_json('test.json', 3600, fetch), {'en': 'en.wikipedia.org'})
+            self.assertEqual(util.load_cached_json('test.json', 3600, fetch), {'en': 'en.wikipedia.org'})
+            self.assertEqual(fetch.call_count, 1)
+
+            # Expired
+            fetch.return_value = {'de': 'de.wikipedia.org'}
+            self.assertEqual(util.load_cached_json('test.json', 0, fetch), {'de': 'de.wikipedia.org'})
+
+    def test_load_without_cache_dir(self):
+        # The cache dir can't be created inside a file
+        with tempfile.NamedTemporaryFile() as fp, patch.dict(os.environ, {'UKBOT_CACHE_DIR': os.path.join(fp.name, 'ukbot')}):
+            fetch = Mock(return_value={'en': 'en.wikipedia.org'})
+            self.assertEqual(util.load_cached_json('test.json', 3600, fetch), {'en': 'en.wikipedia.org'})
+            self.assertEqual(util.load_cached_json('test.json', 3600, fetch), {'en': 'en.wikipedia.org'})
+            self.assertEqual(fetch.call_count, 2)
+            self.assertEqual(fetch.call_count, 2)
+
+            # The expired copy is used if the fetch fails
+            fetch.side_effect = IOError('Network is unreachable')
+            self.assertEqual(util.load_cached_json('test.json', 0, fetch), {'de': 'de.wikipedia.org'})
+
+    def test_load_without_cache_dir(self):
+        # The cache dir can't be created inside a file
+        with tempfile.NamedTemporaryFile() as fp, patch.dict(os.environ, {'UKBOT_CACHE_DIR': os.path.join(fp.name, 'ukbot')}):
+            fetch = Mock(return_value={'en': 'en.wikipedia.org'})
+            self.assertEqual(util.load_cached_json('test.json', 3600, fetch), {'en': 'en.wikipedia.org'})
+            self.assertEqual(util.load_cached_json('test.json', 3600, fetch), {'en': 'en.wikipedia.org'})
+            self.assertEqual(fetch.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
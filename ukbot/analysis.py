@@ -0,0 +1,86 @@
+# encoding=utf-8
+# vim: fenc=utf-8 et sw=4 ts=4 sts=4 ai
+"""
+Memoization of features derived from revision texts (reference counts, image lists,
+word counts, template lists, ...).
+
+The parent text of a revision is usually the text of the previous revision, so
+without caching, each text would be parsed twice by every rule. Features are keyed
+by a digest of the text, the feature name and its parameters, and the cache is
+bounded by the estimated size of the stored values.
+"""
+import hashlib
+import logging
+import sys
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def text_digest(text):
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+
+def estimate_size(value):
+    """ Rough estimate of the memory used by a feature value """
+    size = sys.getsizeof(value)
+    if isinstance(value, (tuple, list, set, frozenset)):
+        size += sum(estimate_size(item) for item in value)
+    elif isinstance(value, dict):
+        size += sum(estimate_size(k) + estimate_size(v) for k, v in value.items())
+    return size
+
+
+class AnalysisCache(object):
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (value, size)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def resize(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.evict()
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def evict(self):
+        while self.size > self.max_bytes and len(self.entries) > 0:
+            _, (_, size) = self.entries.popitem(last=False)
+            self.size -= size
+
+    def get(self, digest, feature, params, compute):
+        """
+        Return the value of a feature for the text with the given digest, calling
+        compute() to calculate it if it's not cached.
+        """
+        key = (digest, feature, params)
+        try:
+            value, size = self.entries[key]
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+        except KeyError:
+            pass
+
+        self.misses += 1
+        value = compute()
+        size = estimate_size(value) + 200  # key and bookkeeping overhead
+        self.entries[key] = (value, size)
+        self.size += size
+        self.evict()
+        return value
+
+    def log_stats(self):
+        total = self.hits + self.misses
+        if total > 0:
+            logger.info('Text analysis cache: %d hits, %d misses (%.0f %% hit rate), %d entries, %.1f MB',
+                        self.hits, self.misses, 100. * self.hits / total, len(self.entries), self.size / 1e6)
+
+
+# Shared by all rules, see Revision.text_feature
+analysis_cache = AnalysisCache()
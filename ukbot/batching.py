@@ -0,0 +1,89 @@
+# encoding=utf-8
+# vim: fenc=utf-8 et sw=4 ts=4 sts=4 ai
+"""
+Size-aware batching of revision content requests.
+
+The API refuses to return more than $wgAPIMaxResultSize bytes per request, so
+batches of revisions with content are packed by the known size of each revision,
+up to a byte budget per site. The budget is lowered when a result is truncated,
+raised again after full batches succeed, and stored in the persistent cache so
+the next run starts from the last good value.
+"""
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+MAX_RESULT_SIZE = 8 * 1024 * 1024  # Default $wgAPIMaxResultSize
+MAX_BUDGET = int(MAX_RESULT_SIZE * 0.9)  # Leave room for the rest of the result
+DEFAULT_BUDGET = MAX_RESULT_SIZE // 2
+MIN_BUDGET = 64 * 1024
+
+
+def batch_length(revids, sizes, max_count, max_bytes):
+    """
+    Returns the number of revisions from the start of `revids` that fit in a batch of at
+    most `max_count` revisions and `max_bytes` bytes of content, at least one. If sizes
+    or max_bytes is None, the batch is only limited by the number of revisions.
+    """
+    n = min(len(revids), max_count)
+    if sizes is None or max_bytes is None:
+        return n
+    total = 0
+    for i, revid in enumerate(revids[:n]):
+        total += sizes.get(revid, 0)
+        if total > max_bytes and i > 0:
+            return i
+    return n
+
+
+def batch_bytes(revids, sizes):
+    if sizes is None:
+        return 0
+    return sum(sizes.get(revid, 0) for revid in revids)
+
+
+class BatchBudgets(object):
+
+    namespace = 'revision_batch_bytes'
+
+    def __init__(self):
+        self.budgets = {}  # site key -> bytes of content per request
+        self.changed = set()
+        self.lock = threading.Lock()
+
+    def get(self, site_key):
+        with self.lock:
+            return self.budgets.get(site_key, DEFAULT_BUDGET)
+
+    def overflow(self, site_key, returned_bytes):
+        """ A result was truncated after `returned_bytes` bytes of content """
+        with self.lock:
+            budget = self.budgets.get(site_key, DEFAULT_BUDGET)
+            new_budget = max(MIN_BUDGET, int(min(budget, returned_bytes) * 0.9))
+            if new_budget < budget:
+                logger.info('Lowering the batch budget for %s from %.1f MB to %.1f MB',
+                            site_key, budget / 1e6, new_budget / 1e6)
+                self.budgets[site_key] = new_budget
+                self.changed.add(site_key)
+
+    def success(self, site_key, nbytes):
+        """ A batch with `nbytes` bytes of content was returned in full """
+        with self.lock:
+            budget = self.budgets.get(site_key, DEFAULT_BUDGET)
+            if nbytes > 0.8 * budget and budget < MAX_BUDGET:
+                self.budgets[site_key] = min(MAX_BUDGET, int(budget * 1.25))
+                self.changed.add(site_key)
+
+    def load(self, cache, site_keys):
+        """ Read the budgets stored by earlier runs """
+        stored = cache.get_many(self.namespace, list(site_keys))
+        with self.lock:
+            self.budgets.update(stored)
+
+    def save(self, cache):
+        """ Store the budgets that have changed during this run """
+        with self.lock:
+            changed = {site_key: self.budgets[site_key] for site_key in self.changed}
+            self.changed = set()
+        cache.set_many(self.namespace, changed)
@@ -0,0 +1,101 @@
+# encoding=utf-8
+# vim: fenc=utf-8 et sw=4 ts=4 sts=4 ai
+"""
+Persistent key-value cache for results of API lookups that rarely change
+(image uploaders, category memberships, ...), shared between runs.
+
+Values are stored as JSON in the `kvcache` table, keyed by a namespace and the
+SHA-1 of the key, and expire after a time to live that can be configured per
+namespace with the `cache_ttl` setting (in hours).
+"""
+import hashlib
+import json
+import logging
+import time
+
+from .db import result_iterator
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL = 24  # hours
+
+
+def key_hash(key):
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+class KeyValueCache(object):
+
+    def __init__(self, sql, ttls=None):
+        """
+            sql: mysql Connection object
+            ttls: dict of namespace -> time to live in hours
+        """
+        self.sql = sql
+        self.ttls = ttls or {}
+
+    def ttl(self, namespace, default=DEFAULT_TTL):
+        """ Returns the time to live for the namespace, in seconds """
+        return float(self.ttls.get(namespace, default)) * 3600
+
+    def get_many(self, namespace, keys):
+        """ Returns a dict of key -> value for the given keys that are cached and not expired """
+        hashes = {key_hash(key): key for key in keys}
+        if len(hashes) == 0:
+            return {}
+
+        now = int(time.time())
+        values = {}
+        cur = self.sql.cursor()
+        keyhashes = list(hashes.keys())
+        chunk_size = 1000
+        for n in range(0, len(keyhashes), chunk_size):
+            chunk = keyhashes[n:n + chunk_size]
+            cur.execute(
+                'SELECT hash, value FROM kvcache WHERE namespace=%s AND expires>%s AND hash IN (' + ','.join(['%s'] * len(chunk)) + ')',
+                [namespace, now] + chunk
+            )
+            for h, value in result_iterator(cur):
+                values[hashes[h]] = json.loads(value)
+        cur.close()
+        logger.debug('Cache %s: %d of %d keys found', namespace, len(values), len(hashes))
+        return values
+
+    def set_many(self, namespace, items, ttl=None):
+        """ Store a dict of key -> value. The values must be JSON serializable. """
+        if len(items) == 0:
+            return
+        if ttl is None:
+            ttl = self.ttl(namespace)
+        expires = int(time.time() + ttl)
+        data = [
+            (namespace, key_hash(key), json.dumps(value, ensure_ascii=False), expires)
+            for key, value in items.items()
+        ]
+        cur = self.sql.cursor()
+        chunk_size = 500
+        for n in range(0, len(data), chunk_size):
+            cur.executemany("""
+                replace into kvcache (namespace, hash, value, expires)
+                values (%s,%s,%s,%s)
+                """, data[n:n + chunk_size]
+            )
+        self.sql.commit()
+        cur.close()
+
+    def get(self, namespace, key, default=None):
+        return self.get_many(namespace, [key]).get(key, default)
+
+    def set(self, namespace, key, value, ttl=None):
+        self.set_many(namespace, {key: value}, ttl)
+
+    def purge(self):
+        """ Remove expired entries """
+        cur = self.sql.cursor()
+        cur.execute('DELETE FROM kvcache WHERE expires<=%s', [int(time.time())])
+        ndel = cur.rowcount
+        self.sql.commit()
+        cur.close()
+        if ndel > 0:
+            logger.info('Removed %d expired cache entries', ndel)
+        return ndel
@@ -0,0 +1,203 @@
+# encoding=utf-8
+# vim: fenc=utf-8 et sw=4 ts=4 sts=4 ai
+"""
+Removal of the stored contributions, texts and metrics of a closed contest.
+
+The contributions in the contest period are deleted in chunks of a limited number
+of rows, with a pause between the chunks, so other bots get a chance at the MyISAM
+table locks. Contributions that are also inside the period of another contest
+that is still open are kept, and so are the texts and metrics of revisions that are
+referenced by contributions that are kept, such as the parent text of the first
+edit after the contest period. Text blobs are only removed when no revision
+refers to them any more.
+
+In a dry run nothing is deleted, and the report tells what would be reclaimed.
+"""
+import logging
+import time
+from collections import Counter
+from datetime import timedelta
+
+import pytz
+
+from .db import result_iterator
+
+logger = logging.getLogger(__name__)
+
+
+def in_list(keys, placeholder='(%s,%s)'):
+    """ Returns the SQL and the parameters for `IN (...)` with the given (revid, site) keys """
+    return ','.join([placeholder] * len(keys)), [x for key in keys for x in key]
+
+
+class ContribsCleaner(object):
+
+    def __init__(self, sql, start, end, site, name, wiki_tz=pytz.utc, chunk_size=1000, sleep=0.5, dry_run=False):
+        """
+            sql        : SQL Connection object
+            start, end : naive UTC datetimes, the contest period
+            site, name : the contest being cleaned, which is not closed yet in a dry run
+            wiki_tz    : timezone of the contest dates stored in the contests table
+            chunk_size : number of contributions to delete at a time
+            sleep      : seconds to wait between the chunks
+            dry_run    : only report what would be deleted
+        """
+        self.sql = sql
+        self.start = start
+        self.end = end
+        self.site = site
+        self.name = name
+        self.wiki_tz = wiki_tz
+        self.chunk_size = chunk_size
+        self.sleep = sleep
+        self.dry_run = dry_run
+        self.report = Counter()
+        self.blob_refs = Counter()  # sha1 -> number of deleted references
+        self.seen_text_keys = set()  # In a dry run, the rows are still there for the next chunk
+
+    def open_contest_windows(self, cur):
+        """
+        Returns the periods of the other open contests that overlap the contest period,
+        as (name, start, end) with naive UTC datetimes.
+        """
+        # The contest dates are stored in the wiki's local time, so the query allows for a day
+        # either way, and the overlap is checked after the conversion to UTC.
+        cur.execute(
+            'SELECT site, name, start_date, end_date FROM contests '
+            'WHERE closed=0 AND start_date IS NOT NULL AND end_date IS NOT NULL AND start_date <= %s AND end_date >= %s '
+            'AND NOT (site=%s AND name=%s)',
+            [(self.end + timedelta(days=1)).strftime('%F %T'), (self.start - timedelta(days=1)).strftime('%F %T'),
+             self.site, self.name]
+        )
+        windows = []
+        for site, name, open_start, open_end in cur.fetchall():
+            if (site, name) == (self.site, self.name):
+                continue
+            open_start = self.wiki_tz.localize(open_start).astimezone(pytz.utc).replace(tzinfo=None)
+            open_end = self.wiki_tz.localize(open_end).astimezone(pytz.utc).replace(tzinfo=None)
+            if open_start <= self.end and open_end >= self.start:
+                windows.append((name, open_start, open_end))
+        return windows
+
+    def deletable_condition(self, cur):
+        """
+        Returns the SQL condition and parameters matching the contributions that can be
+        deleted: those in the contest period that are not in the period of another open contest.
+        """
+        condition = 'timestamp >= %s AND timestamp <= %s'
+        params = [self.start.strftime('%F %T'), self.end.strftime('%F %T')]
+        for name, open_start, open_end in self.open_contest_windows(cur):
+            logger.info('Keeping contributions from %s to %s UTC, used by the open contest %s', open_start, open_end, name)
+            condition += ' AND NOT (timestamp >= %s AND timestamp <= %s)'
+            params += [open_start.strftime('%F %T'), open_end.strftime('%F %T')]
+        return condition, params
+
+    def referenced_keys(self, cur, keys, deletable, deletable_params):
+        """ Returns the (revid, site) keys that are referenced by contributions that are kept """
+        found = set()
+        sql_in, params = in_list(keys)
+        for column in ['revid', 'parentid']:
+            cur.execute(
+                'SELECT ' + column + ', site FROM contribs WHERE (' + column + ', site) IN (' + sql_in + ') '
+                'AND NOT (' + deletable + ')',
+                params + deletable_params
+            )
+            for revid, site_key in result_iterator(cur):
+                found.add((revid, site_key))
+        return found
+
+    def delete_chunk(self, cur, contrib_keys, text_keys):
+        # Texts and metrics
+        if self.dry_run:
+            text_keys = [key for key in text_keys if key not in self.seen_text_keys]
+            self.seen_text_keys.update(text_keys)
+        if len(text_keys) > 0:
+            sql_in, params = in_list(text_keys)
+            cur.execute('SELECT sha1 FROM revtexts WHERE (revid, site) IN (' + sql_in + ')', params)
+            sha1s = [row[0] for row in result_iterator(cur)]
+            self.blob_refs.update(sha1s)
+            self.report['revtexts'] += len(sha1s)
+            if self.dry_run:
+                cur.execute('SELECT COUNT(*) FROM revmetrics WHERE (revid, site) IN (' + sql_in + ')', params)
+                self.report['revmetrics'] += cur.fetchone()[0]
+            else:
+                cur.execute('DELETE FROM revtexts WHERE (revid, site) IN (' + sql_in + ')', params)
+                cur.execute('DELETE FROM revmetrics WHERE (revid, site) IN (' + sql_in + ')', params)
+                self.report['revmetrics'] += cur.rowcount
+
+        # Contributions
+        self.report['contribs'] += len(contrib_keys)
+        if not self.dry_run:
+            sql_in, params = in_list(contrib_keys)
+            cur.execute('DELETE FROM contribs WHERE (revid, site) IN (' + sql_in + ')', params)
+            self.sql.commit()
+
+    def delete_blobs(self, cur):
+        """ Remove the blobs that are no longer referenced, or count them in a dry run """
+        sha1s = list(self.blob_refs.keys())
+        for n in range(0, len(sha1s), self.chunk_size):
+            chunk = sha1s[n:n + self.chunk_size]
+            placeholders = ','.join(['%s'] * len(chunk))
+            cur.execute('SELECT sha1, COUNT(*) FROM revtexts WHERE sha1 IN (' + placeholders + ') GROUP BY sha1', chunk)
+            remaining = {sha1: count for sha1, count in result_iterator(cur)}
+            if self.dry_run:
+                # The references have not actually been deleted
+                unused = [sha1 for sha1 in chunk if remaining.get(sha1, 0) <= self.blob_refs[sha1]]
+            else:
+                unused = [sha1 for sha1 in chunk if remaining.get(sha1, 0) == 0]
+            if len(unused) == 0:
+                continue
+
+            placeholders = ','.join(['%s'] * len(unused))
+            cur.execute('SELECT COUNT(*), SUM(LENGTH(data)) FROM textblobs WHERE sha1 IN (' + placeholders + ')', unused)
+            nblobs, nbytes = cur.fetchone()
+            self.report['textblobs'] += nblobs
+            self.report['bytes'] += int(nbytes or 0)
+            if not self.dry_run:
+                # Guard against references added by other bots in the meantime
+                cur.execute(
+                    'DELETE FROM textblobs WHERE sha1 IN (' + placeholders + ') '
+                    'AND sha1 NOT IN (SELECT sha1 FROM revtexts WHERE sha1 IN (' + placeholders + '))',
+                    unused + unused
+                )
+                self.sql.commit()
+                if self.sleep > 0:
+                    time.sleep(self.sleep)
+
+    def run(self):
+        """ Delete the contributions, texts and metrics. Returns the report as a Counter. """
+        t0 = time.time()
+        cur = self.sql.cursor()
+        deletable, deletable_params = self.deletable_condition(cur)
+
+        last = (0, '')
+        while True:
+            cur.execute(
+                'SELECT revid, site, parentid FROM contribs WHERE (revid, site) > (%s, %s) AND ' + deletable +
+                ' ORDER BY revid, site LIMIT %s',
+                list(last) + deletable_params + [self.chunk_size]
+            )
+            rows = cur.fetchall()
+            if len(rows) == 0:
+                break
+            last = (rows[-1][0], rows[-1][1])
+
+            contrib_keys = [(revid, site_key) for revid, site_key, parentid in rows]
+            text_keys = set(contrib_keys) | set((parentid, site_key) for revid, site_key, parentid in rows if parentid)
+            protected = self.referenced_keys(cur, list(text_keys), deletable, deletable_params)
+            self.report['protected'] += len(protected)
+            self.delete_chunk(cur, contrib_keys, list(text_keys - protected))
+            logger.info('%s %d contributions so far', 'Found' if self.dry_run else 'Deleted', self.report['contribs'])
+
+            if not self.dry_run and self.sleep > 0:
+                time.sleep(self.sleep)
+
+        self.delete_blobs(cur)
+        cur.close()
+
+        logger.info('%s %d rows from contribs, %d from revtexts, %d from revmetrics and %d unused texts '
+                    '(%.1f MB) in %.1f secs. Kept the texts of %d revisions used by other contributions.',
+                    'Would remove' if self.dry_run else 'Removed',
+                    self.report['contribs'], self.report['revtexts'], self.report['revmetrics'],
+                    self.report['textblobs'], self.report['bytes'] / 1e6, time.time() - t0, self.report['protected'])
+        return self.report
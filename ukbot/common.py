@@ -5,8 +5,6 @@ import locale
 import gettext
 import yaml
 import os
-import psutil
-import pkg_resources
 import logging
 
 logger = logging.getLogger(__name__)
@@ -90,10 +88,14 @@ def log(msg, newline = True):
     logfile.flush()
 
 
-process = psutil.Process(os.getpid())
+process = None
 
 def get_mem_usage():
     """ Returns memory usage in MBs """
+    global process
+    if process is None:
+        import psutil
+        process = psutil.Process(os.getpid())
     return process.memory_info().rss / 1024.**2
 
 
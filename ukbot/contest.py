@@ -13,6 +13,8 @@ import json
 import os
 import urllib.parse
 import codecs
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 import mwclient
 from mwtemplates import TemplateEditor
 
@@ -21,7 +23,13 @@ from .common import _, STATE_ENDING, STATE_CLOSING, InvalidContestPage
 from .rules import rule_classes
 from .filters import CatFilter, TemplateFilter, NewPageFilter, ExistingPageFilter, ByteFilter, SparqlFilter, \
     BackLinkFilter, ExternalLinksFilter, ForwardLinkFilter, NamespaceFilter, PageFilter
-from .db import result_iterator
+from .analysis import analysis_cache
+from .batching import BatchBudgets
+from .cache import KeyValueCache
+from .cleanup import ContribsCleaner
+from .globaluserinfo import GlobalUserInfoService
+from .metrics import MetricsStore
+from .textregistry import TextRegistry
 from .user import User
 from .util import cleanup_input, unix_time, parse_infobox
 
@@ -123,6 +131,10 @@ class Contest(object):
         txt = page.text()
 
         self.sql = sql
+        self.cache = KeyValueCache(sql, config.get('cache_ttl'))
+        self.globaluserinfo = GlobalUserInfoService(self.cache, config.get('globaluserinfo_workers', 8))
+        self.texts = TextRegistry(float(config.get('text_registry_size', 200)) * 1e6)
+        self.batch_budgets = BatchBudgets()
         self.wiki_tz = config['wiki_timezone']
         self.server_tz = config['server_timezone']
 
@@ -366,11 +378,7 @@ class Contest(object):
                 if 'site' in templ.parameters:
                     site_key = cleanup_input(templ.parameters['site'].value)
 
-                site = None
-                for s in self.sites.sites.values():
-                    if s.match_prefix(site_key):
-                        site = s
-                        break
+                site = self.sites.from_prefix(site_key)
 
                 if site is None:
                     raise InvalidContestPage(_('Failed to parse the %(template)s template: Did not find a site matching the site prefix %(prefix)s') % {
@@ -399,27 +407,49 @@ class Contest(object):
 
         return rules, filters
 
+    def plotdata_filename(self):
+        return os.path.join(self.project_dir, self.config['plot']['datafile'] % {'year': self.year, 'week': self.startweek, 'month': self.month})
+
     def prepare_plotdata(self, results):
         if 'plot' not in self.config:
             return
 
-        plotdata = []
-        for result in results:
-            tmp = {'name': result['name'], 'values': []}
-            for point in result['plotdata']:
-                tmp['values'].append({'x': point[0], 'y': point[1]})
-            plotdata.append(tmp)
+        plotdata = [
+            {'name': result['name'], 'x': result['plotdata']['x'], 'y': result['plotdata']['y']}
+            for result in results
+        ]
 
         if 'datafile' in self.config['plot']:
-            filename = os.path.join(self.project_dir, self.config['plot']['datafile'] % {'year': self.year, 'week': self.startweek, 'month': self.month})
-            with open(filename, 'w') as fp:
-                json.dump(plotdata, fp)
+            with open(self.plotdata_filename(), 'w') as fp:
+                json.dump([
+                    {
+                        'name': series['name'],
+                        'values': [{'x': x, 'y': y} for x, y in zip(series['x'].tolist(), series['y'].tolist())],
+                    }
+                    for series in plotdata
+                ], fp)
 
         return plotdata
 
+    def load_plotdata(self):
+        """ Read the plot data written by prepare_plotdata """
+        with open(self.plotdata_filename(), 'r') as fp:
+            data = json.load(fp)
+        return [
+            {
+                'name': series['name'],
+                'x': np.array([point['x'] for point in series['values']], dtype=float),
+                'y': np.array([point['y'] for point in series['values']], dtype=float),
+            }
+            for series in data
+        ]
+
     def plot(self, plotdata):
         if 'plot' not in self.config:
             return
+        # Imported here since it's slow to import, and most runs don't plot
+        import matplotlib
+        matplotlib.use('svg')
         import matplotlib.pyplot as plt
 
         w = 20 / 2.54
@@ -441,24 +471,18 @@ class Contest(object):
 
         now = float(unix_time(self.server_tz.localize(datetime.now()).astimezone(pytz.utc)))
 
-        yall = []
+        ymax = None
         cnt = 0
 
         for result in plotdata:
-            x = [t['x'] for t in result['values']]
-            y = [t['y'] for t in result['values']]
+            x = result['x']
+            y = result['y']
 
             if len(x) > 0:
                 cnt += 1
-                yall.extend(y)
-                x.insert(0, xt[0])
-                y.insert(0, 0)
-                if now < xt[-1]:
-                    x.append(now)
-                    y.append(y[-1])
-                else:
-                    x.append(xt[-1])
-                    y.append(y[-1])
+                ymax = np.max(y) if ymax is None else max(ymax, np.max(y))
+                x = np.concatenate(([xt[0]], x, [min(now, xt[-1])]))
+                y = np.concatenate(([0.], y, [y[-1]]))
                 l = ax.plot(x, y, linewidth=1.2, label=result['name'])  # markerfacecolor='#FF8C00', markeredgecolor='#888888', label = u['name'])
                 c = l[0].get_color()
                 #ax.plot(x[1:-1], y[1:-1], marker='.', markersize=4, markerfacecolor=c, markeredgecolor=c, linewidth=0., alpha=0.5)  # markerfacecolor='#FF8C00', markeredgecolor='#888888', label = u['name'])
@@ -532,9 +556,9 @@ class Contest(object):
         for line in ax.yaxis.get_ticklines(minor=False):
             line.set_markersize(x_ticks_major_size)
 
-        if len(yall) > 0:
+        if ymax is not None:
             ax.set_xlim(t0, xt[-1])
-            ax.set_ylim(0, 1.05 * np.max(yall))
+            ax.set_ylim(0, 1.05 * ymax)
 
             ax.set_xlabel(_('Day'))
             ax.set_ylabel(_('Points'))
@@ -716,31 +740,35 @@ class Contest(object):
             txt = page.text(section=csection)
             page.save(appendtext=mld, bot=False, summary='== ' + heading + ' ==')
 
-    def delete_contribs_from_db(self):
+    def delete_contribs_from_db(self, dry_run=False):
+        """
+        Remove the contributions in the contest period, and their texts and metrics,
+        from the DB. In a dry run, only report what would be removed.
+        """
+        cleaner = ContribsCleaner(
+            self.sql,
+            self.start.astimezone(pytz.utc).replace(tzinfo=None),
+            self.end.astimezone(pytz.utc).replace(tzinfo=None),
+            self.sites.homesite.key,
+            self.name,
+            wiki_tz=self.wiki_tz,
+            chunk_size=int(self.config.get('cleanup_chunk_size', 1000)),
+            sleep=float(self.config.get('cleanup_sleep', 0.5)),
+            dry_run=dry_run,
+        )
+        cleaner.run()
+        if dry_run:
+            return
+
         cur = self.sql.cursor()
-        cur2 = self.sql.cursor()
         ts_start = self.start.astimezone(pytz.utc).strftime('%F %T')
         ts_end = self.end.astimezone(pytz.utc).strftime('%F %T')
-        ndel = 0
-        cur.execute('SELECT site,revid,parentid FROM contribs WHERE timestamp >= %s AND timestamp <= %s', (ts_start, ts_end))
-        for row in result_iterator(cur):
-            cur2.execute('DELETE FROM fulltexts WHERE site=%s AND revid=%s', [row[0], row[1]])
-            ndel += cur2.rowcount
-            cur2.execute('DELETE FROM fulltexts WHERE site=%s AND revid=%s', [row[0], row[2]])
-            ndel += cur2.rowcount
-
-        cur.execute('SELECT COUNT(*) FROM fulltexts')
-        nremain = cur.fetchone()[0]
-        logger.info('Cleaned %d rows from fulltexts-table. %d rows remain', ndel, nremain)
-
-        cur.execute('DELETE FROM contribs WHERE timestamp >= %s AND timestamp <= %s', (ts_start, ts_end))
-        ndel = cur.rowcount
-        cur.execute('SELECT COUNT(*) FROM contribs')
-        nremain = cur.fetchone()[0]
-        logger.info('Cleaned %d rows from contribs-table. %d rows remain', ndel, nremain)
+
+        # Any contest whose synced contributions overlap the deleted ones must do a full sync
+        cur.execute('DELETE FROM sync_cursors WHERE last_timestamp >= %s AND window_start <= %s', (ts_start, ts_end))
+        logger.info('Cleaned %d rows from sync_cursors-table', cur.rowcount)
 
         cur.close()
-        cur2.close()
         self.sql.commit()
 
     def deliver_warnings(self, simulate=False):
@@ -797,6 +825,113 @@ class Contest(object):
                     page.save(text=msg, bot=False, section='new', summary=heading)
             self.sql.commit()
 
+    def add_contribs_from_wikis(self, user, **kwargs):
+        """
+        Fill in new contributions from all the wikis the user has edited.
+        This only talks to the wikis, not to the database, so it is safe to run
+        for several users at once.
+        """
+        # Sites are initialized on first use, so check the hostnames before touching the sites
+        edited_hosts = user.hosts_with_edits()
+        for site_key in list(self.sites.keys()):
+
+            # if host_filter is None or site.host == host_filter:
+            if edited_hosts is not None and site_key not in edited_hosts:
+                continue
+            user.add_contribs_from_wiki(self.sites.sites[site_key], self.start, self.end, fulltext=True, **kwargs)
+
+    def ingest_contribs(self, users, executor=None, **kwargs):
+        """
+        Read and update the contributions for a batch of users.
+
+        The database is only accessed from the calling thread, since the connection
+        can't be shared between threads. If an executor is given, the contributions
+        are fetched from the wikis for all the users in the batch at once.
+        """
+        for user in users:
+            logger.info('=== User:%s ===', user.name)
+
+            # First read contributions from db
+            user.add_contribs_from_db(self.sql, self.start, self.end, self.sites.sites)
+            user.load_sync_cursors(self.sql)
+
+        # Then fill in new contributions from wiki
+        if executor is None:
+            for user in users:
+                self.add_contribs_from_wikis(user, **kwargs)
+        else:
+            t0 = time.time()
+            futures = [executor.submit(self.add_contribs_from_wikis, user, **kwargs) for user in users]
+            try:
+                for future in futures:
+                    future.result()
+            except BaseException:
+                # Don't start fetching for the other users. Nothing has been written to the DB yet.
+                for future in futures:
+                    future.cancel()
+                raise
+            logger.info('Fetched contributions for %d users in %.1f secs', len(users), time.time() - t0)
+
+        for user in users:
+            # And update db
+            user.save_contribs_to_db(self.sql)
+            user.save_sync_cursors(self.sql)
+
+            user.backfill_article_creation_dates(self.sql)
+
+    def score_user(self, user, simulate, stats, article_errors, results):
+        logger.info('=== Scoring User:%s ===', user.name)
+        try:
+
+            # Filter out relevant articles
+            user.filter(self.filters)
+
+            # And calculate points, using and updating the stored text metrics
+            logger.info('Calculating points')
+            tp0 = time.time()
+            metrics = MetricsStore(self.sql)
+            metrics.attach(user)
+            user.analyze(self.rules, self.cache)
+            tp1 = time.time()
+            logger.info('%s: %.f points (calculated in %.1f secs)', user.name,
+                        user.contributions.sum(), tp1 - tp0)
+
+            stats.extend(user.count_bytes_per_site())
+            stats.extend(user.count_words_per_site())
+            stats.extend(user.count_pages_per_site())
+            stats.extend(user.count_newpages_per_site())
+
+            tp2 = time.time()
+            logger.info('Wordcount done in %.1f secs', tp2 - tp1)
+            metrics.save()
+
+            for article in user.articles.values():
+                k = article.link()
+                if len(article.errors) > 0:
+                    article_errors[k] = article.errors
+                for rev in article.revisions.values():
+                    if len(rev.errors) > 0:
+                        if k in article_errors:
+                            article_errors[k].extend(rev.errors)
+                        else:
+                            article_errors[k] = rev.errors
+
+            results.append({
+                'name': user.name,
+                'points': user.contributions.sum(),
+                'result': user.contributions.format(homesite=self.sites.homesite),
+                'plotdata': user.plotdata,
+            })
+
+        except InvalidContestPage as e:
+            err = "\n* '''%s'''" % e.msg
+            out = '\n{{%s | error | %s }}' % (self.config['templates']['botinfo'], err)
+            if simulate:
+                logger.error(out)
+            else:
+                self.page.save('dummy', summary=_('UKBot encountered a problem'), appendtext=out)
+            raise
+
     def run(self, simulate=False, output=''):
         config = self.config
 
@@ -821,79 +956,38 @@ class Contest(object):
         article_errors = {}
         results = []
 
-        while True:
-            if len(self.users) == 0:
-                break
-            user = self.users.pop()
+        # Number of users whose contributions are fetched from the wikis in parallel.
+        # The users are still filtered and scored one by one, in the same order as
+        # before, so the output does not depend on this setting.
+        workers = max(1, int(config.get('ingestion_workers', 1)))
 
-            logger.info('=== User:%s ===', user.name)
-
-            # First read contributions from db
-            user.add_contribs_from_db(self.sql, self.start, self.end, self.sites.sites)
+        # Find the wikis each participant has an account on, for all the participants at once
+        self.globaluserinfo.prefetch([user.name for user in self.users])
+        self.batch_budgets.load(self.cache, self.sites.keys())
 
-            # Then fill in new contributions from wiki
-            edited_wikis = user.wikis_with_edits()
-            for site in self.sites.sites.values():
-
-                # if host_filter is None or site.host == host_filter:
-                if edited_wikis is not None and site.dbname not in edited_wikis:
-                    continue
-                user.add_contribs_from_wiki(site, self.start, self.end, fulltext=True, **extraargs)
-
-            # And update db
-            user.save_contribs_to_db(self.sql)
-
-            user.backfill_article_creation_dates(self.sql)
+        if workers > 1:
+            logger.info('Fetching contributions for up to %d users in parallel', workers)
+            executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ingest')
+        else:
+            executor = nullcontext()  # Fetch on the calling thread
 
-            try:
+        with executor as pool:
+            while True:
+                if len(self.users) == 0:
+                    break
 
-                # Filter out relevant articles
-                user.filter(self.filters)
-
-                # And calculate points
-                logger.info('Calculating points')
-                tp0 = time.time()
-                user.analyze(self.rules)
-                tp1 = time.time()
-                logger.info('%s: %.f points (calculated in %.1f secs)', user.name,
-                            user.contributions.sum(), tp1 - tp0)
-
-                stats.extend(user.count_bytes_per_site())
-                stats.extend(user.count_words_per_site())
-                stats.extend(user.count_pages_per_site())
-                stats.extend(user.count_newpages_per_site())
-
-                tp2 = time.time()
-                logger.info('Wordcount done in %.1f secs', tp2 - tp1)
-
-                for article in user.articles.values():
-                    k = article.link()
-                    if len(article.errors) > 0:
-                        article_errors[k] = article.errors
-                    for rev in article.revisions.values():
-                        if len(rev.errors) > 0:
-                            if k in article_errors:
-                                article_errors[k].extend(rev.errors)
-                            else:
-                                article_errors[k] = rev.errors
-
-                results.append({
-                    'name': user.name,
-                    'points': user.contributions.sum(),
-                    'result': user.contributions.format(homesite=self.sites.homesite),
-                    'plotdata': user.plotdata,
-                })
+                batch = [self.users.pop() for _ in range(min(workers, len(self.users)))]
+                self.ingest_contribs(batch, pool, **extraargs)
 
-            except InvalidContestPage as e:
-                err = "\n* '''%s'''" % e.msg
-                out = '\n{{%s | error | %s }}' % (config['templates']['botinfo'], err)
-                if simulate:
-                    logger.error(out)
-                else:
-                    self.page.save('dummy', summary=_('UKBot encountered a problem'), appendtext=out)
-                raise
+                while len(batch) > 0:
+                    user = batch.pop(0)
+                    self.score_user(user, simulate, stats, article_errors, results)
+                    del user
 
-            del user
+        analysis_cache.log_stats()
+        self.texts.log_stats()
+        self.batch_budgets.save(self.cache)
+        self.cache.purge()
 
         # Sort users by points
 
@@ -972,7 +1066,7 @@ class Contest(object):
                 err.append('(...)')
             errors.append('\n* ' + _('UKBot encountered the following problems with the page [[%s]]') % art + ''.join(['\n** %s' % e for e in err]))
 
-        for site in self.sites.sites.values():
+        for site in self.sites.initialized_sites():
             for error in site.errors:
                 errors.append('\n* %s' % error)
 
@@ -1123,8 +1217,7 @@ class Contest(object):
             #     self.deliver_receipt_to_leaders()
 
             logger.info('Cleaning database')
-            if not simulate:
-                self.delete_contribs_from_db()
+            self.delete_contribs_from_db(dry_run=simulate)
 
         # Notify users about issues
 
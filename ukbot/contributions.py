@@ -20,6 +20,15 @@ class UserContributions(object):
         self.labels = {}
         self.wikidata_languages = config['wikidata_languages']
 
+        # Indexes to avoid scanning all the contributions on every lookup
+        self._by_revision = {}  # (site key, revid) -> [UserContribution]
+        self._by_article = {}  # article key -> [UserContribution]
+        self._totals = {}  # article key -> {rule class: [raw points, points]}
+
+    @staticmethod
+    def revision_key(revision):
+        return revision.article().site().key, revision.revid
+
     def add(self, contribution):
         """
         Add a contribution and calculate the actual number of points given to it when
@@ -38,6 +47,13 @@ class UserContributions(object):
         )
         contribution.points = self.calculate_contribution_points(contribution)
         self.contributions.append(contribution)
+
+        self._by_revision.setdefault(self.revision_key(contribution.rev), []).append(contribution)
+        article_key = contribution.article.key
+        self._by_article.setdefault(article_key, []).append(contribution)
+        totals = self._totals.setdefault(article_key, {}).setdefault(type(contribution.rule), [0., 0.])
+        totals[0] += contribution.raw_points
+        totals[1] += contribution.points
         # Reminder to self: We do not filter out contributions that end up giving zero points after a limit.
         # This is so we can make statistics on metrics like total number of words.
 
@@ -50,16 +66,33 @@ class UserContributions(object):
             revision: Filter by revision
             rule: Filter by rule class
         """
-        contribs = self.contributions
-        if rule is not None:
-            contribs = [contrib for contrib in self.contributions if isinstance(contrib.rule, rule)]
-        if article is not None:
-            contribs = [contrib for contrib in contribs if contrib.article == article]
         if revision is not None:
+            contribs = self._by_revision.get(self.revision_key(revision), [])
             contribs = [contrib for contrib in contribs if contrib.rev == revision]
+            if article is not None:
+                contribs = [contrib for contrib in contribs if contrib.article == article]
+        elif article is not None:
+            contribs = list(self._by_article.get(article.key, []))
+        else:
+            contribs = list(self.contributions)
+        if rule is not None:
+            contribs = [contrib for contrib in contribs if isinstance(contrib.rule, rule)]
 
         return contribs
 
+    def get_rule_totals(self, article, rule):
+        """
+        Return the sum of the raw points and the sum of the actual points given to
+        an article by contributions from a given rule class (including subclasses).
+        """
+        raw_points = 0.
+        points = 0.
+        for rule_cls, totals in self._totals.get(article.key, {}).items():
+            if issubclass(rule_cls, rule):
+                raw_points += totals[0]
+                points += totals[1]
+        return raw_points, points
+
     def calculate_contribution_points(self, contribution):
         """
         Get the actual points for a given contribution, taking capping into account.
@@ -68,9 +101,7 @@ class UserContributions(object):
             return contribution.raw_points
 
         article = contribution.article
-        article_contribs = self.get(article=article, rule=type(contribution.rule))
-        article_raw_points = sum([contrib.raw_points for contrib in article_contribs])
-        article_points = sum([contrib.points for contrib in article_contribs])
+        article_raw_points, article_points = self.get_rule_totals(article, type(contribution.rule))
 
         if is_zero(article_points - contribution.rule.maxpoints):
             logger.debug('Ignoring contribution, already reached the point limit (%.1f) for %s.',
@@ -146,7 +177,7 @@ class UserContributions(object):
 
     def get_articles(self):
         return sorted(
-            list(set([contrib.article for contrib in self.contributions])),
+            [contribs[0].article for contribs in self._by_article.values()],
             key=lambda article: article.firstrev.timestamp
         )
 
@@ -57,3 +57,24 @@ def result_iterator(cursor, arraysize=1000):
             break
         for result in results:
             yield result
+
+
+def executemany_chunked(sql, query, rows, chunk_size=1000):
+    """
+    Run the query for the rows, which may be a generator, in chunks of `chunk_size`
+    rows. Returns the number of rows.
+    """
+    cur = sql.cursor()
+    nrows = 0
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            cur.executemany(query, chunk)
+            nrows += len(chunk)
+            chunk = []
+    if len(chunk) > 0:
+        cur.executemany(query, chunk)
+        nrows += len(chunk)
+    cur.close()
+    return nrows
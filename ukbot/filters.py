@@ -7,44 +7,52 @@ from copy import copy
 from more_itertools import first
 import logging
 import time
-import urllib
-import requests
+import urllib.parse
 from collections import OrderedDict
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
 from mwtemplates.templateeditor2 import TemplateParseError
 from .common import _, InvalidContestPage
 from .site import WildcardPage
+from . import transport
 
 from typing import List, Union, Optional
 from typing import TYPE_CHECKING
 if TYPE_CHECKING:
     from .ukbot import FilterTemplate, SiteManager
     from .article import Article
+    from .cache import KeyValueCache
     from mwclient.page import Page
     Articles = OrderedDict[str, 'Article']
 
 logger = logging.getLogger(__name__)
 
 
-def requests_retry_session(
-    retries=3,
-    backoff_factor=0.8,
-    status_forcelist=(500, 502, 504),
-    session=None,
-):
-    session = session or requests.Session()
-    retry = Retry(
-        total=retries,
-        read=retries,
-        connect=retries,
-        backoff_factor=backoff_factor,
-        status_forcelist=status_forcelist,
-    )
-    adapter = HTTPAdapter(max_retries=retry)
-    session.mount('http://', adapter)
-    session.mount('https://', adapter)
-    return session
+def trie_regexp(words: List[str]) -> str:
+    """
+    Build a regular expression that matches any of the given words, with common prefixes
+    factored out, so that the regexp engine doesn't have to try each word in turn.
+    A '*' in a word matches any sequence of characters except '}'.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}  # end of word
+
+    def build(node):
+        alternatives = []
+        for char, child in sorted(node.items()):
+            if char == '':
+                continue
+            token = '[^}]*?' if char == '*' else re.escape(char)
+            alternatives.append(token + build(child))
+        if len(alternatives) == 0:
+            return ''
+        if len(alternatives) == 1 and '' not in node:
+            return alternatives[0]
+        return '(?:%s)%s' % ('|'.join(alternatives), '?' if '' in node else '')
+
+    return build(trie)
 
 
 class CategoryLoopError(Exception):
@@ -60,6 +68,9 @@ class CategoryLoopError(Exception):
 
 class Filter(object):
 
+    # Whether test_page looks at revision texts, which are loaded lazily
+    needs_text = False
+
     def __init__(self, sites: 'SiteManager'):
         """
         Args:
@@ -68,10 +79,64 @@ class Filter(object):
         self.sites = sites
         self.page_keys = set()
 
+        # Verdicts shared between the users in a contest: memo key -> (passed, cat_path, errors)
+        self.verdicts = {}
+
     @classmethod
     def make(cls, tpl: 'FilterTemplate', **kwargs):
         return cls(tpl.sites)
 
+    def memo_key(self, page):
+        """
+        Return a key that identifies the verdict for a page, so that pages edited by several
+        users are only tested once, or None if the verdict depends on the user's contributions.
+        """
+        return page.key
+
+    def apply(self, articles: 'Articles', prepare=None) -> 'Articles':
+        """
+        Filter a set of articles, reusing the verdicts for pages that have already been tested
+        for another user. The optional prepare function is called with the articles that
+        actually need to be tested, before testing them.
+        """
+        keys = {article_key: self.memo_key(article) for article_key, article in articles.items()}
+        todo = OrderedDict([
+            (article_key, article) for article_key, article in articles.items()
+            if keys[article_key] is None or keys[article_key] not in self.verdicts
+        ])
+
+        if len(todo) > 0:
+            if prepare is not None:
+                prepare(todo)
+            nerrors = {article_key: len(article.errors) for article_key, article in todo.items()}
+            passed = self.filter(todo)
+            for article_key, article in todo.items():
+                if keys[article_key] is not None:
+                    self.verdicts[keys[article_key]] = (
+                        article_key in passed,
+                        getattr(article, 'cat_path', None) if article_key in passed else None,
+                        article.errors[nerrors[article_key]:],
+                    )
+        else:
+            passed = {}
+
+        out = OrderedDict()
+        for article_key, article in articles.items():
+            if article_key in todo:
+                if article_key in passed:
+                    out[article_key] = article
+                continue
+            ok, cat_path, errors = self.verdicts[keys[article_key]]
+            if ok:
+                if cat_path is not None:
+                    article.cat_path = cat_path
+                article.errors.extend(errors)
+                out[article_key] = article
+        if len(todo) < len(articles):
+            logger.info(' - %s: %d of %d verdicts shared with other users',
+                        type(self).__name__, len(articles) - len(todo), len(articles))
+        return out
+
     def test_page(self, page):
         """
         Return True if the page matches the current filter, False otherwise.
@@ -144,6 +209,8 @@ class Filter(object):
 class TemplateFilter(Filter):
     """ Filters articles that had any of a given set of templates (or their aliases) at a point"""
 
+    needs_text = True
+
     @classmethod
     def make(cls, tpl, **kwargs):
         if len(tpl.anon_params) < 3:
@@ -152,11 +219,12 @@ class TemplateFilter(Filter):
         params = {
             'sites': tpl.sites,
             'templates': tpl.anon_params[2:],
+            'cache': kwargs['contest'].cache,
         }
 
         return cls(**params)
 
-    def __init__(self, sites, templates, include_aliases=True):
+    def __init__(self, sites, templates, include_aliases=True, cache=None):
         """
         The TemplateFilter keeps pages that had any of a given set of templates
         (or their aliases) when the user made their first edit during the
@@ -166,22 +234,59 @@ class TemplateFilter(Filter):
             sites (SiteManager): References to the sites part of this contest
             templates (list): List of templates to include
             include_aliases (bool): Whether to include aliases, defaults to True
+            cache (KeyValueCache): persistent cache for the aliases, optional
         """
         Filter.__init__(self, sites)
 
         aliases = []
+        if include_aliases:
+            for template_aliases in self.get_aliases(templates, cache).values():
+                aliases.extend(template_aliases)
+
+        self.templates = templates + aliases
+
+        # Compile the matcher once. Maintenance templates can have hundreds of redirects,
+        # so the names are combined into a trie rather than a plain alternation.
+        names = set([x.lower() for x in self.templates if x.strip() != ''])
+        self.matcher = None
+        if len(names) > 0:
+            self.matcher = re.compile(r'{{(%s)[\s]*(\||}})' % trie_regexp(names), flags=re.IGNORECASE)
+        logger.info('TemplateFilter ready with %d templates and aliases', len(names))
+
+    def get_aliases(self, templates, cache=None):
+        """ Returns a dict of template name -> list of redirects to the template """
+        homesite = self.sites.homesite
+        keys = {template_name: '%s|%s' % (homesite.key, template_name) for template_name in templates}
+        stored = cache.get_many('template_aliases', keys.values()) if cache is not None else {}
+
+        aliases = {}
         for template_name in templates:
-            template_page = self.sites.homesite.pages['Template:%s' % template_name]
+            if keys[template_name] in stored:
+                aliases[template_name] = stored[keys[template_name]]
+                continue
+            template_page = homesite.pages['Template:%s' % template_name]
             if template_page.exists:
-                aliases.extend([x.page_title for x in template_page.backlinks(filterredir='redirects')])
+                aliases[template_name] = [x.page_title for x in template_page.backlinks(filterredir='redirects')]
+            else:
+                aliases[template_name] = []
 
-        self.templates = templates + aliases
+        if cache is not None:
+            cache.set_many('template_aliases', {
+                keys[template_name]: template_aliases
+                for template_name, template_aliases in aliases.items()
+                if keys[template_name] not in stored
+            })
+        return aliases
+
+    def memo_key(self, page):
+        # The verdict depends on the text before the user's first edit
+        return (page.key, page.revisions[first(page.revisions)].parentid)
 
     def text_contains_template(self, text):
         """ Checks if a given text contains the template"""
-
-        tpls = [x.replace('*', '[^}]*?') for x in self.templates]
-        m = re.search(r'{{(%s)[\s]*(\||}})' % '|'.join(tpls), text, flags=re.IGNORECASE)
+        if self.matcher is None:
+            return None
+        m = self.matcher.search(text)
         if m:
             return m.group(1)
         return None
@@ -239,6 +344,7 @@ class CatFilter(Filter):
 
         params = {
             'sites': tpl.sites,
+            'cache': kwargs['contest'].cache,
             'ignore': cls.get_ignore_list(tpl, kwargs.get('cfg', {}).get('ignore_page')),
             'categories': [
                 tpl.sites.resolve_page(cat_name, 14, True)
@@ -255,20 +361,31 @@ class CatFilter(Filter):
         if tpl.has_param('maxdepth'):
             params['maxdepth'] = int(tpl.get_param('maxdepth'))
 
+        params['mode'] = kwargs['contest'].config.get('catfilter_mode', 'ancestors')
+
         return cls(**params)
 
     def __init__(self, sites: 'SiteManager', categories: List[Union['Page', WildcardPage]], maxdepth: int = 5,
-                 ignore: List[str] = []):
+                 ignore: List[str] = [], cache: Optional['KeyValueCache'] = None, mode: str = 'ancestors'):
         """
         Arguments:
             sites (SiteManager): References to the sites part of this contest
             categories (list): Page objects
             maxdepth (int):  number of subcategory levels to traverse
             ignore (list): list of categories to ignore
+            cache (KeyValueCache): persistent cache for category memberships, optional
+            mode (str): 'ancestors' to walk up the category tree from each article, or
+                'descendants' to expand the given categories down the tree once, and
+                only look up the direct categories of each article.
         """
         Filter.__init__(self, sites)
 
+        if mode not in ['ancestors', 'descendants']:
+            raise RuntimeError('Unknown CatFilter mode: %s' % mode)
+        self.mode = mode
+
         self.ignore = ignore
+        self.cache = cache
 
         self.include = [
             '%s:%s' % (page.site.key, page.name)  # Includes namespace prefix
@@ -278,6 +395,10 @@ class CatFilter(Filter):
 
         self.categories_cache = {site_key: {} for site_key in self.sites.keys()}
 
+        # In descendants mode: category key -> parent category key (None for the included categories)
+        self.include_pages = [page for page in categories if not isinstance(page, WildcardPage)]
+        self.descendants = None
+
         # Sites for which we should accept all contributions
         self.wildcard_include = [
             page.site.key
@@ -288,91 +409,256 @@ class CatFilter(Filter):
         logger.debug('Initializing CatFilter with categories: "%s", maxdepth: %d',
                      '" OR "'.join(self.include), maxdepth)
 
-    def add_to_category_cache(self, articles: 'Articles'):
+    def follow_category(self, category_title: str) -> bool:
+        """ Returns False if the category matches any of the patterns in `self.ignore` """
+        category_short_name = category_title.split(':', 1)[1]
+        for d in self.ignore:
+            if re.search(d, category_short_name):
+                logger.debug(' - Ignore: "%s" matched "%s"', category_title, d)
+                return False
+        return True
+
+    def set_categories(self, site_key: str, member_title: str, category_titles: List[str]):
+        """ Store the categories of a page in `self.categories_cache`, skipping ignored categories """
+        self.categories_cache[site_key][member_title] = set([
+            category_title for category_title in category_titles if self.follow_category(category_title)
+        ])
+
+    def fetch_categories(self, site, titles: List[str]) -> dict:
+        """
+        Returns a dict of page title -> list of category titles (including the Category: prefix), keyed by
+        the requested titles. Titles that the API normalizes or resolves as redirects are mapped back to the
+        requested titles. Pages that are missing or invalid, or not in the response at all, are left out.
+        """
+        if 'bot' in site.rights:
+            requestlimit = 500
+            returnlimit = 5000
+        else:
+            requestlimit = 50
+            returnlimit = 500
+
+        edges = {}
+        for s0 in range(0, len(titles), requestlimit):
+            logger.debug('CatFilter [%s] Fetching categories for %d pages. Batch %d to %d', site.key, len(titles), s0, s0+requestlimit)
+            batch = titles[s0:s0+requestlimit]
+
+            page_categories = {}  # title in the response -> list of category titles
+            aliases = {}  # requested or normalized title -> title in the response
+            cont = True
+            clcont = {'continue': ''}
+            while cont:
+                args = {'prop': 'categories', 'titles': '|'.join(batch), 'cllimit': returnlimit}
+                args.update(clcont)
+                q = site.api('query', **args)
+
+                if 'warnings' in q:
+                    raise RuntimeError(q['warnings']['query']['*'])
+
+                for alias in q['query'].get('normalized', []) + q['query'].get('redirects', []):
+                    aliases[alias['from']] = alias['to']
+
+                for category_member in q['query']['pages'].values():
+                    if 'missing' in category_member or 'invalid' in category_member:
+                        continue
+                    member_categories = page_categories.setdefault(category_member['title'], [])
+                    for category in category_member.get('categories', []):
+                        member_categories.append(category['title'])
+
+                if 'continue' in q:
+                    clcont = q['continue']
+                else:
+                    cont = False
+
+            for title in batch:
+                resolved = aliases.get(title, title)
+                resolved = aliases.get(resolved, resolved)  # A normalized title can also be a redirect
+                if resolved in page_categories:
+                    edges[title] = page_categories[resolved]
+        return edges
+
+    def add_to_category_cache(self, articles: 'Articles', maxdepth: Optional[int] = None):
         """
         Fetch n levels of categories for a set of articles from the API, and store the category memberhips in
         the flat `self.categories_cache` dictionary. The `self.categories_cache` is retained for the whole bot
         run, so we only have to query the API once for each page/category, even if multiple users have contributed
         to the same page/category.
-        """
 
-        for site_key, site in self.sites.items():
-            if site_key in self.ignore_sites:
-                continue
+        The category memberships are also stored in the persistent cache, if available, so that later runs
+        only have to query the API for pages that are new or whose cache entry has expired.
 
-            if 'bot' in site.rights:
-                requestlimit = 500
-                returnlimit = 5000
-            else:
-                requestlimit = 50
-                returnlimit = 500
+        The number of levels defaults to `self.maxdepth` + 1, use maxdepth=0 to only fetch the direct categories.
+        """
+        if maxdepth is None:
+            maxdepth = self.maxdepth
 
-            # Titles of articles that belong to this site
-            titles_to_check = set([page.name for page in articles.values() if page.site().key == site_key])
+        # Group the titles by site, using the sites of the articles so that no other sites are initialized
+        titles_by_site = OrderedDict()
+        for page in articles.values():
+            titles_by_site.setdefault(page.site().key, (page.site(), set()))[1].add(page.name)
+        site_keys = set(self.sites.keys())
 
-            if len(titles_to_check) == 0:
+        for site_key, (site, titles_to_check) in titles_by_site.items():
+            if site_key in self.ignore_sites or site_key not in site_keys:
                 continue
 
             logger.debug('CatFilter [%s]: Planning to fetch categories for %d articles', site_key, len(titles_to_check))
 
-            for level in range(self.maxdepth + 1):
+            for level in range(maxdepth + 1):
 
                 titles0 = copy(titles_to_check)
                 titles_to_check = set()  # make a new list of titles to search
-                cache_misses = []
-
-                for member_title in titles0:
-                    if member_title in self.categories_cache[site_key]:
-                        for category_title in self.categories_cache[site_key][member_title]:
-                            titles_to_check.add(category_title)
-                    else:
-                        cache_misses.append(member_title)
-
-                logger.debug('CatFilter [%s, level %d]: Cache hits: %d, cache misses: %d', site_key, level, len(titles0) - len(cache_misses), len(cache_misses))
-
-                for s0 in range(0, len(cache_misses), requestlimit):
-                    logger.debug('CatFilter [%s, level %d] Fetching categories for %d pages. Batch %d to %d', site_key, level, len(cache_misses), s0, s0+requestlimit)
-                    ids = '|'.join(cache_misses[s0:s0+requestlimit])
-
-                    cont = True
-                    clcont = {'continue': ''}
-                    while cont:
-                        args = {'prop': 'categories', 'titles': ids, 'cllimit': returnlimit}
-                        args.update(clcont)
-                        q = site.api('query', **args)
-
-                        if 'warnings' in q:
-                            raise RuntimeError(q['warnings']['query']['*'])
-
-                        for category_member in q['query']['pages'].values():
-                            member_title = category_member['title']
-                            if 'categories' not in category_member:
-                                continue
-                            for category in category_member['categories']:
-                                category_title = category['title']  # Includes Category: prefix
-                                category_short_name = category_title.split(':', 1)[1]
-                                follow = True
-                                for d in self.ignore:
-                                    if re.search(d, category_short_name):
-                                        logger.debug(' - Ignore: "%s" matched "%s"', category_title, d)
-                                        follow = False
-                                if follow:
-                                    titles_to_check.add(category_title)
-
-                                    if member_title not in self.categories_cache[site_key]:
-                                        self.categories_cache[site_key][member_title] = set()
-
-                                    self.categories_cache[site_key][member_title].add(category_title)
-
-                        if 'continue' in q:
-                            clcont = q['continue']
-                        else:
-                            cont = False
+                cache_misses = [title for title in titles0 if title not in self.categories_cache[site_key]]
+                nhits = len(titles0) - len(cache_misses)
+
+                nstored = 0
+                if self.cache is not None and len(cache_misses) > 0:
+                    stored = self.cache.get_many('categories', ['%s|%s' % (site_key, title) for title in cache_misses])
+                    for key, category_titles in stored.items():
+                        self.set_categories(site_key, key.split('|', 1)[1], category_titles)
+                    nstored = len(stored)
+                    cache_misses = [title for title in cache_misses if title not in self.categories_cache[site_key]]
+
+                if len(titles0) > 0:
+                    logger.info('CatFilter [%s, level %d]: %d pages, cache hits: %d in memory, %d stored, cache misses: %d',
+                                site_key, level, len(titles0), nhits, nstored, len(cache_misses))
+
+                if len(cache_misses) > 0:
+                    edges = self.fetch_categories(site, cache_misses)
+                    for member_title in cache_misses:
+                        # Pages that were not found are only remembered for this run
+                        self.set_categories(site_key, member_title, edges.get(member_title, []))
+                    if self.cache is not None:
+                        self.cache.set_many('categories', {
+                            '%s|%s' % (site_key, member_title): category_titles
+                            for member_title, category_titles in edges.items()
+                        })
 
                 for member_title in titles0:
                     for category_title in self.categories_cache[site_key].get(member_title, []):
                         titles_to_check.add(category_title)
 
+    def fetch_subcategories(self, site, category_titles: List[str]) -> dict:
+        """
+        Returns a dict of category title -> list of subcategory titles. The categories are looked up
+        in the persistent cache all at once, if available, and only the rest are fetched from the API.
+        """
+        subcategories = {}
+        misses = list(dict.fromkeys(category_titles))
+        if self.cache is not None and len(misses) > 0:
+            stored = self.cache.get_many('subcategories', ['%s|%s' % (site.key, title) for title in misses])
+            for key, titles in stored.items():
+                subcategories[key.split('|', 1)[1]] = titles
+            misses = [title for title in misses if title not in subcategories]
+
+        # list=categorymembers only takes one category per request
+        fetched = {}
+        for category_title in misses:
+            members = []
+            cont = True
+            cmcont = {'continue': ''}
+            while cont:
+                args = {'list': 'categorymembers', 'cmtitle': category_title, 'cmtype': 'subcat', 'cmlimit': 'max'}
+                args.update(cmcont)
+                q = site.api('query', **args)
+                members.extend([member['title'] for member in q['query']['categorymembers']])
+                if 'continue' in q:
+                    cmcont = q['continue']
+                else:
+                    cont = False
+            fetched[category_title] = members
+        subcategories.update(fetched)
+
+        if self.cache is not None and len(fetched) > 0:
+            self.cache.set_many('subcategories', {
+                '%s|%s' % (site.key, title): members for title, members in fetched.items()
+            })
+        return subcategories
+
+    def build_descendants(self):
+        """
+        Expand the included categories down to `self.maxdepth` levels of subcategories, breadth first,
+        and store the parent of each category in `self.descendants`, so that the path back to the included
+        category is as short as possible. The included categories are expanded in the order they were given,
+        so a category that belongs to several of them is credited to the first one, as in ancestors mode.
+        """
+        t0 = time.time()
+        self.descendants = {}
+        nlookups = 0
+        for page in self.include_pages:
+            site = page.site
+            root_key = '%s:%s' % (site.key, page.name)
+            if root_key in self.descendants:
+                continue
+            self.descendants[root_key] = None
+            titles = [page.name]
+            for level in range(self.maxdepth):
+                if len(titles) == 0:
+                    break
+                # Look up the whole level at once
+                subcategories = self.fetch_subcategories(site, titles)
+                nlookups += len(titles)
+                next_titles = []
+                for category_title in titles:
+                    category_key = '%s:%s' % (site.key, category_title)
+                    for subcategory_title in subcategories[category_title]:
+                        subcategory_key = '%s:%s' % (site.key, subcategory_title)
+                        if subcategory_key in self.descendants or not self.follow_category(subcategory_title):
+                            continue
+                        self.descendants[subcategory_key] = category_key
+                        next_titles.append(subcategory_title)
+                titles = next_titles
+
+        logger.info('CatFilter: Expanded %d categories to %d categories in %.1f secs (%d lookups)',
+                    len(self.include_pages), len(self.descendants), time.time() - t0, nlookups)
+
+    def get_descendant_path(self, category_key: str) -> List[str]:
+        """ Returns the path from the included category down to the given category """
+        cat_path = []
+        while category_key is not None:
+            cat_path.insert(0, category_key)
+            category_key = self.descendants[category_key]
+        return cat_path
+
+    def filter_descendants(self, articles: 'Articles') -> 'Articles':
+        """ Filter a set of articles by intersecting their direct categories with the descendants of `self.include` """
+        if self.descendants is None:
+            self.build_descendants()
+
+        self.add_to_category_cache(articles, maxdepth=0)
+
+        t0 = time.time()
+        out = OrderedDict()
+        site_keys = set(self.sites.keys())
+        allowed = self.descendants.keys()
+
+        for article_key, article in articles.items():
+            site_key = article.site().key
+
+            if site_key in self.ignore_sites or site_key not in site_keys:
+                continue
+
+            if site_key in self.wildcard_include:
+                # Auto-pass all articles from this site
+                out[article_key] = article
+                continue
+
+            categories = allowed & set([
+                site_key + ':' + category_name
+                for category_name in self.categories_cache[site_key].get(article.name, [])
+            ])
+            if len(categories) > 0:
+                out[article_key] = article
+                # Use the shortest path, and the category name to break ties
+                article.cat_path = min(
+                    [self.get_descendant_path(category_key) for category_key in categories],
+                    key=lambda cat_path: (len(cat_path), cat_path)
+                )
+
+        dt = time.time() - t0
+        logger.debug('CatFilter: Checked categories for %d articles in %.1f secs', len(articles), dt)
+        logger.info(' - CatFilter: Articles reduced from %d to %d', len(articles), len(out))
+        return out
+
     def filter(self, articles: 'Articles') -> 'Articles':
         """
         Filter a set of articles using category data from `self.category_cache`.
@@ -388,6 +674,8 @@ class CatFilter(Filter):
             If a category path cannot be found due to category loops, an error will be attached to
             article.errors instead, but the article will still be returned as a match.
         """
+        if self.mode == 'descendants':
+            return self.filter_descendants(articles)
 
         self.add_to_category_cache(articles)
 
@@ -498,6 +786,10 @@ class ByteFilter(Filter):
         Filter.__init__(self, sites)
         self.bytelimit = bytelimit
 
+    def memo_key(self, page):
+        # The byte count is for the user's contributions only
+        return None
+
     def test_page(self, page):
         """
         Return True if the page matches the current filter, False otherwise.
@@ -508,6 +800,8 @@ class ByteFilter(Filter):
 class NewPageFilter(Filter):
     """Filters new articles"""
 
+    needs_text = True  # to check for redirects
+
     @classmethod
     def make(cls, tpl, contest, **kwargs):
         params = {
@@ -534,6 +828,10 @@ class NewPageFilter(Filter):
         self.contest_end = contest.end
         self.redirects = redirects
 
+    def memo_key(self, page):
+        # Whether the page is a redirect depends on the user's last revision of it
+        return page.key if self.redirects else None
+
     def test_page(self, page):
         """
         Return True if the page matches the current filter, False otherwise.
@@ -642,34 +940,46 @@ class ExternalLinksFilter(Filter):
         Filter.__init__(self, sites)
         self.url = url
         self.site_restrictions = site_restrictions
+        self.fetched_sites = set()
         logger.info('Initializing ExternalLinksFilter: %s', url)
 
-        for site_key, site_obj in self.sites.items():
-            if self.site_restrictions and site_key not in self.site_restrictions:
-                continue
+    def test_page(self, page):
+        """
+        Return True if the page matches the current filter, False otherwise.
+        The pages linking to the URL are fetched from each site when it's first needed.
+        """
+        site_obj = page.site()
+        if site_obj.key not in self.fetched_sites:
+            self.fetched_sites.add(site_obj.key)
+            if site_obj.key in self.sites.keys() and (
+                    not self.site_restrictions or site_obj.key in self.site_restrictions):
+                self.fetch_site(site_obj)
+        return page.key in self.page_keys
 
-            params = {
-                'action': 'query',
-                'list': 'exturlusage',
-                'euprop': 'title',
-                'euquery': url,
-                'eulimit': 'max',
-            }
+    def fetch_site(self, site_obj):
+        """ Fetch the pages at a site that contain the external link """
+        params = {
+            'action': 'query',
+            'list': 'exturlusage',
+            'euprop': 'title',
+            'euquery': self.url,
+            'eulimit': 'max',
+        }
 
-            while True:
-                res = site_obj.api(**params)
-                for entry in res.get('query', {}).get('exturlusage', []):
-                    title = entry.get('title')
-                    link = '%s:%s' % (site_obj.key, title)
-                    self.page_keys.add(link)
+        while True:
+            res = site_obj.api(**params)
+            for entry in res.get('query', {}).get('exturlusage', []):
+                title = entry.get('title')
+                link = '%s:%s' % (site_obj.key, title)
+                self.page_keys.add(link)
 
-                cont = res.get('continue')
-                if cont and 'eucontinue' in cont:
-                    params['eucontinue'] = cont['eucontinue']
-                else:
-                    break
+            cont = res.get('continue')
+            if cont and 'eucontinue' in cont:
+                params['eucontinue'] = cont['eucontinue']
+            else:
+                break
 
-        logger.info('ExternalLinksFilter ready with %d links', len(self.page_keys))
+        logger.info('ExternalLinksFilter: %d links at %s', len(self.page_keys), site_obj.key)
 
 
 class ForwardLinkFilter(Filter):
@@ -784,14 +1094,13 @@ class SparqlFilter(Filter):
     def do_query(self, querystring):
         logger.info('Running SPARQL query: %s', querystring)
         try:
-            response = requests_retry_session().get(
+            response = transport.get_session().get(
                 'https://query.wikidata.org/sparql',
                 params={
                     'query': querystring,
                 },
                 headers={
                     'accept': 'application/sparql-results+json',
-                    'accept-encoding': 'gzip, deflate, br',
                     'user-agent': 'UKBot/1.0, run by User:Danmichaelo',
                 }
             )
@@ -0,0 +1,108 @@
+# encoding=utf-8
+# vim: fenc=utf-8 et sw=4 ts=4 sts=4 ai
+"""
+Lookup of the wikis each participant has an account on, from the global account
+info on Meta, used to skip the wikis a user has never edited.
+
+The API only takes one user per request, so the participants are looked up
+concurrently over the shared session at the start of the run. The results are
+stored in the persistent cache, since the list of merged accounts rarely changes.
+Failed lookups are cached too, for a shorter time, so an unreachable API doesn't
+slow down every run.
+"""
+import logging
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from . import transport
+from .sites import WIKIMEDIA_API_URL
+
+logger = logging.getLogger(__name__)
+
+ERRORS_TTL = 1  # hours
+
+
+def query_globaluserinfo(session, username):
+    """
+    Returns the merged accounts of the user as a list of {'wiki': dbname, 'url': url}.
+    Raises an exception if the lookup fails.
+    """
+    params = {
+        'action': 'query',
+        'meta': 'globaluserinfo',
+        'guiuser': username,
+        'guiprop': 'merged',
+        'format': 'json',
+        'formatversion': 2,
+        'wiki': 'metawiki',
+    }
+    resp = session.get(WIKIMEDIA_API_URL, params=params, timeout=10)
+    resp.raise_for_status()
+    data = resp.json()
+    return [
+        {'wiki': x['wiki'], 'url': x.get('url')}
+        for x in data['query']['globaluserinfo'].get('merged', [])
+    ]
+
+
+def hostnames(accounts):
+    return {urllib.parse.urlparse(x['url']).netloc for x in accounts if x.get('url')}
+
+
+class GlobalUserInfoService(object):
+
+    namespace = 'globaluserinfo'
+    errors_namespace = 'globaluserinfo_errors'  # only used for the time to live
+
+    def __init__(self, cache=None, workers=8):
+        self.cache = cache  # KeyValueCache, optional
+        self.workers = max(1, int(workers))
+        self.accounts = {}  # username -> list of accounts, or None if the lookup failed
+
+    def fetch(self, usernames):
+        """ Look up the given users concurrently. Returns a dict of username -> accounts or None """
+        results = {}
+        session = transport.get_session()
+
+        def lookup(username):
+            try:
+                return query_globaluserinfo(session, username)
+            except Exception as e:
+                logger.warning('Could not fetch globaluserinfo for %s: %s', username, e)
+                return None
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='globaluserinfo') as executor:
+            for username, accounts in zip(usernames, executor.map(lookup, usernames)):
+                results[username] = accounts
+        return results
+
+    def prefetch(self, usernames):
+        """ Look up all the given users that are not already known """
+        usernames = [u for u in dict.fromkeys(usernames) if u not in self.accounts]
+        if len(usernames) == 0:
+            return
+
+        if self.cache is not None:
+            self.accounts.update(self.cache.get_many(self.namespace, usernames))
+            usernames = [u for u in usernames if u not in self.accounts]
+            if len(usernames) == 0:
+                return
+
+        t0 = time.time()
+        results = self.fetch(usernames)
+        self.accounts.update(results)
+
+        if self.cache is not None:
+            found = {u: accounts for u, accounts in results.items() if accounts is not None}
+            failed = {u: None for u, accounts in results.items() if accounts is None}
+            self.cache.set_many(self.namespace, found)
+            self.cache.set_many(self.namespace, failed, ttl=self.cache.ttl(self.errors_namespace, ERRORS_TTL))
+        logger.info('Looked up global accounts for %d users in %.1f secs (%d failed)',
+                    len(usernames), time.time() - t0, sum(1 for x in results.values() if x is None))
+
+    def get(self, username):
+        """ Returns the list of merged accounts of the user, or None if unknown """
+        if username not in self.accounts:
+            self.prefetch([username])
+        return self.accounts[username]
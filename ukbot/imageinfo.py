@@ -0,0 +1,97 @@
+# encoding=utf-8
+# vim: fenc=utf-8 et sw=4 ts=4 sts=4 ai
+"""
+Batched lookup of the uploader and credit line of image files, used by the ImageRule.
+
+All the file names added in a user's revisions are resolved up front, many titles
+per API request, and the results are kept for the rest of the run and stored in the
+persistent cache so later runs don't need to ask again.
+"""
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def imageinfo_batch_size(site):
+    return 500 if 'apihighlimits' in site.rights else 50
+
+
+def query_imageinfo(site, filenames):
+    """
+    Returns a dict of filename -> {'user': uploader, 'credit': credit line} for the
+    given files, or filename -> None for files that don't exist or are invalid.
+    Files from a shared repository (Commons) are included.
+    """
+    titles = {'File:' + filename: filename for filename in filenames}
+    res = site.api('query', prop='imageinfo', titles='|'.join(titles.keys()),
+                   iiprop='user|extmetadata', iiextmetadatafilter='Credit')
+    query = res.get('query', {})
+    normalized = {n['from']: n['to'] for n in query.get('normalized', [])}
+    pages = {page['title']: page for page in query.get('pages', {}).values()}
+
+    infos = {}
+    for title, filename in titles.items():
+        page = pages.get(normalized.get(title, title))
+        if page is None or 'invalid' in page:
+            logger.error('Image filename "%s" is invalid, ignoring this file', filename)
+            infos[filename] = None
+            continue
+        imageinfo = page.get('imageinfo', [])
+        if len(imageinfo) == 0:  # page.missing is also set for files on Commons
+            infos[filename] = None
+            continue
+        if 'user' not in imageinfo[0]:
+            logger.error("Could not locate user for file '%s'", filename)
+            infos[filename] = None
+            continue
+        try:
+            credit = imageinfo[0]['extmetadata']['Credit']['value']
+        except KeyError:
+            logger.debug("Could not read credit info for file '%s'", filename)
+            credit = ''
+        infos[filename] = {'user': imageinfo[0]['user'], 'credit': credit}
+    return infos
+
+
+class ImageInfoService(object):
+
+    namespace = 'imageinfo'
+
+    def __init__(self, cache=None):
+        self.cache = cache  # KeyValueCache, optional
+        self.infos = {}  # (site key, filename) -> dict or None
+
+    def prefetch(self, site, filenames):
+        """ Look up all the given files that are not already known, in as few requests as possible """
+        filenames = [f for f in set(filenames) if (site.key, f) not in self.infos]
+        if len(filenames) == 0:
+            return
+
+        if self.cache is not None:
+            cached = self.cache.get_many(self.namespace, ['%s|%s' % (site.key, f) for f in filenames])
+            for key, info in cached.items():
+                self.infos[(site.key, key.split('|', 1)[1])] = info
+            filenames = [f for f in filenames if (site.key, f) not in self.infos]
+            if len(filenames) == 0:
+                return
+
+        t0 = time.time()
+        found = {}
+        batch_size = imageinfo_batch_size(site)
+        for n in range(0, len(filenames), batch_size):
+            for filename, info in query_imageinfo(site, filenames[n:n + batch_size]).items():
+                self.infos[(site.key, filename)] = info
+                if info is not None:
+                    # Missing files are not cached persistently, since they may be uploaded later
+                    found['%s|%s' % (site.key, filename)] = info
+
+        if self.cache is not None:
+            self.cache.set_many(self.namespace, found)
+        logger.info('Looked up %d files at %s in %.1f secs', len(filenames), site.key, time.time() - t0)
+
+    def get(self, site, filename):
+        """ Returns {'user': uploader, 'credit': credit line}, or None if the file doesn't exist """
+        if (site.key, filename) not in self.infos:
+            self.prefetch(site, [filename])
+        return self.infos[(site.key, filename)]
@@ -0,0 +1,109 @@
+# encoding=utf-8
+# vim: fenc=utf-8 et sw=4 ts=4 sts=4 ai
+"""
+DB-backed cache of features derived from revision texts (word counts, references,
+images, links, templates, ...), so that each revision text only has to be analysed
+once, not on every run.
+
+Metrics are stored per (site, revid) together with ANALYZER_VERSION. Bump the
+version whenever a change to the analysis code can change the results, so that
+the stored metrics are recalculated.
+"""
+import json
+import logging
+import time
+
+from .db import result_iterator
+
+logger = logging.getLogger(__name__)
+
+ANALYZER_VERSION = 2
+
+
+def metric_key(feature, params):
+    if len(params) == 0:
+        return feature
+    return feature + ':' + json.dumps(params, ensure_ascii=False)
+
+
+class Metrics(dict):
+    """ The metrics of a single revision text. Values read from the DB are JSON values, so tuples become lists. """
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.dirty = False
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self.dirty = True
+
+
+class MetricsStore(object):
+
+    def __init__(self, sql):
+        self.sql = sql
+        self.metrics = {}  # (site key, revid) -> Metrics
+
+    def attach(self, user):
+        """
+        Read the stored metrics for the texts and parent texts of all the revisions
+        of a user in bulk, and attach them to the revisions.
+        """
+        t0 = time.time()
+        revisions = [rev for article in user.articles.values() for rev in article.revisions.values()]
+
+        revids_by_site = {}
+        for rev in revisions:
+            site_key = rev.article().site().key
+            for revid in [rev.revid, rev.parentid]:
+                if revid != 0 and (site_key, revid) not in self.metrics:
+                    revids_by_site.setdefault(site_key, set()).add(revid)
+
+        nfound = 0
+        cur = self.sql.cursor()
+        for site_key, revids in revids_by_site.items():
+            revids = list(revids)
+            chunk_size = 1000
+            for n in range(0, len(revids), chunk_size):
+                chunk = revids[n:n + chunk_size]
+                cur.execute(
+                    'SELECT revid, metrics FROM revmetrics WHERE site=%s AND version=%s AND revid IN (' + ','.join(['%s'] * len(chunk)) + ')',
+                    [site_key, ANALYZER_VERSION] + chunk
+                )
+                for revid, data in result_iterator(cur):
+                    self.metrics[(site_key, revid)] = Metrics(json.loads(data))
+                    nfound += 1
+        cur.close()
+
+        for rev in revisions:
+            site_key = rev.article().site().key
+            rev.text_metrics = self.metrics.setdefault((site_key, rev.revid), Metrics())
+            if rev.parentid != 0:
+                rev.parenttext_metrics = self.metrics.setdefault((site_key, rev.parentid), Metrics())
+
+        logger.info('Read stored metrics for %d of %d revision texts in %.2f secs',
+                    nfound, sum(len(revids) for revids in revids_by_site.values()), time.time() - t0)
+
+    def save(self):
+        """ Store the metrics that have been calculated since they were read, and forget them all """
+        data = [
+            (revid, site_key, ANALYZER_VERSION, json.dumps(metrics, ensure_ascii=False))
+            for (site_key, revid), metrics in self.metrics.items()
+            if metrics.dirty
+        ]
+        self.metrics = {}
+        if len(data) == 0:
+            return
+
+        t0 = time.time()
+        cur = self.sql.cursor()
+        chunk_size = 500
+        for n in range(0, len(data), chunk_size):
+            cur.executemany("""
+                replace into revmetrics (revid, site, version, metrics)
+                values (%s,%s,%s,%s)
+                """, data[n:n + chunk_size]
+            )
+        self.sql.commit()
+        cur.close()
+        logger.info('Stored metrics for %d revision texts in %.2f secs', len(data), time.time() - t0)
@@ -0,0 +1,84 @@
+# encoding=utf-8
+# vim: fenc=utf-8 et sw=4 ts=4 sts=4 ai
+"""
+Startup profiling for the `ukbot --profile-startup` flag.
+
+install() wraps the import statement to record how long each module takes to
+import, in the same format as `python -X importtime`, and watch_first_request()
+reports the time from when this module was loaded to the first HTTP request,
+which is normally the first API call. install() must be called before the other
+modules are imported.
+"""
+import builtins
+import importlib.util
+import sys
+import time
+
+start_time = time.perf_counter()
+_original_import = builtins.__import__
+_records = []  # (name, depth, self time, cumulative time) in microseconds
+_stack = []  # child time accumulated for the imports in progress
+_reported = False
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    try:
+        package = globals.get('__package__') if level > 0 and globals is not None else None
+        resolved = importlib.util.resolve_name('.' * level + name, package)
+    except (ImportError, ValueError, AttributeError):
+        resolved = name
+    if resolved in sys.modules:
+        return _original_import(name, globals, locals, fromlist, level)
+
+    depth = len(_stack)
+    _stack.append(0.)
+    t0 = time.perf_counter()
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        cumulative = (time.perf_counter() - t0) * 1e6
+        children = _stack.pop()
+        if len(_stack) > 0:
+            _stack[-1] += cumulative
+        _records.append((resolved, depth, cumulative - children, cumulative))
+
+
+def install():
+    """ Start recording import times """
+    builtins.__import__ = _timed_import
+
+
+def uninstall():
+    builtins.__import__ = _original_import
+
+
+def report_imports(limit=30, file=None):
+    """ Print the slowest top-level imports and the modules they imported """
+    file = file or sys.stderr
+    total = sum(cumulative for name, depth, self_time, cumulative in _records if depth == 0)
+    print('Startup profile: %d modules imported in %.1f ms' % (len(_records), total / 1000.), file=file)
+    print('import time: self [us] | cumulative | imported package', file=file)
+    slowest = sorted(_records, key=lambda record: record[3], reverse=True)[:limit]
+    for name, depth, self_time, cumulative in slowest:
+        print('import time: %9.0f | %10.0f | %s%s' % (self_time, cumulative, '  ' * depth, name), file=file)
+
+
+def watch_first_request(file=None):
+    """ Report the imports and the time to the first HTTP request when it is made """
+    import requests
+
+    original_send = requests.Session.send
+
+    def send(session, request, **kwargs):
+        global _reported
+        if not _reported:
+            _reported = True
+            requests.Session.send = original_send
+            uninstall()
+            report_imports(file=file)
+            print('Startup profile: first API call after %.1f ms: %s %s' % (
+                (time.perf_counter() - start_time) * 1000., request.method, request.url.split('?')[0]
+            ), file=file or sys.stderr)
+        return original_send(session, request, **kwargs)
+
+    requests.Session.send = send
@@ -7,13 +7,21 @@ from collections import OrderedDict
 from datetime import datetime
 import logging
 import pytz
-from mwtemplates import TemplateEditor
 from mwtextextractor import get_body_text
 from .common import _
+from .textstore import decompress
+from .analysis import analysis_cache, text_digest
+from .metrics import metric_key
 
 logger = logging.getLogger(__name__)
 
 
+def body_text_stats(text):
+    """ Returns the number of characters and words in the body text of a wikitext """
+    body = get_body_text(re.sub('<nowiki ?/>', '', text))
+    return len(body), len(body.split())
+
+
 class Revision(object):
 
     def __init__(self, article, revid, **kwargs):
@@ -29,18 +37,22 @@ class Revision(object):
 
         self.revid = revid
         self.size = -1
-        self.text = ''
+        self._text = ''  # None if not loaded yet
+        self._ztext = None  # Compressed text from the text store, decompressed as needed
         self.point_deductions = []
 
         self.parentid = 0
         self.parentsize = 0
-        self.parenttext = ''
+        self._parenttext = ''
+        self._zparenttext = None
         self.username = ''
         self.parsedcomment = None
         self.saved = False  # Saved in local DB
         self.dirty = False  #
-        self._te_text = None  # Loaded as needed
-        self._te_parenttext = None  # Loaded as needed
+        self._text_digest = None  # Loaded as needed
+        self._parenttext_digest = None  # Loaded as needed
+        self.text_metrics = None  # Stored metrics, see MetricsStore
+        self.parenttext_metrics = None
 
         for k, v in kwargs.items():
             if k == 'timestamp':
@@ -77,6 +89,108 @@ class Revision(object):
     def __hash__(self):
         return hash(self.__repr__())
 
+    def defer_texts(self):
+        """
+        Mark the revision text and parent text as not loaded. They are loaded in bulk
+        by User.load_texts, or for the whole article on first access.
+        """
+        self._text = None
+        self._ztext = None
+        self._text_digest = None
+        self._parenttext = None if self.parentid != 0 else ''
+        self._zparenttext = None
+        self._parenttext_digest = None
+
+    @property
+    def text_loaded(self):
+        return self._text is not None or self._ztext is not None
+
+    @property
+    def parenttext_loaded(self):
+        return self._parenttext is not None or self._zparenttext is not None
+
+    def set_compressed_texts(self, ztext=None, zparenttext=None):
+        """ Set texts from the text store. They are decompressed on first access. """
+        if ztext is not None:
+            self._text = None
+            self._ztext = ztext
+            self._text_digest = None
+        if zparenttext is not None:
+            self._parenttext = None
+            self._zparenttext = zparenttext
+            self._parenttext_digest = None
+
+    @property
+    def text(self):
+        if not self.text_loaded:
+            self.article().user().load_texts({self.article().key: self.article()})
+        if self._text is None:
+            self._text = decompress(self._ztext)
+            self._ztext = None
+        return self._text
+
+    @text.setter
+    def text(self, value):
+        self._text = value
+        self._ztext = None
+        self._text_digest = None
+
+    @property
+    def parenttext(self):
+        if not self.parenttext_loaded:
+            self.article().user().load_texts({self.article().key: self.article()})
+        if self._parenttext is None:
+            self._parenttext = decompress(self._zparenttext)
+            self._zparenttext = None
+        return self._parenttext
+
+    @parenttext.setter
+    def parenttext(self, value):
+        self._parenttext = value
+        self._zparenttext = None
+        self._parenttext_digest = None
+
+    @property
+    def text_digest(self):
+        if self._text_digest is None:
+            self._text_digest = text_digest(self.text)
+        return self._text_digest
+
+    @property
+    def parenttext_digest(self):
+        if self._parenttext_digest is None:
+            self._parenttext_digest = text_digest(self.parenttext)
+        return self._parenttext_digest
+
+    @staticmethod
+    def _feature(metrics, get_text, get_digest, feature, compute, params):
+        key = metric_key(feature, params)
+        if metrics is not None and key in metrics:
+            return metrics[key]
+
+        text = get_text()
+        value = analysis_cache.get(get_digest(), feature, params, lambda: compute(text, *params))
+        if metrics is not None and text != '':
+            # Don't store metrics for missing texts, the text may be available later
+            metrics[key] = value
+        return value
+
+    def text_feature(self, feature, compute, *params):
+        """
+        Returns compute(self.text, *params). The value is read from the stored metrics
+        if available, or memoized in the shared analysis cache.
+        """
+        return self._feature(self.text_metrics, lambda: self.text, lambda: self.text_digest,
+                             feature, compute, params)
+
+    def parenttext_feature(self, feature, compute, *params):
+        """
+        Returns compute(self.parenttext, *params). The value is read from the stored metrics
+        if available, or memoized in the shared analysis cache.
+        """
+        return self._feature(self.parenttext_metrics, lambda: self.parenttext, lambda: self.parenttext_digest,
+                             feature, compute, params)
+
     @property
     def utc(self):
         return pytz.utc.localize(datetime.fromtimestamp(self.timestamp))
@@ -85,16 +199,6 @@ class Revision(object):
     def wiki_tz(self):
         return self.utc.astimezone(self.article().user().contest().wiki_tz)
 
-    def te_text(self):
-        if self._te_text is None:
-            self._te_text = TemplateEditor(re.sub('<nowiki ?/>', '', self.text))
-        return self._te_text
-
-    def te_parenttext(self):
-        if self._te_parenttext is None:
-            self._te_parenttext = TemplateEditor(re.sub('<nowiki ?/>', '', self.parenttext))
-        return self._te_parenttext
-
     @property
     def bytes(self):
         return self.size - self.parentsize
@@ -109,20 +213,17 @@ class Revision(object):
         except:
             pass
 
-        mt1 = get_body_text(re.sub('<nowiki ?/>', '', self.text))
-        mt0 = get_body_text(re.sub('<nowiki ?/>', '', self.parenttext))
+        chars1, words1 = self.text_feature('body_text_stats', body_text_stats)
+        chars0, words0 = self.parenttext_feature('body_text_stats', body_text_stats)
 
         if self.article().site().key == 'ja.wikipedia.org':
-            words1 = len(mt1) / 3.0
-            words0 = len(mt0) / 3.0
+            words1 = chars1 / 3.0
+            words0 = chars0 / 3.0
         elif self.article().site().key == 'zh.wikipedia.org':
-            words1 = len(mt1) / 2.0
-            words0 = len(mt0) / 2.0
-        else:
-            words1 = len(mt1.split())
-            words0 = len(mt0.split())
+            words1 = chars1 / 2.0
+            words0 = chars0 / 2.0
 
-        charcount = len(mt1) - len(mt0)
+        charcount = chars1 - chars0
         self._wordcount = words1 - words0
 
         logger.debug('Wordcount: Revision %s@%s: %+d bytes, %+d characters, %+d words',
@@ -150,8 +251,6 @@ class Revision(object):
 
         #s = _('A problem encountered with revision %(revid)d may have influenced the word count for this revision: <nowiki>%(problems)s</nowiki> ')
         #s = _('Et problem med revisjon %d kan ha påvirket ordtellingen for denne: <nowiki>%s</nowiki> ')
-        del mt1
-        del mt0
         # except DanmicholoParseError as e:
         #     log("!!!>> FAIL: %s @ %d" % (self.article().name, self.revid))
         #     self._wordcount = 0
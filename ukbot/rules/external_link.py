@@ -25,8 +25,8 @@ class ExternalLinkRule(Rule):
     @family('wikipedia.org', 'wikibooks.org')
     def test(self, rev):
         contains = self.get_param('contains')
-        links_before = self.count_links(rev.parenttext, contains)
-        links_after = self.count_links(rev.text, contains)
+        links_before = rev.parenttext_feature('external_links', self.count_links, contains)
+        links_after = rev.text_feature('external_links', self.count_links, contains)
         links_added = links_after - links_before
 
         if links_added > 0:
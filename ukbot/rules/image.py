@@ -1,11 +1,12 @@
 # encoding=utf-8
 # vim: fenc=utf-8 et sw=4 ts=4 sts=4 ai
+import hashlib
 import re
-from mwclient.errors import InvalidPageTitle
 import urllib
 import logging
 from ..common import _
 from ..contributions import UserContribution
+from ..imageinfo import ImageInfoService
 from .rule import Rule
 from .decorators import family
 
@@ -29,73 +30,71 @@ class ImageRule(Rule):
         # for addition of images to articles that do not have images from before.
         self.maxinitialcount = self.get_param('maxinitialcount', datatype=int)
 
-        # Find localized File: prefixes for all sites
-        self.file_prefixes = set([prefix for site in self.sites.sites.values() for prefix in site.file_prefixes])
-
         # Keep a statistic for total number of images added
         self.total = 0
 
-        # Compile regexps for match images
-        prefixes = r'(?:%s)' % '|'.join(['%s:' % x for x in self.file_prefixes])
-        suffixes = r'\.(?:svg|png|jpe?g|gif|tiff)'
-        imagematcher = r"""
-            (?:
-                (?:=|\||^)%(prefixes)s?   # "=File:", "=", "|File:", "|", ...
-                | %(prefixes)s
-            )
-            (  # start capture
-                [^\}\]\[=\|$\n]*?
-                %(suffixes)s
-            )  # end capture
-        """ % {'prefixes': prefixes, 'suffixes': suffixes}
-        logger.debug('ImageRule regexp: %s', imagematcher)
-        self.imagematcher = re.compile(imagematcher, flags=re.IGNORECASE | re.MULTILINE | re.VERBOSE)
-        self.extlinkmatcher = re.compile(r'https?://[^ \n]*?' + suffixes, flags=re.IGNORECASE)
-
-    def get_images(self, txt):
+        # Regexps matching images, by site, since the File: prefixes are localized
+        self.suffixes = r'\.(?:svg|png|jpe?g|gif|tiff)'
+        self.imagematchers = {}
+        self.extlinkmatcher = re.compile(r'https?://[^ \n]*?' + self.suffixes, flags=re.IGNORECASE)
+
+        # Uploaders and credit lines of the added files, shared by all users in the run
+        self.imageinfo = ImageInfoService()
+
+    def get_imagematcher(self, site):
+        """ Returns the regexp matching images at the site, using the localized File: prefixes of the site """
+        if site.key not in self.imagematchers:
+            prefixes = r'(?:%s)' % '|'.join(['%s:' % x for x in sorted(set(site.file_prefixes))])
+            imagematcher = r"""
+                (?:
+                    (?:=|\||^)%(prefixes)s?   # "=File:", "=", "|File:", "|", ...
+                    | %(prefixes)s
+                )
+                (  # start capture
+                    [^\}\]\[=\|$\n]*?
+                    %(suffixes)s
+                )  # end capture
+            """ % {'prefixes': prefixes, 'suffixes': self.suffixes}
+            logger.debug('ImageRule regexp for %s: %s', site.key, imagematcher)
+            self.imagematchers[site.key] = re.compile(imagematcher, flags=re.IGNORECASE | re.MULTILINE | re.VERBOSE)
+        return self.imagematchers[site.key]
+
+    def get_images(self, txt, imagematcher):
         txt = self.extlinkmatcher.sub('', txt)  # remove external links to images
         # return len(re.findall(imagematcher, txt, flags=re.IGNORECASE))
-        for img in self.imagematcher.finditer(txt):
+        for img in imagematcher.finditer(txt):
             yield img.group(1).strip()
 
-    @staticmethod
-    def get_image_uploader(rev, filename):
-        try:
-            image = rev.article().site().images[filename]
-        except InvalidPageTitle:
-            logger.error('Image filename "%s" is invalid, ignoring this file', filename)
-            return
-        imageinfo = image.imageinfo
-        if len(imageinfo) > 0:  # seems like image.exists only checks locally
-            try:
-                uploader = imageinfo['user']
-            except KeyError:
-                logger.error("Could not locate user for file '%s' in rev. %s ",
-                             filename, rev.revid)
-                return
+    def get_image_changes(self, rev):
+        """ Returns the images in the parent revision and the set of images added in the revision """
+        # The image list depends on the file prefixes, so a digest of the pattern is part of the cache key
+        imagematcher = self.get_imagematcher(rev.article().site())
+        pattern_digest = hashlib.blake2b(imagematcher.pattern.encode('utf-8'), digest_size=8).hexdigest()
+
+        def get_images(txt, pattern_digest):
+            return tuple(self.get_images(txt, imagematcher))
+
+        imgs_before = list(rev.parenttext_feature('images', get_images, pattern_digest))
+        imgs_after = list(rev.text_feature('images', get_images, pattern_digest))
+        return imgs_before, set(imgs_after).difference(set(imgs_before))
+
+    def prefetch(self, revisions, cache=None):
+        self.imageinfo.cache = cache
+        filenames = {}
+        for rev in revisions:
+            site = rev.article().site()
+            if not site.host.endswith(('wikipedia.org', 'wikibooks.org')):
+                continue
+            added = self.get_image_changes(rev)[1]
+            for filename in added:
+                filenames.setdefault(site.key, (site, set()))[1].add(urllib.parse.unquote(filename))
 
-            logger.debug("File '%s' uploaded by '%s', revision made by '%s'",
-                         filename, uploader, rev.username)
-            return uploader
-
-    @staticmethod
-    def get_image_credit(rev, filename):
-        credit = ''
-        extrainfo = rev.article().site().api('query', prop='imageinfo', titles=u'File:{}'.format(filename),
-                                             iiprop='extmetadata')
-        try:
-            for pageid, page in extrainfo['query']['pages'].items():
-                credit = page['imageinfo'][0]['extmetadata']['Credit']['value']
-        except KeyError:
-            logger.debug("Could not read credit info for file '%s'", filename)
-
-        return credit
+        for site, site_filenames in filenames.values():
+            self.imageinfo.prefetch(site, site_filenames)
 
     @family('wikipedia.org', 'wikibooks.org')
     def test(self, rev):
-        imgs_before = list(self.get_images(rev.parenttext))
-        imgs_after = list(self.get_images(rev.text))
-        added = set(imgs_after).difference(set(imgs_before))
+        imgs_before, added = self.get_image_changes(rev)
 
         if len(added) == 0:
             return
@@ -103,13 +102,15 @@ class ImageRule(Rule):
         counters = {'ownwork': [], 'own': [], 'other': []}
         for filename in added:
             filename = urllib.parse.unquote(filename)
-            uploader = self.get_image_uploader(rev, filename)
-            if uploader is None:
+            info = self.imageinfo.get(rev.article().site(), filename)
+            if info is None:
                 logger.warning("File '%s' does not exist or is invalid", filename)
                 continue
 
-            if uploader == rev.username:
-                credit = self.get_image_credit(rev, filename)
+            logger.debug("File '%s' uploaded by '%s', revision made by '%s'",
+                         filename, info['user'], rev.username)
+            if info['user'] == rev.username:
+                credit = info['credit']
 
                 if 'int-own-work' in credit or 'Itse otettu valokuva' in credit:
                     logger.debug("File '%s' identified as own work.", filename)
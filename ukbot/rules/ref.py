@@ -64,8 +64,8 @@ class RefRule(Rule):
     @family('wikipedia.org', 'wikibooks.org')
     def test(self, rev):
 
-        s1, r1 = self.count_sources(rev.parenttext)
-        s2, r2 = self.count_sources(rev.text)
+        s1, r1 = rev.parenttext_feature('sources', self.count_sources)
+        s2, r2 = rev.text_feature('sources', self.count_sources)
 
         sources_added = s2 - s1
         refs_added = r2 - r1
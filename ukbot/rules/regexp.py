@@ -27,8 +27,14 @@ class RegexpRule(Rule):
         return False
 
     def test(self, rev):
-        had_pattern = self.has_pattern(rev.parenttext)
-        has_pattern = self.has_pattern(rev.text)
+        patterns = tuple(pattern.pattern for pattern in self.patterns)
+
+        def match(txt, patterns):
+            # patterns is only part of the cache key, the compiled self.patterns are used for matching
+            return self.has_pattern(txt)
+
+        had_pattern = rev.parenttext_feature('has_pattern', match, patterns)
+        has_pattern = rev.text_feature('has_pattern', match, patterns)
 
         if has_pattern and not had_pattern:
             self.total += 1
@@ -36,6 +36,15 @@ class Rule(object):
             lst.append(tmp[param])
         return lst
 
+    def prefetch(self, revisions, cache=None):
+        """
+        Called with all the revisions of a user that the rule applies to before test()
+        is called for each of them, so that data needed by the rule can be fetched in bulk.
+
+            cache: KeyValueCache, optional
+        """
+        pass
+
     @property
     def maxpoints(self):
         return self.get_param('maxpoints', datatype=float)
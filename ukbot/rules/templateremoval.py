@@ -1,6 +1,9 @@
 # encoding=utf-8
 # vim: fenc=utf-8 et sw=4 ts=4 sts=4 ai
 import logging
+import re
+
+from mwtemplates import TemplateEditor
 
 from ..common import _
 from ..contributions import UserContribution
@@ -57,19 +60,24 @@ class TemplateRemovalRule(Rule):
                 return True
         return False
 
-    def count_instances(self, template, parsed_text):
-        """Count the number of instances of a template in a given text."""
-        tc = 0
+    @staticmethod
+    def get_template_titles(text):
+        """Return the titles of all the templates used in a given text."""
+        parsed_text = TemplateEditor(re.sub('<nowiki ?/>', '', text))
+        titles = []
         for node in parsed_text.templates.doc.findall('.//template'):
             for elem in node:
                 if (elem.tag == 'title') and (elem.text is not None):
-                    if self.matches_template(template, elem.text.strip()):
-                        tc += 1
-        return tc
+                    titles.append(elem.text.strip())
+        return tuple(titles)
+
+    def count_instances(self, template, titles):
+        """Count the number of instances of a template in a list of template titles."""
+        return len([title for title in titles if self.matches_template(template, title)])
 
     def get_templates_removed(self, template, rev):
-        pt = self.count_instances(template, rev.te_parenttext())
-        ct = self.count_instances(template, rev.te_text())
+        pt = self.count_instances(template, rev.parenttext_feature('template_titles', self.get_template_titles))
+        ct = self.count_instances(template, rev.text_feature('template_titles', self.get_template_titles))
         return pt - ct
 
     @family('wikipedia.org', 'wikibooks.org')
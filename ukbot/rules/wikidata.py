@@ -3,7 +3,6 @@
 import re
 import json
 import logging
-from jsonpath_rw import parse
 from ..common import _
 from ..contributions import UserContribution
 from .rule import Rule
@@ -24,6 +23,9 @@ class WikidataRule(Rule):
 
         Rule.__init__(self, sites, params, trans)
 
+        # Imported here since it's only needed for Wikidata contests
+        from jsonpath_rw import parse
+
         self.labels = self.get_param('labels', datatype=list, default=[])
         self.labels = [re.sub('[^a-z-]', '', x.lower()) for x in self.labels]
 
@@ -4,11 +4,11 @@ import logging
 import re
 import os
 import mwclient
-from requests import Session
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
 from requests_oauthlib import OAuth1
 
+from . import transport
+from .util import load_cached_json
+
 
 logger = logging.getLogger(__name__)
 
@@ -17,17 +17,18 @@ class Site(mwclient.Site):
 
     key = None
 
-    def __init__(self, host, prefixes, **kwargs):
-        session = Session()
-        retries = Retry(total=5, backoff_factor=1, status_forcelist=[502, 503, 504])
-        session.mount('https://', HTTPAdapter(max_retries=retries))
-
+    def __init__(self, host, prefixes, cache_ttl=0, **kwargs):
+        """
+            host: hostname of the wiki
+            prefixes: interwiki prefixes of the wiki
+            cache_ttl: seconds to keep the site info in the cache dir, 0 to always fetch it
+        """
+        # All the wikis share one session, and thereby the connection pools
         consumer_token = os.getenv('MW_CONSUMER_TOKEN')
         consumer_secret = os.getenv('MW_CONSUMER_SECRET')
         access_token = os.getenv('MW_ACCESS_TOKEN')
         access_secret = os.getenv('MW_ACCESS_SECRET')
-        session.auth = OAuth1(consumer_token, consumer_secret, access_token, access_secret)
-        session.headers['User-Agent'] = 'UKBot (http://tools.wmflabs.org/ukbot/; danmichaelo+wikipedia@gmail.com)'
+        session = transport.get_session('wikis', OAuth1(consumer_token, consumer_secret, access_token, access_secret))
 
         self.errors = []
         self.name = host
@@ -36,8 +37,14 @@ class Site(mwclient.Site):
         logger.debug('Initializing site: %s', host)
         mwclient.Site.__init__(self, host, pool=session, **kwargs)
 
-        res = self.api('query', meta='siteinfo',
-                        siprop='general|magicwords|namespaces|namespacealiases|interwikimap')['query']
+        def fetch_siteinfo():
+            return self.api('query', meta='siteinfo',
+                            siprop='general|magicwords|namespaces|namespacealiases|interwikimap')['query']
+
+        if cache_ttl > 0:
+            res = load_cached_json('siteinfo-%s.json' % host, cache_ttl, fetch_siteinfo)
+        else:
+            res = fetch_siteinfo()
 
         self.dbname = res.get('general', {}).get('dbname')
 
@@ -1,11 +1,14 @@
 # encoding=utf-8
 # vim: fenc=utf-8 et sw=4 ts=4 sts=4 ai
 import logging
+import threading
+from collections.abc import Mapping
 from fnmatch import fnmatch
-import requests
 from .common import _, InvalidContestPage
 from .db import db_conn
 from .site import WildcardPage, Site
+from . import transport
+from .util import load_cached_json
 
 logger = logging.getLogger(__name__)
 
@@ -23,10 +26,7 @@ def fetch_interwikimap():
         'iwurl': 1,
         'wiki': 'metawiki',
     }
-    headers = {
-        'User-Agent': 'UKBot (https://tools.wmflabs.org/ukbot/)',
-    }
-    resp = requests.get(WIKIMEDIA_API_URL, params=params, headers=headers, timeout=10)
+    resp = transport.get_session().get(WIKIMEDIA_API_URL, params=params, timeout=10)
     resp.raise_for_status()
     data = resp.json()
     return {
@@ -35,20 +35,64 @@ def fetch_interwikimap():
     }
 
 
+class LazySites(Mapping):
+    """
+    Dictionary {key: Site} where each Site is initialized on first access, since
+    initializing a site takes a few requests, and most contests only need a few
+    of the sites that the othersites patterns match.
+    """
+
+    def __init__(self, prefixes, sites=None, **site_kwargs):
+        """
+        :param prefixes: (dict) Dictionary {key: list of interwiki prefixes} of all the sites
+        :param sites: (dict) Dictionary {key: Site} of sites that are already initialized
+        :param site_kwargs: Extra arguments for the Site constructor
+        """
+        self.prefixes = prefixes
+        self.loaded = dict(sites or {})
+        self.site_kwargs = site_kwargs
+        self.lock = threading.Lock()  # Sites may be first used from the ingestion threads
+
+    def __getitem__(self, key):
+        if key not in self.loaded:
+            if key not in self.prefixes:
+                raise KeyError(key)
+            with self.lock:
+                if key not in self.loaded:
+                    self.loaded[key] = Site(key, prefixes=self.prefixes[key], **self.site_kwargs)
+        return self.loaded[key]
+
+    def __contains__(self, key):
+        return key in self.prefixes
+
+    def __iter__(self):
+        return iter(self.prefixes)
+
+    def __len__(self):
+        return len(self.prefixes)
+
+
 class SiteManager(object):
 
     def __init__(self, sites, homesite):
         """
 
-        :param sites: (dict) Dictionary {key: Site} of sites, including the homesite
+        :param sites: (dict) Dictionary {key: Site} of sites, including the homesite.
+            Use a LazySites dictionary to initialize the sites only when they are used.
         :param homesite: (Site)
         """
+        if not isinstance(sites, LazySites):
+            sites = LazySites({key: site.prefixes for key, site in sites.items()}, sites)
         self.sites = sites
         self.homesite = homesite
 
     def keys(self):
         return self.sites.keys()
 
+    def initialized_sites(self):
+        """ Returns the sites that have been used so far, without initializing the others """
+        return list(self.sites.loaded.values())
+
     def items(self):
         return self.sites.items()
 
@@ -100,9 +144,10 @@ class SiteManager(object):
         :param raise_on_error: Throw error if site not found, otherwise return None
         :return: Site
         """
-        for site in self.sites.values():
-            if site.match_prefix(key):
-                return site
+        # Check the prefixes before initializing any site
+        for site_key, prefixes in self.sites.prefixes.items():
+            if key in prefixes or key == site_key:
+                return self.sites[site_key]
         if raise_on_error:
             raise InvalidContestPage(_('Could not find a site matching the prefix "%(key)s"') % {
                 'key': key
@@ -117,13 +162,19 @@ def init_sites(config):
     if 'ignoreTags' not in config:
         config['ignoreTags'] = []
 
+    # Site info and the interwiki map rarely change, so they are cached on disk
+    cache_ttl = float(config.get('siteinfo_cache_ttl', 0)) * 3600
+
     # Configure home site (where the contests live)
     host = config['homesite']
-    homesite = Site(host, prefixes=[''])
+    homesite = Site(host, prefixes=[''], cache_ttl=cache_ttl)
 
     assert homesite.logged_in
 
-    iwmap = fetch_interwikimap()
+    if cache_ttl > 0:
+        iwmap = load_cached_json('interwikimap.json', cache_ttl, fetch_interwikimap)
+    else:
+        iwmap = fetch_interwikimap()
     homesite.interwikimap = iwmap
     prefixes = [''] + [k for k, v in iwmap.items() if v == host]
     homesite.prefixes = prefixes
@@ -132,21 +183,23 @@ def init_sites(config):
     sql = db_conn()
     logger.debug('Connected to database')
 
-    sites = {homesite.host: homesite}
+    # The other sites are initialized when they are first used
+    site_prefixes = {homesite.host: homesite.prefixes}
     if 'othersites' in config:
         for pattern in config['othersites']:
             matched = False
             for host in set(iwmap.values()):
                 if fnmatch(host, pattern):
                     matched = True
-                    if host not in sites:
-                        prefixes = [k for k, v in iwmap.items() if v == host]
-                        sites[host] = Site(host, prefixes=prefixes)
+                    if host not in site_prefixes:
+                        site_prefixes[host] = [k for k, v in iwmap.items() if v == host]
             if not matched:
                 if any(ch in pattern for ch in '*?'):
                     logger.warning('No othersites matched pattern "%s"', pattern)
                 else:
-                    prefixes = [k for k, v in iwmap.items() if v == pattern]
-                    sites[pattern] = Site(pattern, prefixes=prefixes)
+                    site_prefixes[pattern] = [k for k, v in iwmap.items() if v == pattern]
+
+    sites = LazySites(site_prefixes, {homesite.host: homesite}, cache_ttl=cache_ttl)
+    logger.info('%d sites configured', len(sites))
 
     return SiteManager(sites, homesite), sql
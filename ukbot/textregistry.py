@@ -0,0 +1,86 @@
+# encoding=utf-8
+# vim: fenc=utf-8 et sw=4 ts=4 sts=4 ai
+"""
+Run-scoped registry of the revision texts fetched from the wikis, shared by all
+the participants of a contest.
+
+In collaborative contests, one participant's parent revision is often another
+participant's revision, which has already been fetched in the same run. The
+registry serves such texts without another API request, and remembers which
+texts have been written to the text store, so each is only written once.
+The registry is bounded by the estimated memory used by the texts, and the
+least recently used texts are evicted first.
+"""
+import logging
+import sys
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class TextRegistry(object):
+
+    def __init__(self, max_bytes=200 * 1000 * 1000):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # (site key, revid) -> (text, size in bytes from the API)
+        self.size = 0
+        self.saved = set()  # (site key, revid) of the texts written to the text store in this run
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.skipped_writes = 0
+
+    def add(self, site_key, revid, text, size):
+        if not revid or not text:
+            # An empty text is treated as missing, like in the text store
+            return
+        key = (site_key, revid)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return
+            self.entries[key] = (text, size)
+            self.size += sys.getsizeof(text)
+            while self.size > self.max_bytes and len(self.entries) > 0:
+                _, (old_text, _) = self.entries.popitem(last=False)
+                self.size -= sys.getsizeof(old_text)
+
+    def get_many(self, site_key, revids):
+        """ Returns a dict of revid -> (text, size) for the given revisions that are known """
+        found = {}
+        with self.lock:
+            for revid in revids:
+                key = (site_key, revid)
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    found[revid] = self.entries[key]
+            self.hits += len(found)
+            self.misses += len(revids) - len(found)
+        return found
+
+    def get(self, site_key, revid):
+        """ Returns (text, size) for the revision, or None if it is not known """
+        return self.get_many(site_key, [revid]).get(revid)
+
+    def unsaved(self, rows):
+        """
+        Yields the (revid, site key, text) rows that have not been written to the text
+        store in this run yet, and marks them as written.
+        """
+        for row in rows:
+            key = (row[1], row[0])
+            with self.lock:
+                if key in self.saved:
+                    self.skipped_writes += 1
+                    continue
+                if row[0] and row[2]:
+                    self.saved.add(key)
+            yield row
+
+    def log_stats(self):
+        total = self.hits + self.misses
+        if total > 0:
+            logger.info('Text registry: %d hits, %d misses (%.0f %% hit rate), %d writes skipped, %d texts, %.1f MB',
+                        self.hits, self.misses, 100. * self.hits / total, self.skipped_writes,
+                        len(self.entries), self.size / 1e6)
@@ -0,0 +1,346 @@
+# encoding=utf-8
+# vim: fenc=utf-8 et sw=4 ts=4 sts=4 ai
+"""
+Compressed, content-addressed store for revision texts.
+
+Each distinct text is stored once in the `textblobs` table, zlib-compressed and
+keyed by its SHA-1. The `revtexts` table maps (revid, site) to a blob. A parent
+revision shared by several contributions, or a revert to an earlier version,
+therefore costs only one small row.
+
+Usage:
+    ukbot-textstore migrate     Create the new tables, and copy the texts from the old `fulltexts` table
+    ukbot-textstore benchmark   Compare size and read throughput with `fulltexts`
+"""
+import argparse
+import hashlib
+import logging
+import random
+import sys
+import time
+import zlib
+
+from .db import db_conn, result_iterator
+
+logger = logging.getLogger(__name__)
+
+COMPRESSION_LEVEL = 6
+
+# The tables added since the `fulltexts` table, created by `migrate` if they don't exist.
+# Keep in sync with db/init.sql.
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS `textblobs` (
+      `sha1` char(40) CHARACTER SET ascii NOT NULL,
+      `len` int(11) unsigned NOT NULL,
+      `data` mediumblob NOT NULL,
+      PRIMARY KEY (`sha1`)
+    ) ENGINE=MyISAM DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_bin
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS `revtexts` (
+      `revid` int(11) unsigned NOT NULL,
+      `site` varchar(50) COLLATE utf8mb4_bin NOT NULL,
+      `sha1` char(40) CHARACTER SET ascii NOT NULL,
+      PRIMARY KEY (`revid`,`site`) USING BTREE,
+      KEY `sha1` (`sha1`)
+    ) ENGINE=MyISAM DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_bin
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS `revmetrics` (
+      `revid` int(11) unsigned NOT NULL,
+      `site` varchar(50) COLLATE utf8mb4_bin NOT NULL,
+      `version` int(4) unsigned NOT NULL,
+      `metrics` mediumtext COLLATE utf8mb4_bin NOT NULL,
+      PRIMARY KEY (`revid`,`site`) USING BTREE
+    ) ENGINE=MyISAM DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_bin
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS `kvcache` (
+      `namespace` varchar(50) CHARACTER SET ascii NOT NULL,
+      `hash` char(40) CHARACTER SET ascii NOT NULL,
+      `value` mediumtext COLLATE utf8mb4_bin NOT NULL,
+      `expires` int(11) unsigned NOT NULL,
+      PRIMARY KEY (`namespace`,`hash`),
+      KEY `expires` (`expires`)
+    ) ENGINE=MyISAM DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_bin
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS `sync_cursors` (
+      `contestsite` varchar(50) COLLATE utf8_bin NOT NULL,
+      `contest` varchar(100) COLLATE utf8_bin NOT NULL,
+      `user` varchar(100) COLLATE utf8_bin NOT NULL,
+      `site` varchar(50) COLLATE utf8_bin NOT NULL,
+      `window_start` datetime NOT NULL,
+      `last_timestamp` datetime NOT NULL,
+      `last_revid` int(11) unsigned NOT NULL,
+      `full_sync_at` datetime NOT NULL,
+      PRIMARY KEY (`contestsite`,`contest`,`user`,`site`)
+    ) ENGINE=MyISAM DEFAULT CHARSET=utf8 COLLATE=utf8_bin
+    """,
+]
+
+
+def compress(text):
+    return zlib.compress(text.encode('utf-8'), COMPRESSION_LEVEL)
+
+
+def decompress(data):
+    return zlib.decompress(data).decode('utf-8')
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+# Empty texts stored before they were skipped by TextStore.save are treated as missing
+EMPTY_SHA1 = text_hash('')
+
+
+class TextStore(object):
+
+    def __init__(self, sql):
+        self.sql = sql
+
+    def save(self, rows, chunk_size=500, chunk_bytes=4 * 1000 * 1000):
+        """
+        Store revision texts. The rows are consumed lazily and written in chunks of at
+        most `chunk_size` revisions or `chunk_bytes` bytes of compressed text.
+
+            rows : iterable of (revid, site key, text) tuples
+
+        Returns the number of revisions stored.
+        """
+        seen_blobs = set()
+        seen_refs = set()
+        blobs = []
+        refs = []
+        pending_bytes = 0
+        nblobs = 0
+        nrefs = 0
+        nbytes = 0
+        cur = None
+        t0 = time.time()
+
+        for revid, site_key, text in rows:
+            if not revid or not text:
+                # Revision id 0 is the "parent" of a new page. An empty text is treated as missing
+                # (failed or skipped fetch, deleted revision), so it can be backfilled later.
+                continue
+            if (revid, site_key) in seen_refs:
+                continue
+            seen_refs.add((revid, site_key))
+            sha1 = text_hash(text)
+            if sha1 not in seen_blobs:
+                seen_blobs.add(sha1)
+                data = compress(text)
+                blobs.append((sha1, len(text), data))
+                pending_bytes += len(data)
+                nblobs += 1
+                nbytes += len(data)
+            refs.append((revid, site_key, sha1))
+            nrefs += 1
+            if len(refs) >= chunk_size or pending_bytes >= chunk_bytes:
+                cur = cur or self.sql.cursor()
+                self.write_chunk(cur, blobs, refs)
+                blobs, refs, pending_bytes = [], [], 0
+
+        if nrefs == 0:
+            return 0
+        cur = cur or self.sql.cursor()
+        self.write_chunk(cur, blobs, refs)
+        self.sql.commit()
+        cur.close()
+
+        dt = max(time.time() - t0, 1e-6)
+        logger.info('Stored %d revision texts (%d distinct, %.1f MB compressed) in %.2f secs (%.0f rows/sec, %.1f MB/sec)',
+                    nrefs, nblobs, nbytes / 1e6, dt, nrefs / dt, nbytes / dt / 1e6)
+        return nrefs
+
+    @staticmethod
+    def write_chunk(cur, blobs, refs):
+        if len(blobs) > 0:
+            cur.executemany("""
+                insert ignore into textblobs (sha1, len, data)
+                values (%s,%s,%s)
+                """, blobs
+            )
+        if len(refs) > 0:
+            cur.executemany("""
+                insert into revtexts (revid, site, sha1)
+                values (%s,%s,%s)
+                on duplicate key update sha1=values(sha1)
+                """, refs
+            )
+
+    def existing(self, keys):
+        """
+        Returns the subset of the given (revid, site key) tuples that have a stored text
+        """
+        keys = list(keys)
+        found = set()
+        cur = self.sql.cursor()
+        chunk_size = 1000
+        for n in range(0, len(keys), chunk_size):
+            chunk = keys[n:n + chunk_size]
+            cur.execute(
+                'SELECT revid, site FROM revtexts WHERE (revid, site) IN (' + ','.join(['(%s,%s)'] * len(chunk)) + ') '
+                'AND sha1 != %s',
+                [x for key in chunk for x in key] + [EMPTY_SHA1]
+            )
+            for revid, site_key in result_iterator(cur):
+                found.add((revid, site_key))
+        cur.close()
+        return found
+
+    def load(self, site_key, revids):
+        """ Returns a dict of revid -> text for the given revisions that are stored """
+        return {revid: decompress(data) for revid, data in self.load_compressed(site_key, revids).items()}
+
+    def load_compressed(self, site_key, revids):
+        """
+        Returns a dict of revid -> compressed text for the given revisions that are stored.
+        Empty texts are left out, so the revisions are backfilled.
+        """
+        revids = list(revids)
+        texts = {}
+        cur = self.sql.cursor()
+        chunk_size = 1000
+        for n in range(0, len(revids), chunk_size):
+            chunk = revids[n:n + chunk_size]
+            cur.execute(
+                'SELECT rt.revid, tb.data FROM revtexts AS rt '
+                'JOIN textblobs AS tb ON tb.sha1 = rt.sha1 '
+                'WHERE rt.site=%s AND rt.revid IN (' + ','.join(['%s'] * len(chunk)) + ') AND rt.sha1 != %s',
+                [site_key] + chunk + [EMPTY_SHA1]
+            )
+            for revid, data in result_iterator(cur):
+                texts[revid] = data
+        cur.close()
+        return texts
+
+
+def create_tables(cur):
+    """ Create the tables that don't exist yet. Existing tables are left untouched. """
+    for statement in SCHEMA:
+        cur.execute(statement)
+
+
+def table_exists(cur, table):
+    cur.execute(
+        'SELECT COUNT(*) FROM information_schema.TABLES WHERE table_schema = DATABASE() AND table_name = %s',
+        [table]
+    )
+    return cur.fetchone()[0] > 0
+
+
+def migrate(sql, batch_size=1000, drop=False):
+    """
+    Upgrade an existing database: create the new tables and copy all texts from the
+    old fulltexts table, if there is one, into the text store. Safe to run again.
+    """
+    store = TextStore(sql)
+    cur = sql.cursor()
+    create_tables(cur)
+    sql.commit()
+    if not table_exists(cur, 'fulltexts'):
+        logger.info('Created the new tables. There is no fulltexts table to migrate.')
+        cur.close()
+        return
+
+    t0 = time.time()
+    nrows = 0
+    last = (0, '')
+    while True:
+        cur.execute(
+            'SELECT revid, site, revtxt FROM fulltexts WHERE (revid, site) > (%s, %s) '
+            'ORDER BY revid, site LIMIT %s',
+            [last[0], last[1], batch_size]
+        )
+        rows = cur.fetchall()
+        if len(rows) == 0:
+            break
+        store.save(rows)
+        nrows += len(rows)
+        last = (rows[-1][0], rows[-1][1])
+        logger.info('Migrated %d texts (%.0f texts/sec)', nrows, nrows / (time.time() - t0))
+
+    if drop:
+        cur.execute('DROP TABLE fulltexts')
+        logger.info('Dropped the fulltexts table')
+    cur.close()
+    logger.info('Migrated %d texts in %.1f secs', nrows, time.time() - t0)
+
+
+def table_size(cur, tables):
+    cur.execute(
+        'SELECT SUM(data_length + index_length) FROM information_schema.TABLES '
+        'WHERE table_schema = DATABASE() AND table_name IN (' + ','.join(['%s'] * len(tables)) + ')',
+        tables
+    )
+    return int(cur.fetchone()[0] or 0)
+
+
+def benchmark(sql, samples=5000, batch_size=500):
+    """ Compare the size and read throughput of the text store and the old fulltexts table """
+    cur = sql.cursor()
+
+    old_size = table_size(cur, ['fulltexts'])
+    new_size = table_size(cur, ['textblobs', 'revtexts'])
+    print('fulltexts           : %8.1f MB' % (old_size / 1e6))
+    print('textblobs, revtexts : %8.1f MB (%.1f %% of fulltexts)' % (new_size / 1e6, 100. * new_size / max(old_size, 1)))
+
+    cur.execute('SELECT revid, site FROM revtexts')
+    keys = cur.fetchall()
+    keys = random.sample(keys, min(samples, len(keys)))
+    by_site = {}
+    for revid, site_key in keys:
+        by_site.setdefault(site_key, []).append(revid)
+
+    def old_read(site_key, revids):
+        cur.execute(
+            'SELECT revid, revtxt FROM fulltexts WHERE site=%s AND revid IN (' + ','.join(['%s'] * len(revids)) + ')',
+            [site_key] + revids
+        )
+        return {row[0]: row[1] for row in cur.fetchall()}
+
+    store = TextStore(sql)
+    for name, read in [('fulltexts', old_read), ('text store', store.load)]:
+        t0 = time.time()
+        ntexts = 0
+        nbytes = 0
+        for site_key, revids in by_site.items():
+            for n in range(0, len(revids), batch_size):
+                texts = read(site_key, revids[n:n + batch_size])
+                ntexts += len(texts)
+                nbytes += sum(len(text) for text in texts.values())
+        dt = max(time.time() - t0, 1e-6)
+        print('%-20s: read %d texts in %.2f secs (%.0f texts/sec, %.1f MB/sec)' % (name, ntexts, dt, ntexts / dt, nbytes / dt / 1e6))
+    cur.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the UKBot revision text store')
+    subparsers = parser.add_subparsers(dest='command')
+
+    migrate_parser = subparsers.add_parser('migrate', help='Create the new tables and copy texts from the fulltexts table into the text store')
+    migrate_parser.add_argument('--batch-size', type=int, default=1000)
+    migrate_parser.add_argument('--drop', action='store_true', help='Drop the fulltexts table afterwards')
+
+    benchmark_parser = subparsers.add_parser('benchmark', help='Compare the text store with the fulltexts table')
+    benchmark_parser.add_argument('--samples', type=int, default=5000, help='Number of revisions to read')
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    if args.command == 'migrate':
+        migrate(db_conn(), args.batch_size, args.drop)
+    elif args.command == 'benchmark':
+        benchmark(db_conn(), args.samples)
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+# encoding=utf-8
+# vim: fenc=utf-8 et sw=4 ts=4 sts=4 ai
+"""
+Shared HTTP sessions for all the API clients: the wikis, the Wikidata query
+service and the global APIs on Meta.
+
+Each session keeps a pool of keep-alive connections per host, and retries failed
+requests with backoff, honouring Retry-After. MediaWiki maxlag responses are left
+to mwclient, which waits and retries them itself, so they are only counted here.
+The number of requests and their latency are recorded per host and logged at the
+end of the run with stats.log_stats().
+"""
+import bisect
+import logging
+import threading
+import time
+import urllib.parse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+USER_AGENT = 'UKBot (https://tools.wmflabs.org/ukbot/; danmichaelo+wikipedia@gmail.com)'
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1., 2.5, 5., 10., float('inf')]
+
+
+class HostStats(object):
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.lag_responses = 0
+        self.total_time = 0.
+        self.histogram = [0] * len(LATENCY_BUCKETS)
+
+    def percentile(self, p):
+        """ Returns the upper bound of the latency bucket containing the p-th percentile """
+        threshold = p / 100. * self.requests
+        count = 0
+        for bound, n in zip(LATENCY_BUCKETS, self.histogram):
+            count += n
+            if count >= threshold:
+                return bound
+        return LATENCY_BUCKETS[-1]
+
+
+class TransportStats(object):
+
+    def __init__(self):
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def get(self, host):
+        if host not in self.hosts:
+            self.hosts[host] = HostStats()
+        return self.hosts[host]
+
+    def record(self, host, elapsed, status=None):
+        """ Record a request. status is None if the request failed without a response """
+        with self.lock:
+            host_stats = self.get(host)
+            host_stats.requests += 1
+            host_stats.total_time += elapsed
+            host_stats.histogram[bisect.bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+            if status is None or status >= 400:
+                host_stats.errors += 1
+
+    def record_lag_response(self, host):
+        with self.lock:
+            self.get(host).lag_responses += 1
+
+    def log_stats(self):
+        with self.lock:
+            for host, s in sorted(self.hosts.items(), key=lambda x: x[1].requests, reverse=True):
+                logger.info('HTTP %s: %d requests in %.1f secs, %d errors, %d maxlag responses, '
+                            'latency p50 <= %s s, p95 <= %s s, histogram %s',
+                            host, s.requests, s.total_time, s.errors, s.lag_responses,
+                            s.percentile(50), s.percentile(95), s.histogram)
+
+
+stats = TransportStats()
+
+
+class Session(requests.Session):
+    """
+    A requests.Session that records the requests in `stats`, including the responses
+    with the X-Database-Lag header, sent by MediaWiki when the maxlag parameter is exceeded.
+    """
+
+    def __init__(self, pool_size=20, max_retries=5, backoff_factor=1.):
+        requests.Session.__init__(self)
+        # Retry-After is honoured for 429 and 503 responses. Only idempotent requests are retried,
+        # so edits are never sent twice.
+        retry = Retry(total=max_retries, backoff_factor=backoff_factor,
+                      status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=50, pool_maxsize=pool_size, max_retries=retry)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+        self.headers['User-Agent'] = USER_AGENT
+        self.headers['Accept-Encoding'] = 'gzip, deflate'
+
+    def request(self, method, url, *args, **kwargs):
+        host = urllib.parse.urlsplit(url).netloc
+        t0 = time.perf_counter()
+        try:
+            response = requests.Session.request(self, method, url, *args, **kwargs)
+        except requests.RequestException:
+            stats.record(host, time.perf_counter() - t0)
+            raise
+        stats.record(host, time.perf_counter() - t0, response.status_code)
+        if response.headers.get('X-Database-Lag') is not None:
+            # Retried by mwclient, which knows the request parameters
+            stats.record_lag_response(host)
+        return response
+
+
+_sessions = {}
+_lock = threading.Lock()
+
+
+def get_session(name='default', auth=None):
+    """
+    Returns the shared session with the given name, creating it on first use.
+    The wikis share one authenticated session, the other clients share the default one.
+    """
+    with _lock:
+        if name not in _sessions:
+            session = Session()
+            session.auth = auth
+            _sessions[name] = session
+        return _sessions[name]
@@ -6,11 +6,14 @@ runstart_s = time.time()
 print('Loading')
 
 import sys
+if '--profile-startup' in sys.argv:
+    # Start recording import times before anything else is imported
+    from . import profiling
+    profiling.install()
+
 import logging
-import matplotlib
 from datetime import datetime
 import pytz
-import json
 import os
 import argparse
 import mwclient
@@ -21,11 +24,11 @@ from importlib.metadata import version
 
 from .common import get_mem_usage, Localization, _, STATE_NORMAL, InvalidContestPage
 from .util import load_config
+from .analysis import analysis_cache
 from .contest import Contest
 from .contests import discover_contest_pages
 from .sites import init_sites
-
-matplotlib.use('svg')
+from . import transport
 
 __version__ = version('ukbot')
 
@@ -77,12 +80,7 @@ def process_contest(contest_page, contest_state, sites, sql, config, working_dir
         contest.uploadplot(args.simulate, args.output)
 
     elif args.action == 'plot':
-        filename = os.path.join(working_dir, config['plot']['datafile'] % {'year': contest.year,
-                                                                           'week': contest.startweek,
-                                                                           'month': contest.month})
-        with open(filename, 'r') as fp:
-            plotdata = json.load(fp)
-        contest.plot(plotdata)
+        contest.plot(contest.load_plotdata())
     else:
         contest.run(args.simulate, args.output)
 
@@ -98,8 +96,14 @@ def main():
     parser.add_argument('--close', action='store_true', help='Close contest')
     parser.add_argument('--action', nargs='?', default='', help='"uploadplot" or "run"')
     parser.add_argument('--job_id', required=False, help='Job ID')
+    parser.add_argument('--profile-startup', action='store_true', default=False,
+                        help='Print the import times and the time to the first API call')
     args = parser.parse_args()
 
+    if args.profile_startup:
+        from . import profiling
+        profiling.watch_first_request()
+
     if args.verbose:
         syslog.setLevel(logging.DEBUG)
     else:
@@ -109,6 +113,8 @@ def main():
     config['filename'] = args.config.name
     args.config.close()
 
+    analysis_cache.resize(config.get('analysis_cache_mb', 256) * 1024 * 1024)
+
     working_dir = os.path.realpath(os.getcwd())
     logger.info('Working dir: %s', working_dir)
 
@@ -173,6 +179,9 @@ def main():
                 if page.text() != txt and not args.simulate:
                     page.save(txt, summary=_('Redirecting to %s') % contest_name)
 
+    logger.info('Used %d of %d configured sites', len(sites.initialized_sites()), len(sites.keys()))
+    transport.stats.log_stats()
+
     runend = config['server_timezone'].localize(datetime.now())
     runend_s = time.time()
 
@@ -3,28 +3,156 @@
 import logging
 import re
 import time
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from copy import copy
 
 import pydash
 import weakref
 import numpy as np
-from datetime import datetime
+from datetime import datetime, timedelta
 import pytz
 import pymysql
-import requests
 from more_itertools import first
 
 from .contributions import UserContributions
 from .common import _
-from .db import result_iterator
-from .util import unix_time
+from .db import executemany_chunked, result_iterator
+from .util import unix_time, localtime_as_utc
 from .article import Article
-from .sites import WIKIMEDIA_API_URL
+from .batching import batch_length, batch_bytes
+from .globaluserinfo import hostnames
+from .textstore import TextStore
 
 logger = logging.getLogger(__name__)
 
 
+def revision_batch_size(site):
+    """ Number of revisions we can ask for in one API request """
+    if 'bot' in site.rights:
+        return site.api_limit         # API limit, should be 500
+    return 50
+
+
+def fetch_revisions(site, revids, props, apilim, sizes=None, budgets=None):
+    """
+    Fetch the given revisions in batches of at most `apilim` revisions, and yield the
+    pages returned by the API. If the content is fetched and the sizes of the revisions
+    are known, the batches are also limited by the byte budget for the site.
+    """
+    revids = list(revids)
+    rev_count = len(revids)
+    if 'content' not in props:
+        sizes = None
+    nr = 0
+    while nr < rev_count:
+        n = batch_length(revids[nr:], sizes, apilim, budgets.get(site.key) if budgets else None)
+        logger.info('Fetching revisions %d-%d of %d', nr + 1, nr + n, rev_count)
+        for page in fetch_revision_batch(site, revids[nr:nr + n], props, sizes, budgets):
+            yield page
+        nr += n
+
+
+def fetch_revision_batch(site, revids, props, sizes=None, budgets=None):
+    """
+    Fetch the given revisions in one API request and return the pages. If we run into
+    Manual:$wgAPIMaxResultSize, the revisions that were returned are kept and only the
+    rest are fetched again, in smaller batches.
+    """
+    res = site.api('query', prop='revisions', rvprop=props, revids='|'.join(str(r) for r in revids),
+                   rvslots='main', uselang='nb')
+    pages = list(res['query'].get('pages', {}).values())
+    if 'content' not in props:
+        sizes = None
+
+    if pydash.get(res, 'warnings.result.*') is None:
+        if budgets is not None and sizes is not None:
+            budgets.success(site.key, batch_bytes(revids, sizes))
+        return pages
+
+    returned = set(apirev['revid'] for page in pages for apirev in page.get('revisions', []))
+    bad = set(int(revid) for revid in res['query'].get('badrevids', {}).keys())
+    missing = [revid for revid in revids if int(revid) not in returned and int(revid) not in bad]
+    if len(missing) == 0:
+        return pages
+    if budgets is not None and sizes is not None:
+        budgets.overflow(site.key, batch_bytes([r for r in revids if int(r) in returned], sizes))
+
+    if len(returned) == 0:
+        if len(missing) == 1:
+            logger.warning('Revision %s is larger than wgAPIMaxResultSize', missing[0])
+            return pages
+        logger.warning('We ran into wgAPIMaxResultSize, splitting a batch of %d revisions', len(missing))
+        half = len(missing) // 2
+        return pages + fetch_revision_batch(site, missing[:half], props, sizes, budgets) \
+            + fetch_revision_batch(site, missing[half:], props, sizes, budgets)
+
+    logger.info('We ran into wgAPIMaxResultSize, got %d of %d revisions, fetching the rest',
+                len(returned), len(revids))
+    return pages + list(fetch_revisions(site, missing, props, len(missing), sizes, budgets))
+
+
+def fetch_revisions_with_parents(site, revids, props, parent_props, apilim, window,
+                                 handle_revisions, handle_parents, known_texts=(), sizes=None, budgets=None):
+    """
+    Fetch the given revisions and their parent revisions in batches of at most `apilim`
+    revisions, with up to `window` requests in flight at once. The revisions in
+    `known_texts` are fetched without their content. Batches with content are also
+    limited by the byte budget for the site, using the sizes in `sizes` (revid -> bytes).
+
+    handle_revisions(page) is called for each page returned for the revisions, and returns
+    the parent ids to fetch. It may add the expected sizes of the parents to `sizes`.
+    The parents are fetched as soon as a full batch has been queued, or when all the
+    revisions have been fetched. handle_parents(page) is called for each page returned
+    for the parent revisions. The handlers are only called from the calling thread.
+    """
+    rev_queues = deque([
+        ([r for r in revids if r not in known_texts], props),
+        ([r for r in revids if r in known_texts], props.replace('|content', '')),
+    ])
+    parent_queue = []
+    in_flight = {}  # future -> handler
+
+    if len(revids) == 0:
+        return
+
+    def next_batch(queue, batch_props):
+        max_bytes = budgets.get(site.key) if budgets is not None and 'content' in batch_props else None
+        n = batch_length(queue, sizes, apilim, max_bytes)
+        return queue[:n], queue[n:]
+
+    with ThreadPoolExecutor(max_workers=window, thread_name_prefix='revisions') as executor:
+        while len(rev_queues) > 0 or len(parent_queue) > 0 or len(in_flight) > 0:
+            while len(in_flight) < window:
+                while len(rev_queues) > 0 and len(rev_queues[0][0]) == 0:
+                    rev_queues.popleft()
+                revisions_pending = len(rev_queues) > 0 or handle_revisions in in_flight.values()
+                if len(parent_queue) > 0:
+                    batch, rest = next_batch(parent_queue, parent_props)
+                else:
+                    batch, rest = [], []
+                if len(rest) > 0 or len(batch) >= apilim or (len(batch) > 0 and not revisions_pending):
+                    parent_queue = rest
+                    in_flight[executor.submit(fetch_revision_batch, site, batch, parent_props, sizes, budgets)] = \
+                        handle_parents
+                elif len(rev_queues) > 0:
+                    queue, batch_props = rev_queues[0]
+                    batch, rest = next_batch(queue, batch_props)
+                    rev_queues[0] = (rest, batch_props)
+                    in_flight[executor.submit(fetch_revision_batch, site, batch, batch_props, sizes, budgets)] = \
+                        handle_revisions
+                else:
+                    break
+
+            done = wait(in_flight.keys(), return_when=FIRST_COMPLETED)[0]
+            for future in done:
+                handler = in_flight.pop(future)
+                for page in future.result():
+                    parentids = handler(page)
+                    if parentids:
+                        parent_queue.extend(parentids)
+
+
 class User:
 
     def __init__(self, username, contest):
@@ -36,6 +164,7 @@ class User:
         self.contributions = UserContributions(self, contest.config)
         self.disqualified_articles = []
         self.point_deductions = []
+        self.sync_cursors = {}
 
     def __del__(self):
         logger.info('Destructing %s', repr(self))
@@ -63,29 +192,18 @@ class User:
         return self.articles[article_key]
 
     def wikis_with_edits(self):
-        if hasattr(self, '_wikis_with_edits'):
-            return self._wikis_with_edits
-        params = {
-            'action': 'query',
-            'meta': 'globaluserinfo',
-            'guiuser': self.name,
-            'guiprop': 'merged',
-            'format': 'json',
-            'formatversion': 2,
-            'wiki': 'metawiki',
-        }
-        headers = {
-            'User-Agent': 'UKBot (https://tools.wmflabs.org/ukbot/)',
-        }
-        try:
-            resp = requests.get(WIKIMEDIA_API_URL, params=params, headers=headers, timeout=10)
-            resp.raise_for_status()
-            data = resp.json()
-            self._wikis_with_edits = {x['wiki'] for x in data['query']['globaluserinfo'].get('merged', [])}
-        except Exception as e:
-            logger.warning('Could not fetch globaluserinfo for %s: %s', self.name, e)
-            self._wikis_with_edits = None
-        return self._wikis_with_edits
+        """ Returns the database names of the wikis the user has an account on, or None if unknown """
+        accounts = self.contest().globaluserinfo.get(self.name)
+        if accounts is None:
+            return None
+        return {x['wiki'] for x in accounts}
+
+    def hosts_with_edits(self):
+        """ Returns the hostnames of the wikis the user has an account on, or None if unknown """
+        accounts = self.contest().globaluserinfo.get(self.name)
+        if accounts is None:
+            return None
+        return hostnames(accounts)
 
     def add_contribs_from_wiki(self, site, start, end, fulltext=False, **kwargs):
         """
@@ -99,13 +217,19 @@ class User:
 
         # logger.info('Reading contributions from %s', site.host)
 
-        apilim = 50
-        if 'bot' in site.rights:
-            apilim = site.api_limit         # API limit, should be 500
+        apilim = revision_batch_size(site)
 
         site_key = site.host
 
-        ts_start = start.astimezone(pytz.utc).strftime('%FT%TZ')
+        sync_started = datetime.utcnow().replace(microsecond=0)
+        window_start = start.astimezone(pytz.utc).replace(tzinfo=None)
+        since = self.incremental_sync_start(site, window_start, sync_started)
+
+        if since is None:
+            ts_start = start.astimezone(pytz.utc).strftime('%FT%TZ')
+        else:
+            ts_start = since.strftime('%FT%TZ')
+            logger.info('Fetching contributions to %s since %s (incremental sync)', site.key, ts_start)
         ts_end = end.astimezone(pytz.utc).strftime('%FT%TZ')
 
         # 1) Fetch user contributions
@@ -120,13 +244,21 @@ class User:
         new_revisions = []
         # stored_revisions = set(copy(self.revisions.keys()))
         stored_revisions = set([rev.revid for rev in self.revisions.values() if rev.article().site() == site])
+        if since is not None:
+            # Only the revisions after the cursor are listed, so we can only detect
+            # deletions among those. Older ones are checked by the full reconciliation.
+            since_ts = unix_time(pytz.utc.localize(since))
+            stored_revisions = set([revid for revid in stored_revisions if self.revisions[revid].timestamp >= since_ts])
         current_revisions = set()
+        sizes = {}  # revid -> size in bytes, used to pack the batches of revision texts
+        last_contrib = None
         t0 = time.time()
         t1 = time.time()
         tnr = 0
         n_articles = len(self.articles)
-        for c in site.usercontributions(self.name, ts_start, ts_end, 'newer', prop='ids|title|timestamp|comment|tags', **args):
+        for c in site.usercontributions(self.name, ts_start, ts_end, 'newer', prop='ids|title|timestamp|comment|tags|size', **args):
             tnr += 1
+            last_contrib = c
 
             dt1 = time.time() - t1
             if dt1 > 10:
@@ -165,6 +297,7 @@ class User:
                     rev = article.add_revision(rev_id, timestamp=time.mktime(c['timestamp']), username=self.name)
                     rev.saved = False  # New revision that should be stored in DB
                     new_revisions.append(rev)
+                    sizes[rev_id] = c.get('size', 0)
 
         # Check if revisions have been deleted
         logger.info('Site: %s, stored revisions: %d, current revisions: %d', site.key, len(stored_revisions), len(current_revisions))
@@ -204,101 +337,171 @@ class User:
         #        article_key = site_key + ':' + page['title']
         #        self.articles[article_key].redirect = ('redirect' in page.keys())
 
-        # 3) Fetch info about the new revisions: diff size, possibly content
+        # 3) Fetch info about the new revisions: diff size, possibly content, and
+        # 4) Fetch info about the parent revisions: diff size, possibly content
+        #    The parents of each batch of new revisions are queued as soon as the batch
+        #    has been parsed, and up to `revision_fetch_window` batches are fetched at once.
 
         props = 'ids|size|parsedcomment'
+        parent_props = 'ids|size'
         if fulltext:
             props += '|content'
-        revids = [str(r.revid) for r in new_revisions]
-        parentids = set()
+            parent_props += '|content'
         revs = set()
+        children = {}  # parentid -> rev
+        nr = 0
+        nknown = 0
 
-        cur_apilim = apilim
-
-        rev_count = len(revids)
-        while len(revids) > 0:
-            ids = '|'.join(revids[:cur_apilim])
-            logger.info('Fetching revisions %d-%d of %d', len(revs) + 1, min([len(revs) + cur_apilim, len(revids)]), rev_count)
-            res = site.api('query', prop='revisions', rvprop=props, revids=ids, rvslots='main', uselang='nb')
-            if pydash.get(res, 'warnings.result.*') is not None:
-                # We ran into Manual:$wgAPIMaxResultSize, try reducing
-                logger.warning('We ran into wgAPIMaxResultSize, reducing the batch size from %d to %d', cur_apilim, round(cur_apilim / 2))
-                cur_apilim = round(cur_apilim / 2)
-                continue
+        # Texts already fetched for other participants in this run
+        registry = self.contest().texts
+        known_texts = registry.get_many(site_key, [r.revid for r in new_revisions]) if fulltext else {}
 
-            for page in res['query']['pages'].values():
-                article_key = site_key + ':' + page['title']
-                for apirev in page['revisions']:
-                    rev = self.articles[article_key].revisions[apirev['revid']]
-                    rev.parentid = apirev['parentid']
-                    rev.size = apirev['size']
-                    rev.parsedcomment = apirev['parsedcomment']
-                    content = pydash.get(apirev, 'slots.main.*')
-                    if content is not None:
-                        rev.text = content
-                        rev.dirty = True
-                    if not rev.new:
-                        parentids.add(rev.parentid)
-                    revs.add(apirev['revid'])
-            revids = revids[cur_apilim:]
+        def handle_revisions(page):
+            nonlocal nknown
+            article_key = site_key + ':' + page['title']
+            parentids = []
+            for apirev in page['revisions']:
+                rev = self.articles[article_key].revisions[apirev['revid']]
+                rev.parentid = apirev['parentid']
+                rev.size = apirev['size']
+                rev.parsedcomment = apirev['parsedcomment']
+                content = pydash.get(apirev, 'slots.main.*')
+                if content is None and rev.revid in known_texts:
+                    content = known_texts[rev.revid][0]
+                if content is not None:
+                    rev.text = content
+                    rev.dirty = True
+                    registry.add(site_key, rev.revid, content, rev.size)
+                if not rev.new:
+                    known_parent = registry.get(site_key, rev.parentid)
+                    if known_parent is not None:
+                        nknown += 1
+                        rev.parentsize = known_parent[1]
+                        if fulltext:
+                            rev.parenttext = known_parent[0]
+                    else:
+                        children[rev.parentid] = rev
+                        sizes[rev.parentid] = rev.size  # The parent is usually about the same size
+                        parentids.append(rev.parentid)
+                revs.add(apirev['revid'])
+            return parentids
+
+        def handle_parents(page):
+            nonlocal nr
+            for apirev in page.get('revisions', []):
+                nr += 1
+                rev = children.get(apirev['revid'])
+                if rev is None:
+                    continue
+                rev.parentsize = apirev['size']
+                content = pydash.get(apirev, 'slots.main.*')
+                if content is None:
+                    logger.warning('Did not get revision text for %s', rev.article().name)
+                else:
+                    rev.parenttext = content
+                    registry.add(site_key, apirev['revid'], content, apirev['size'])
+                    logger.debug('Got revision text for %s: %d bytes', rev.article().name, len(rev.parenttext))
 
-        dt = time.time() - t0
-        t0 = time.time()
-        if len(revs) > 0:
-            logger.info('Checked %d revisions, found %d parent revisions in %.2f secs',
-                        len(revs), len(parentids), dt)
+        window = max(1, int(self.contest().config.get('revision_fetch_window', 1)))
+        fetch_revisions_with_parents(site, [r.revid for r in new_revisions], props, parent_props, apilim, window,
+                                     handle_revisions, handle_parents, known_texts, sizes,
+                                     self.contest().batch_budgets)
 
         if len(revs) != len(new_revisions):
             raise Exception('Expected %d revisions, but got %d' % (len(new_revisions), len(revs)))
 
-        # 4) Fetch info about the parent revisions: diff size, possibly content
+        if len(revs) > 0:
+            dt = time.time() - t0
+            logger.info('Checked %d revisions and %d parent revisions in %.2f secs (%d texts and %d parent revisions '
+                        'already fetched for other participants)', len(revs), nr, dt, len(known_texts), nknown)
+
+        # 5) Move the sync cursor forward. It is saved to the DB together with the contributions.
+
+        cursor = self.sync_cursors.get(site.key, {})
+        if last_contrib is not None:
+            cursor_timestamp = datetime(*last_contrib['timestamp'][:6])
+            cursor_revid = last_contrib['revid']
+        elif since is not None:
+            cursor_timestamp = cursor['timestamp']
+            cursor_revid = cursor['revid']
+        else:
+            cursor_timestamp = window_start
+            cursor_revid = 0
+        self.sync_cursors[site.key] = {
+            'window_start': window_start,
+            'timestamp': cursor_timestamp,
+            'revid': cursor_revid,
+            'full_sync_at': sync_started if since is None else cursor['full_sync_at'],
+            'dirty': True,
+        }
 
-        props = 'ids|size'
-        if fulltext:
-            props += '|content'
-        nr = 0
+    def incremental_sync_start(self, site, window_start, now):
+        """
+        Returns the timestamp (naive UTC) to continue fetching contributions from,
+        or None if all contributions since the contest start should be fetched.
 
-        parentids = [str(i) for i in parentids]
-        rev_count = len(parentids)
-        while len(parentids) > 0:
-            ids = '|'.join(parentids[:cur_apilim])
-            logger.info('Fetching revisions %d-%d of %d', nr + 1, min([nr + cur_apilim, len(parentids)]), rev_count)
-            res = site.api('query', prop='revisions', rvprop=props, revids=ids, rvslots='main', uselang='nb')
-            if pydash.get(res, 'warnings.result.*') is not None:
-                # We ran into Manual:$wgAPIMaxResultSize, try reducing
-                logger.warning('We ran into wgAPIMaxResultSize, reducing the batch size from %d to %d', cur_apilim, round(cur_apilim / 2))
-                cur_apilim = round(cur_apilim / 2)
-                continue
+        A full reconciliation is needed to detect deleted and moved revisions, and
+        revisions that have got one of the ignored tags after we stored them, so it is
+        done every `full_sync_interval` hours.
+        """
+        interval = float(self.contest().config.get('full_sync_interval', 0))
+        cursor = self.sync_cursors.get(site.key)
+        if interval <= 0 or cursor is None:
+            return None
+        if cursor['window_start'] != window_start:
+            # The contest start has been changed
+            return None
+        if now - cursor['full_sync_at'] >= timedelta(hours=interval):
+            logger.info('Last full sync of %s was at %s, doing a full sync', site.key, cursor['full_sync_at'].strftime('%F %T'))
+            return None
+
+        # The cursor timestamp is inclusive, since several edits can have the same timestamp
+        return cursor['timestamp']
+
+    def load_sync_cursors(self, sql):
+        """ Read the sync cursors saved by save_sync_cursors """
+        contest = self.contest()
+        cur = sql.cursor()
+        cur.execute(
+            'SELECT site, window_start, last_timestamp, last_revid, full_sync_at FROM sync_cursors '
+            'WHERE contestsite=%s AND contest=%s AND user=%s',
+            [contest.sites.homesite.key, contest.name, self.name]
+        )
+        for row in result_iterator(cur):
+            self.sync_cursors[row[0]] = {
+                'window_start': row[1],
+                'timestamp': row[2],
+                'revid': row[3],
+                'full_sync_at': row[4],
+                'dirty': False,
+            }
+        cur.close()
 
-            for page in res['query']['pages'].values():
-                article_key = site_key + ':' + page['title']
-                # In the case of a merge, the new title (article_key) might not be part of the user's
-                # contribution list (self.articles), so we need to check:
-                if article_key in self.articles:
-                    article = self.articles[article_key]
-                    for apirev in page.get('revisions', []):
-                        nr += 1
-                        parentid = apirev['revid']
-                        found = False
-                        for revid, rev in article.revisions.items():
-                            if rev.parentid == parentid:
-                                found = True
-                                break
-                        if found:
-                            rev.parentsize = apirev['size']
-                            content = pydash.get(apirev, 'slots.main.*')
-                            if content is None:
-                                logger.warning('Did not get revision text for %s', article.name)
-                            else:
-                                rev.parenttext = content
-                                logger.debug('Got revision text for %s: %d bytes', article.name, len(rev.parenttext))
-                        else:
-                            rev.parenttext = ''  # New page
-            parentids = parentids[cur_apilim:]
-
-        if nr > 0:
-            dt = time.time() - t0
-            logger.info('Checked %d parent revisions in %.2f secs', nr, dt)
+    def save_sync_cursors(self, sql):
+        """ Save the sync cursors that were moved by add_contribs_from_wiki """
+        contest = self.contest()
+        data = []
+        for site_key, cursor in self.sync_cursors.items():
+            if cursor['dirty']:
+                data.append((
+                    contest.sites.homesite.key, contest.name, self.name, site_key,
+                    cursor['window_start'].strftime('%F %T'),
+                    cursor['timestamp'].strftime('%F %T'),
+                    cursor['revid'],
+                    cursor['full_sync_at'].strftime('%F %T'),
+                ))
+                cursor['dirty'] = False
+        if len(data) == 0:
+            return
+
+        cur = sql.cursor()
+        cur.executemany("""
+            replace into sync_cursors (contestsite, contest, user, site, window_start, last_timestamp, last_revid, full_sync_at)
+            values (%s,%s,%s,%s,%s,%s,%s,%s)
+            """, data
+        )
+        sql.commit()
+        cur.close()
 
     def backfill_article_creation_dates(self, sql):
         cur = sql.cursor()
@@ -343,101 +546,112 @@ class User:
     def save_contribs_to_db(self, sql):
         """ Save self.articles to DB so it can be read by add_contribs_from_db """
 
-        cur = sql.cursor()
+        text_revs = []  # (revid, site key, rev, is parent)
 
-        contribs_query_params = []
-        fulltexts_query_params = []
+        def contrib_rows():
+            for article_key, article in self.articles.items():
+                site_key = article.site().key
 
-        for article_key, article in self.articles.items():
-            site_key = article.site().key
+                for revid, rev in article.revisions.items():
+                    # Save revision if not already saved
+                    if not rev.saved:
+                        ts = datetime.fromtimestamp(rev.timestamp).strftime('%F %T')
+                        yield (revid, site_key, rev.parentid, self.name, article.name, ts, rev.size, rev.parentsize, rev.parsedcomment, article.ns)
+                        rev.saved = True
 
-            for revid, rev in article.revisions.items():
-                ts = datetime.fromtimestamp(rev.timestamp).strftime('%F %T')
-
-                # Save revision if not already saved
-                if not rev.saved:
-                    contribs_query_params.append((revid, site_key, rev.parentid, self.name, article.name, ts, rev.size, rev.parentsize, rev.parsedcomment, article.ns))
-                    rev.saved = True
-
-                if rev.dirty:
-                    # Save revision text if we have it and if not already saved
-                    fulltexts_query_params.append((revid, site_key, rev.text))
-                    fulltexts_query_params.append((rev.parentid, site_key, rev.parenttext))
+                    if rev.dirty:
+                        # Save revision text if we have it and if not already saved.
+                        # The text store only keeps one copy of each distinct text.
+                        text_revs.append((revid, site_key, rev, False))
+                        if rev.parentid:
+                            text_revs.append((rev.parentid, site_key, rev, True))
+                        rev.dirty = False
 
         # Insert all revisions
-        chunk_size = 1000
-        for n in range(0, len(contribs_query_params), chunk_size):
-            data = contribs_query_params[n:n+chunk_size]
-            # logger.info('Adding %d contributions to database', len(data))
-
-            t0 = time.time()
-            cur.executemany("""
-                insert into contribs (revid, site, parentid, user, page, timestamp, size, parentsize, parsedcomment, ns)
-                values (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
-                """, data
-            )
-            dt = time.time() - t0
-            logger.info('Added %d contributions to database in %.2f secs', len(data), dt)
-
-        chunk_size = 100
-        for n in range(0, len(fulltexts_query_params), chunk_size):
-            data = fulltexts_query_params[n:n+chunk_size]
-            # logger.info('Adding %d fulltexts to database', len(data))
-            t0 = time.time()
-
-            cur.executemany("""
-                insert into fulltexts (revid, site, revtxt)
-                values (%s,%s,%s)
-                on duplicate key update revtxt=values(revtxt);
-                """, data
-            )
-
-            dt = time.time() - t0
-            logger.info('Added %d fulltexts to database in %.2f secs', len(data), dt)
+        t0 = time.time()
+        nrows = executemany_chunked(sql, """
+            insert into contribs (revid, site, parentid, user, page, timestamp, size, parentsize, parsedcomment, ns)
+            values (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
+            on duplicate key update parentid=values(parentid), user=values(user), page=values(page),
+                timestamp=values(timestamp), size=values(size), parentsize=values(parentsize),
+                parsedcomment=values(parsedcomment), ns=values(ns)
+            """, contrib_rows())
+        if nrows > 0:
+            dt = max(time.time() - t0, 1e-6)
+            logger.info('Added %d contributions to database in %.2f secs (%.0f rows/sec)', nrows, dt, nrows / dt)
+
+        # Texts that are already stored, typically parent texts, are not written again
+        store = TextStore(sql)
+        stored = store.existing(set((revid, site_key) for revid, site_key, rev, is_parent in text_revs))
+
+        def text_rows():
+            for revid, site_key, rev, is_parent in text_revs:
+                if (revid, site_key) not in stored:
+                    yield (revid, site_key, rev.parenttext if is_parent else rev.text)
+
+        store.save(self.contest().texts.unsaved(text_rows()))
 
         sql.commit()
-        cur.close()
 
-    def backfill_text(self, sql, site, rev):
-        parentid = None
-        props = 'ids|size|content'
-        res = site.api('query', prop='revisions', rvprop=props, rvslots='main', revids='{}|{}'.format(rev.revid, rev.parentid))['query']
-        if res.get('pages') is None:
-            logger.info('Failed to get revision %d, revision deleted?', rev.revid)
-            return
+    def backfill_texts(self, sql, sites, missing_texts, missing_parenttexts):
+        """
+        Fetch revision texts that are missing from the DB, and store them.
 
-        for page in res['pages'].values():
-            for apirev in page['revisions']:
-                if apirev['revid'] == rev.revid:
-                    content = pydash.get(apirev, 'slots.main.*')
-                    if content is None:
-                        logger.warning('No revision text available!')
-                    else:
-                        rev.text = content
-                elif apirev['revid'] == rev.parentid:
+            sql                 : SQL Connection object
+            sites               : dict of sites
+            missing_texts       : dict of site key -> list of revisions missing their text
+            missing_parenttexts : dict of site key -> list of revisions missing their parent text
+        """
+        t0 = time.time()
+        text_rows = []
+        registry = self.contest().texts
+        for site_key in set(missing_texts.keys()) | set(missing_parenttexts.keys()):
+            site = sites[site_key]
+            by_revid = {}
+            by_parentid = {}
+            sizes = {}
+            for rev in missing_texts.get(site_key, []):
+                by_revid.setdefault(rev.revid, []).append(rev)
+                sizes[rev.revid] = max(rev.size, 0)
+            for rev in missing_parenttexts.get(site_key, []):
+                by_parentid.setdefault(rev.parentid, []).append(rev)
+                sizes[rev.parentid] = max(rev.parentsize, 0)
+            revids = set(by_revid.keys()) | set(by_parentid.keys())
+            nfound = 0
+
+            def set_text(revid, content):
+                for rev in by_revid.get(revid, []):
+                    rev.text = content
+                for rev in by_parentid.get(revid, []):
+                    rev.parenttext = content
+                text_rows.append((revid, site_key, content))
+
+            # Texts already fetched for other participants in this run
+            for revid, (content, size) in registry.get_many(site_key, revids).items():
+                nfound += 1
+                set_text(revid, content)
+                revids.remove(revid)
+
+            for page in fetch_revisions(site, sorted(revids), 'ids|size|content', revision_batch_size(site),
+                                        sizes, self.contest().batch_budgets):
+                for apirev in page.get('revisions', []):
                     content = pydash.get(apirev, 'slots.main.*')
                     if content is None:
-                        logger.warning('No parent revision text available!')
-                    else:
-                        rev.parenttext = content
-
-        cur = sql.cursor()
+                        logger.warning('No revision text available for revision %d', apirev['revid'])
+                        continue
+                    nfound += 1
+                    set_text(apirev['revid'], content)
+                    registry.add(site_key, apirev['revid'], content, apirev['size'])
 
-        # Save revision text if we have it and if not already saved
-        cur.execute('SELECT revid FROM fulltexts WHERE revid=%s AND site=%s', [rev.revid, site.key])
-        if len(rev.text) > 0 and len(cur.fetchall()) == 0:
-            cur.execute('INSERT INTO fulltexts (revid, site, revtxt) VALUES (%s,%s,%s)', (rev.revid, site.key, rev.text))
-            sql.commit()
+            ntotal = len(set(by_revid.keys()) | set(by_parentid.keys()))
+            if nfound < ntotal:
+                logger.info('Failed to get %d of %d revision texts from %s, revisions deleted?',
+                            ntotal - nfound, ntotal, site_key)
 
-        # Save parent revision text if we have it and if not already saved
-        if parentid is not None:
-            logger.debug('Storing parenttext %d , revid %s ', len(rev.parenttext), rev.parentid)
-            cur.execute('SELECT revid FROM fulltexts WHERE revid=%s AND site=%s', [rev.parentid, site.key])
-            if len(rev.parenttext) > 0 and len(cur.fetchall()) == 0:
-                cur.execute('INSERT INTO fulltexts (revid, site, revtxt) VALUES (%s,%s,%s)', (rev.parentid, site.key, rev.parenttext))
-                sql.commit()
+        TextStore(sql).save(registry.unsaved(text_rows))
 
-        cur.close()
+        dt = time.time() - t0
+        logger.info('Backfilled %d revision texts in %.2f secs', len(text_rows), dt)
 
     def add_contribs_from_db(self, sql, start, end, sites):
         """
@@ -458,15 +672,14 @@ class User:
         nrevs = 0
         narts = 0
         t0 = time.time()
+
+        # Only the metadata is read here. The revision texts are loaded by load_texts
+        # once we know which articles remain after filtering.
         cur.execute(
             '''
             SELECT
-                c.revid, c.site, c.parentid, c.page, c.timestamp, c.size, c.parentsize, c.parsedcomment, c.ns,
-                ft.revtxt,
-                ft2.revtxt
+                c.revid, c.site, c.parentid, c.page, c.timestamp, c.size, c.parentsize, c.parsedcomment, c.ns
             FROM contribs AS c
-            LEFT JOIN fulltexts AS ft ON ft.revid = c.revid AND ft.site = c.site
-            LEFT JOIN fulltexts AS ft2 ON ft2.revid = c.parentid AND ft2.site = c.site
             WHERE c.user = %s
             AND c.timestamp >= %s AND c.timestamp <= %s
             ''',
@@ -474,7 +687,7 @@ class User:
         )
         for row in result_iterator(cur):
 
-            rev_id, site_key, parent_id, article_title, ts, size, parentsize, parsedcomment, ns, rev_text, parent_rev_txt = row
+            rev_id, site_key, parent_id, article_title, ts, size, parentsize, parsedcomment, ns = row
             article_key = site_key + ':' + article_title
 
             ts = unix_time(pytz.utc.localize(ts))
@@ -494,22 +707,12 @@ class User:
             # Add revision if not present
             if not rev_id in self.revisions:
                 nrevs += 1
-                article.add_revision(rev_id, timestamp=ts, parentid=parent_id, size=size, parentsize=parentsize,
-                    username=self.name, parsedcomment=parsedcomment, text=rev_text, parenttext=parent_rev_txt)
+                rev = article.add_revision(rev_id, timestamp=ts, parentid=parent_id, size=size, parentsize=parentsize,
+                    username=self.name, parsedcomment=parsedcomment)
+                rev.defer_texts()
             rev = self.revisions[rev_id]
             rev.saved = True
 
-            # Add revision text
-            if rev_text is None or rev_text == '':
-                logger.debug('Article: %s, text missing %s, backfilling', article.name, rev_id)
-                self.backfill_text(sql, sites[site_key], rev)
-
-            # Add parent revision text
-            if not rev.new:
-                if parent_rev_txt is None or parent_rev_txt == '':
-                    logger.debug('Article: %s, parent text missing: %s,  backfilling', article.name, parent_id)
-                    self.backfill_text(sql, sites[site_key], rev)
-
         cur.close()
 
         # Always sort after we've added contribs
@@ -519,6 +722,73 @@ class User:
         dt = time.time() - t0
         logger.info('Read %d revisions, %d pages from database in %.2f secs', nrevs, narts, dt)
 
+    def load_texts(self, articles=None):
+        """
+        Load the revision texts of the given articles (default: all the user's articles)
+        that haven't been loaded yet from the text store in one go. Texts that are missing
+        from the store are backfilled from the wikis.
+
+            articles : dict of article key -> Article
+        """
+        if articles is None:
+            articles = self.articles
+        revs = [
+            rev
+            for article in articles.values()
+            for rev in article.revisions.values()
+            if not rev.text_loaded or not rev.parenttext_loaded
+        ]
+        if len(revs) == 0:
+            return
+
+        t0 = time.time()
+        sql = self.contest().sql
+        store = TextStore(sql)
+        sites = {}
+        revs_by_site = OrderedDict()
+        for rev in revs:
+            site = rev.article().site()
+            sites[site.key] = site
+            revs_by_site.setdefault(site.key, []).append(rev)
+
+        missing_texts = {}
+        missing_parenttexts = {}
+        for site_key, site_revs in revs_by_site.items():
+            revids = set()
+            for rev in site_revs:
+                if not rev.text_loaded:
+                    revids.add(rev.revid)
+                if not rev.parenttext_loaded:
+                    revids.add(rev.parentid)
+            texts = store.load_compressed(site_key, revids)
+
+            for rev in site_revs:
+                if not rev.text_loaded:
+                    if rev.revid in texts:
+                        rev.set_compressed_texts(ztext=texts[rev.revid])
+                    else:
+                        logger.debug('Article: %s, text missing %s, backfilling', rev.article().name, rev.revid)
+                        missing_texts.setdefault(site_key, []).append(rev)
+                if not rev.parenttext_loaded:
+                    if rev.parentid in texts:
+                        rev.set_compressed_texts(zparenttext=texts[rev.parentid])
+                    else:
+                        logger.debug('Article: %s, parent text missing: %s,  backfilling', rev.article().name, rev.parentid)
+                        missing_parenttexts.setdefault(site_key, []).append(rev)
+
+        if len(missing_texts) > 0 or len(missing_parenttexts) > 0:
+            self.backfill_texts(sql, sites, missing_texts, missing_parenttexts)
+
+        # Revisions that have been deleted
+        for rev in revs:
+            if not rev.text_loaded:
+                rev.text = ''
+            if not rev.parenttext_loaded:
+                rev.parenttext = ''
+
+        dt = time.time() - t0
+        logger.info('Loaded texts for %d revisions in %.2f secs', len(revs), dt)
+
     def filter(self, filters):
 
         logger.info('Filtering user contributions')
@@ -548,7 +818,7 @@ class User:
             else:
                 # Apply single filter
                 logger.debug('%s Applying %s filter', '>' * depth, type(filters).__name__)
-                return filters.filter(articles)
+                return filters.apply(articles, self.load_texts if filters.needs_text else None)
 
         logger.debug('Before filtering : %d articles',
                      len(self.articles))
@@ -560,6 +830,9 @@ class User:
         # We should re-sort afterwards since not all filters preserve the order (notably the CatFilter)
         self.sort_contribs()
 
+        # Load the texts of the remaining articles only
+        self.load_texts()
+
         dt = time.time() - t0
         logger.info('%d of %d pages remain after filtering. Filtering took %.2f secs', len(self.articles), n0, dt)
         for a in self.articles.keys():
@@ -583,10 +856,18 @@ class User:
     def count_newpages_per_site(self):
         return self.count_article_stats_per_site('newpages', lambda a: 1 if a.new_non_redirect else 0)
 
-    def analyze(self, rules):
-        x = []
-        y = []
-        utc = pytz.utc
+    def analyze(self, rules, cache=None):
+        timestamps = []
+        points = []
+
+        # Let the rules fetch the data they need for all the revisions at once
+        for rule in rules:
+            rule.prefetch([
+                rev
+                for article in self.articles.values()
+                if rule.site is None or article.site().key in rule.site
+                for rev in article.revisions.values()
+            ], cache)
 
         # loop over articles
         for article in self.articles.values():
@@ -606,34 +887,25 @@ class User:
                             self.contributions.add(contribution)
 
                 if not article.disqualified:
-                    dt = pytz.utc.localize(datetime.fromtimestamp(rev.timestamp))
-                    if self.suspended_since is None or dt < self.suspended_since:
-                        contributions = self.contributions.get(revision=rev)
-                        points = sum([contribution.points for contribution in contributions])
-
-                        if points > 0:
-                            # logger.debug('%s: %d: %s', self.name, rev.revid, points)
-                            ts = float(unix_time(utc.localize(datetime.fromtimestamp(rev.timestamp)).astimezone(
-                                self.contest().wiki_tz
-                            )))
-                            x.append(ts)
-                            y.append(float(points))
-
-                            # logger.debug('    %d : %d ', revid, points)
+                    rev_points = sum([contribution.points for contribution in self.contributions.get(revision=rev)])
+                    if rev_points > 0:
+                        # logger.debug('%s: %d: %s', self.name, rev.revid, rev_points)
+                        timestamps.append(rev.timestamp)
+                        points.append(rev_points)
+
             logger.debug('[[%s]] Sum: %.1f points', article.name,
                          self.contributions.get_article_points(article=article))
 
-        x = np.array(x)
-        y = np.array(y)
-
-        o = np.argsort(x)
-        x = x[o]
-        y = y[o]
-        #pl = np.array(pl, dtype=float)
-        #pl.sort(axis = 0)
-        y2 = np.array([np.sum(y[:q + 1]) for q in range(len(y))])
-        self.plotdata = np.column_stack((x, y2))
-        #np.savetxt('user-%s'%self.name, np.column_stack((x,y,y2)))
+        x = localtime_as_utc(timestamps)
+        y = np.array(points, dtype=float)
+
+        if self.suspended_since is not None:
+            keep = x < unix_time(self.suspended_since)
+            x = x[keep]
+            y = y[keep]
+
+        o = np.argsort(x, kind='stable')
+        self.plotdata = {'x': x[o], 'y': np.cumsum(y[o])}
 
     def format_result(self):
         logger.debug('Formatting results for user %s', self.name)
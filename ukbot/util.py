@@ -1,10 +1,13 @@
 # encoding=utf-8
 # vim: fenc=utf-8 et sw=4 ts=4 sts=4 ai
 import sys
+import json
+import time
 import unicodedata
 import logging
 import os
 from copy import deepcopy
+import numpy as np
 import pytz
 import yaml
 import re
@@ -25,6 +28,121 @@ def unix_time(dt):
     return delta.total_seconds()
 
 
+def localtime_as_utc(timestamps):
+    """
+    Vectorized version of `unix_time(pytz.utc.localize(datetime.fromtimestamp(ts)))` for an array
+    of unix timestamps, that is, the server's local wall-clock time read as if it was UTC.
+    """
+    timestamps = np.asarray(timestamps, dtype=float)
+    if time.timezone == 0 and time.altzone == 0:
+        # The server runs on UTC, which is the normal case
+        return timestamps.copy()
+    offsets = np.fromiter((time.localtime(ts).tm_gmtoff for ts in timestamps), dtype=float, count=len(timestamps))
+    return timestamps + offsets
+
+
+def cache_dir():
+    """
+    Directory for files that can be regenerated, set by UKBOT_CACHE_DIR (default: ~/.cache/ukbot).
+    Returns None if the directory can't be created, in which case nothing is cached.
+    """
+    path = os.environ.get('UKBOT_CACHE_DIR') or os.path.join(os.path.expanduser('~'), '.cache', 'ukbot')
+    try:
+        os.makedirs(path, exist_ok=True)
+    except OSError as err:
+        logger.warning('Could not create the cache dir %s: %s', path, err)
+        return None
+    return path
+
+
+def write_file_atomic(filename, data):
+    """ Write a file so that other processes never see it half-written """
+    tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+    with open(tmp_filename, 'w', encoding='utf-8') as fp:
+        fp.write(data)
+    os.replace(tmp_filename, filename)
+
+
+def load_cached_json(name, ttl, fetch):
+    """
+    Returns the result of fetch(), cached as a JSON file in the cache dir for ttl seconds.
+    If fetch() fails, an expired copy is used if available.
+    """
+    path = cache_dir()
+    if path is None:
+        return fetch()
+    filename = os.path.join(path, name)
+    try:
+        age = time.time() - os.path.getmtime(filename)
+    except OSError:
+        age = None
+
+    if age is not None and age < ttl:
+        try:
+            with open(filename, encoding='utf-8') as fp:
+                return json.load(fp)
+        except (IOError, ValueError) as err:
+            logger.warning('Could not read %s: %s', filename, err)
+
+    try:
+        data = fetch()
+    except Exception:
+        if age is None:
+            raise
+        logger.exception('Failed to refresh %s, using the copy from %.1f hours ago', name, age / 3600.)
+        with open(filename, encoding='utf-8') as fp:
+            return json.load(fp)
+
+    try:
+        write_file_atomic(filename, json.dumps(data))
+    except IOError as err:
+        logger.warning('Could not store %s: %s', filename, err)
+    return data
+
+
+def find_control_char_ranges():
+    """ Returns a list of [first, last] code point ranges of the characters in the Cc and Cf categories """
+    ranges = []
+    for i in range(sys.maxunicode):
+        if unicodedata.category(chr(i)) in {'Cc', 'Cf'}:
+            if len(ranges) > 0 and ranges[-1][1] == i - 1:
+                ranges[-1][1] = i
+            else:
+                ranges.append([i, i])
+    return ranges
+
+
+def control_char_ranges():
+    """
+    Returns the control character ranges. Scanning all of Unicode takes a while, so the ranges
+    are stored in the cache dir, in a file keyed by the Unicode database version.
+    """
+    path = cache_dir()
+    if path is None:
+        return find_control_char_ranges()
+    filename = os.path.join(path, 'control_chars-%s.json' % unicodedata.unidata_version)
+    try:
+        with open(filename) as fp:
+            return json.load(fp)
+    except (IOError, ValueError):
+        pass
+
+    logger.info('Preparing control char ranges for Unicode %s', unicodedata.unidata_version)
+    ranges = find_control_char_ranges()
+    try:
+        write_file_atomic(filename, json.dumps(ranges))
+    except IOError as err:
+        logger.warning('Could not store the control char ranges: %s', err)
+    return ranges
+
+
+def control_char_regexp(ranges):
+    return re.compile('[%s]' % ''.join(
+        re.escape(chr(first)) if first == last else '%s-%s' % (re.escape(chr(first)), re.escape(chr(last)))
+        for first, last in ranges
+    ))
+
+
 def cleanup_input(value):
     global control_char_re
 
@@ -32,11 +150,7 @@ def cleanup_input(value):
         return value
 
     if control_char_re is None:
-        logger.info('Preparing control char regexp...')
-        all_chars = (chr(i) for i in range(sys.maxunicode))
-        control_chars = ''.join(c for c in all_chars if unicodedata.category(c) in {'Cc', 'Cf'})
-        control_char_re = re.compile('[%s]' % re.escape(control_chars))
-        logger.info('Control char regexp is ready')
+        control_char_re = control_char_regexp(control_char_ranges())
 
     value = value.strip()
     value = re.sub(r'<!--.+?-->', r'', value)